@@ -253,7 +253,7 @@ class FSGuiApplication:
                         bfs_queue.append(child)
                 
                 return list_ids
-            if vartype in ['node:float', 'node:bool', 'node:point2d', 'node:bin_id', 'node:spikes', 'node:bin_id', 'node:discrete_distribution', 'node:timestamp']:
+            if vartype in ['node:float', 'node:bool', 'node:point2d', 'node:bin_id', 'node:spikes', 'node:bin_id', 'node:discrete_distribution', 'node:timestamp', 'node:band_envelope']:
                 return [param_value]
             else:
                 logging.warning(f'vartype not explicitly listed to be handled: {vartype}')
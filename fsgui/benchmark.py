@@ -0,0 +1,184 @@
+"""
+Microbenchmarks for the per-sample filter paths.
+
+Run with `python -m fsgui.benchmark`. Each benchmark reports the time per call
+and the memory tracemalloc sees allocated per call, which should stay near zero
+for the streaming filters.
+"""
+import time
+import tracemalloc
+import numpy as np
+
+import fsgui.filter.lfp.ripple_new
+import fsgui.filter.lfp.theta
+import fsgui.filter.lfp.theta_hilbert
+import fsgui.filter.lfp.theta_tracker
+import fsgui.filter.spatial.speed
+
+def measure(function, inputs, n_warmup=100):
+    """
+    Calls `function` once per item of `inputs` and returns (seconds per call, bytes per call).
+    """
+    for item in inputs[:n_warmup]:
+        function(item)
+
+    t0 = time.perf_counter()
+    for item in inputs:
+        function(item)
+    elapsed = time.perf_counter() - t0
+
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    for item in inputs:
+        function(item)
+    snapshot_after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(max(stat.size_diff, 0) for stat in snapshot_after.compare_to(snapshot_before, 'lineno'))
+
+    return elapsed / len(inputs), allocated / len(inputs)
+
+def measure_peak(function, inputs):
+    """
+    Calls `function` once per item of `inputs` and returns the mean peak of
+    memory allocated during a call, which also counts temporaries that are
+    freed before the call returns.
+    """
+    tracemalloc.start()
+    total = 0
+    for item in inputs:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        function(item)
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - baseline
+    tracemalloc.stop()
+
+    return total / len(inputs)
+
+def report(name, seconds_per_call, bytes_per_call):
+    print(f'{name:<48} {seconds_per_call*1e6:10.2f} us/call {bytes_per_call:10.1f} B/call')
+
+def benchmark_envelope_estimator(num_signals=64, n_samples=5000):
+    estimator = fsgui.filter.lfp.ripple_new.EnvelopeEstimator(num_signals=num_signals)
+    lfps = np.random.default_rng(0).normal(size=(n_samples, num_signals)) * 100
+    report(f'EnvelopeEstimator.add_new_data ({num_signals} ch)', *measure(estimator.add_new_data, lfps))
+
+def benchmark_ripple_scaling(num_signals, num_workers, block_size=15, n_blocks=200):
+    """
+    Detector throughput (filtering, Welford stats and thresholding) for a channel
+    count and number of shards. At 1500 Hz the budget is 667 us per sample.
+    """
+    estimator_kwargs = dict(bp_order=2, bp_crit_freqs=[150,250], lfp_sampling_rate=1500, env_num_taps=15, env_band_edges=[50,55], env_desired=[1,0])
+    config = {'sample_mean_sd': True, 'sd_threshold': 3.5, 'auto_flag': True, 'means_magic_input': 50, 'sigmas_magic_input': 25}
+    blocks = np.random.default_rng(0).normal(size=(n_blocks, block_size, num_signals)) * 100
+
+    if num_workers > 1:
+        detector = fsgui.filter.lfp.ripple_new.ShardedEnvelopeDetector(num_signals, num_workers, block_size, estimator_kwargs)
+        process_block = lambda lfps: detector.process_block(lfps, config)
+    else:
+        estimator = fsgui.filter.lfp.ripple_new.EnvelopeEstimator(num_signals=num_signals, **estimator_kwargs)
+        detector = fsgui.filter.lfp.ripple_new.EnvelopeThresholdDetector(num_signals)
+        def process_block(lfps):
+            _, envelopes = estimator.add_new_block(lfps)
+            return [detector.process_envelope(envelope, dict(config, n_above_threshold=1))[0] for envelope in envelopes]
+
+    try:
+        seconds_per_block, _ = measure(process_block, blocks, n_warmup=10)
+    finally:
+        if num_workers > 1:
+            detector.close()
+
+    seconds_per_sample = seconds_per_block / block_size
+    print(f'ripple detector {num_signals:5d} ch {num_workers:2d} workers {seconds_per_sample*1e6:10.2f} us/sample {1/seconds_per_sample/1500:8.1f}x realtime')
+
+def benchmark_theta_filter(n_samples=5000):
+    theta_filter = fsgui.filter.lfp.theta.ThetaFilter(
+        coefficients=fsgui.filter.lfp.theta.ThetaFilterCoefficientsDefault(),
+        params=fsgui.filter.lfp.theta.ThetaFilterParams(targetPhase=0),
+        sample_rate=1500,
+    )
+    lfps = np.random.default_rng(0).normal(size=(n_samples,)) * 100
+    samples = list(zip(lfps.tolist(), range(0, 20 * n_samples, 20)))
+    report('ThetaFilter.process_theta_data', *measure(lambda sample: theta_filter.process_theta_data(*sample), samples))
+
+def benchmark_theta_hilbert(update_interval, n_samples=6000, sample_rate=1500, timestamp_interval=20):
+    """
+    Time per sample and trigger phase accuracy of the Hilbert theta filter on a
+    noisy theta-band chirp whose true phase is known.
+    """
+    theta_filter = fsgui.filter.lfp.theta_hilbert.ThetaHilbertYuleWalkerFilter(
+        phase_deg=0,
+        samples_per_second=sample_rate,
+        timestamp_interval=timestamp_interval,
+        update_interval=update_interval,
+    )
+    rng = np.random.default_rng(0)
+    t = np.arange(n_samples) / sample_rate
+    true_phase = 2 * np.pi * (7 * t + 0.1 * t**2)
+    lfps = 100 * np.cos(true_phase) + 20 * rng.normal(size=n_samples)
+    timestamps = np.arange(n_samples) * timestamp_interval
+
+    samples = list(zip(lfps.tolist(), timestamps.tolist()))
+
+    t0 = time.perf_counter()
+    triggered = [theta_filter.process_theta_data(*sample)[0] for sample in samples[:-500]]
+    seconds_per_sample = (time.perf_counter() - t0) / (n_samples - 500)
+
+    # the filter keeps running on the last samples, so the model state stays realistic
+    peak_bytes = measure_peak(lambda sample: theta_filter.process_theta_data(*sample), samples[-500:])
+
+    # ignore the first second while the buffers fill
+    trigger_index = np.flatnonzero(triggered)
+    trigger_index = trigger_index[trigger_index >= sample_rate]
+    phase_error = np.angle(np.exp(1j * (true_phase[trigger_index] - theta_filter.phase_rad)))
+    # trigger yield against the target crossings of the true phase over the same samples
+    n_cycles = int((true_phase[-500] - theta_filter.phase_rad) // (2 * np.pi) - (true_phase[sample_rate] - theta_filter.phase_rad) // (2 * np.pi))
+
+    print(f'ThetaHilbertYuleWalkerFilter update every {update_interval:3d} samples {seconds_per_sample*1e6:10.2f} us/sample '
+        f'{peak_bytes:10.1f} peak B/sample {len(trigger_index):4d} triggers of {n_cycles:4d} cycles, '
+        f'phase error {np.degrees(np.mean(phase_error)):7.2f} mean {np.degrees(np.std(phase_error)):7.2f} sd deg')
+
+def benchmark_theta_hilbert_batch(num_signals, update_interval=1, n_samples=2000):
+    theta_filter = fsgui.filter.lfp.theta_hilbert.ThetaHilbertYuleWalkerFilter(phase_deg=0, update_interval=update_interval, num_signals=num_signals)
+    lfps = np.random.default_rng(0).normal(size=(n_samples, num_signals)) * 100
+    samples = list(zip(lfps, range(0, 20 * n_samples, 20)))
+    report(f'ThetaHilbertYuleWalkerFilter batch ({num_signals} ch, every {update_interval})',
+        *measure(lambda sample: theta_filter.process_theta_data(*sample), samples))
+
+def benchmark_theta_tracker(num_signals, n_samples=5000):
+    tracker = fsgui.filter.lfp.theta_tracker.ThetaPhaseTracker(num_signals=num_signals, sample_rate=1500, target_phase_deg=0)
+    lfps = np.random.default_rng(0).normal(size=(n_samples, num_signals)) * 100
+    report(f'ThetaPhaseTracker.process_theta_data ({num_signals} ch)', *measure(tracker.process_theta_data, lfps))
+
+def benchmark_kinematics_estimator(n_samples=5000):
+    smoothing_filter = [0.31, 0.29, 0.25, 0.15]
+    estimator = fsgui.filter.spatial.speed.KinematicsEstimator(
+        scale_factor=0.222,
+        dt=1/30,
+        xfilter=smoothing_filter,
+        yfilter=smoothing_filter,
+        speedfilter=smoothing_filter,
+    )
+    positions = np.random.default_rng(0).uniform(0, 500, size=(n_samples, 2)).tolist()
+    report('KinematicsEstimator.compute_kinematics', *measure(
+        lambda xy: estimator.compute_kinematics(xy[0], xy[1], smooth_x=True, smooth_y=True, smooth_speed=True),
+        positions))
+
+if __name__ == '__main__':
+    benchmark_envelope_estimator(num_signals=64)
+    benchmark_envelope_estimator(num_signals=256)
+    benchmark_theta_filter()
+    for update_interval in [1, 15, 30, 60, 150, 300]:
+        benchmark_theta_hilbert(update_interval)
+    for num_signals in [8, 32]:
+        benchmark_theta_hilbert_batch(num_signals)
+        benchmark_theta_hilbert_batch(num_signals, update_interval=15)
+    benchmark_theta_tracker(num_signals=1)
+    benchmark_theta_tracker(num_signals=64)
+    benchmark_theta_tracker(num_signals=256)
+    benchmark_kinematics_estimator()
+
+    for num_signals in [64, 256, 1024]:
+        for num_workers in [1, 2, 4]:
+            benchmark_ripple_scaling(num_signals, num_workers)
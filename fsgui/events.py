@@ -0,0 +1,61 @@
+"""
+Compact event records for detectors that would otherwise publish a boolean
+for every sample. An 'onset' record is sent when the detector turns on and an
+'offset' record when it turns off, so consumers only wake up on changes.
+"""
+
+def is_event(value):
+    return isinstance(value, dict) and 'event' in value
+
+def latch(value):
+    """
+    The state a consumer of a bool stream latches from a published value:
+    onsets latch True until the matching offset, plain values replace the state.
+    """
+    if is_event(value):
+        return value['event'] == 'onset'
+    return value
+
+class EventSegmenter:
+    """
+    Turns a per-sample detection stream into onset/offset records.
+
+    Records carry the hardware timestamp of the transition, the peak z-score and
+    the largest number of channels above threshold seen so far in the event, and
+    the duration in timestamps (0 at onset).
+    """
+    def __init__(self):
+        self.active = False
+        self.onset_timestamp = None
+        self.peak_zscore = None
+        self.n_channels = 0
+
+    def __record(self, event, timestamp):
+        return {
+            'event': event,
+            'timestamp': timestamp,
+            'peak_zscore': float(self.peak_zscore),
+            'n_channels': int(self.n_channels),
+            'duration': timestamp - self.onset_timestamp,
+        }
+
+    def step(self, triggered, timestamp, peak_zscore, n_channels):
+        """
+        Returns an onset or offset record when the detection state changes, otherwise None.
+        """
+        if triggered:
+            if not self.active:
+                self.active = True
+                self.onset_timestamp = timestamp
+                self.peak_zscore = peak_zscore
+                self.n_channels = n_channels
+                return self.__record('onset', timestamp)
+
+            self.peak_zscore = max(self.peak_zscore, peak_zscore)
+            self.n_channels = max(self.n_channels, n_channels)
+            return None
+        elif self.active:
+            self.active = False
+            return self.__record('offset', timestamp)
+        else:
+            return None
@@ -1,7 +1,9 @@
+import fsgui.filter.lfp.band
 import fsgui.filter.lfp.ripple
 import fsgui.filter.lfp.ripple_new
 import fsgui.filter.lfp.theta
 import fsgui.filter.lfp.theta_hilbert
+import fsgui.filter.lfp.theta_tracker
 import fsgui.filter.spatial.polygon
 import fsgui.filter.spatial.rectangle
 import fsgui.filter.spatial.speed
@@ -18,8 +20,12 @@ class FilterProvider:
             fsgui.filter.spatial.speed.SpeedFilterType('speed-filter-type'),
             fsgui.filter.lfp.ripple.RippleFilterType('ripple-filter-type'),
             fsgui.filter.lfp.ripple_new.RippleFilterType('ripple-new-filter-type'),
+            fsgui.filter.lfp.band.BandFilterType('band-filter-type'),
+            fsgui.filter.lfp.band.BandThresholdFilterType('band-threshold-filter-type'),
             fsgui.filter.lfp.theta.ThetaFilterType('theta-filter-type'),
+            fsgui.filter.lfp.theta.MultiChannelThetaFilterType('theta-multichannel-filter-type'),
             fsgui.filter.lfp.theta_hilbert.ThetaPhaseHilbertFilterType('theta-phase-hilbert-filter-type'),
+            fsgui.filter.lfp.theta_tracker.ThetaPhaseTrackerFilterType('theta-phase-tracker-filter-type'),
             fsgui.filter.spikes.markspace.MarkSpaceEncoderType('mark-space-encoder-type'),
             fsgui.filter.cluster.DecoderType('point-process-encoder-type'),
             fsgui.filter.arm.ArmFilterType('arm-filter-type'),
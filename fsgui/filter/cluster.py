@@ -1,6 +1,6 @@
 import multiprocessing as mp
+import multiprocessing.connection
 import fsgui.node
-import zmq
 import time
 import numpy as np
 
@@ -75,9 +75,9 @@ class DecoderType(fsgui.node.NodeTypeObject):
             },
         ]
     def build(self, config, addr_map):
-        histogram_address=addr_map[config['histogram_source']]
-        timekeeper_address=addr_map[config['timekeeper_source']]
-        covariate_address=addr_map[config['covariate_source']]
+        histogram_pipe=addr_map[config['histogram_source']]
+        timekeeper_pipe=addr_map[config['timekeeper_source']]
+        covariate_pipe=addr_map[config['covariate_source']]
 
         def create_uniform_transition(n):
             return np.ones((n, n)) / n
@@ -96,30 +96,21 @@ class DecoderType(fsgui.node.NodeTypeObject):
         )
 
         def setup(reporter, data):
-            data['histogram_sub'] = fsgui.network.UnidirectionalChannelReceiver(histogram_address)
-            data['timekeeper_sub'] = fsgui.network.UnidirectionalChannelReceiver(timekeeper_address)
-            data['covariate_sub'] = fsgui.network.UnidirectionalChannelReceiver(covariate_address)
-
-            # use polling to receive from multiple pubs without blocking in sequence
-            data['poller'] = zmq.Poller()
-            for sub_var_name in ['histogram_sub', 'timekeeper_sub', 'covariate_sub']:
-                data['poller'].register(data[sub_var_name].sock)
-
             data['filter_model'] = decoder
 
             data['spike_buffer'] = []
 
         def workload(connection, publisher, reporter, data):
-            results = dict(data['poller'].poll(timeout=500))
+            # wait on all sources at once rather than blocking on each in sequence
+            results = mp.connection.wait([histogram_pipe, timekeeper_pipe, covariate_pipe], timeout=0.5)
 
-            if data['histogram_sub'].sock in results:
-                item = data['histogram_sub'].recv(timeout=0)
+            if histogram_pipe in results:
+                # encoded spikes carry their histogram as an array, buffered as received
+                while histogram_pipe.poll(timeout=0):
+                    data['spike_buffer'].append(histogram_pipe.recv())
 
-                # add things to the buffer
-                data['spike_buffer'].append(item)
-
-            if data['timekeeper_sub'].sock in results:
-                data['timekeeper_sub'].recv(timeout=0)
+            if timekeeper_pipe in results:
+                timekeeper_pipe.recv()
 
                 t0 = time.time()
                 
@@ -149,8 +140,8 @@ class DecoderType(fsgui.node.NodeTypeObject):
                     'dec_covariate': np.bincount([data['filter_model'].current_covariate_value], minlength=config['bin_count']).tolist() if data['filter_model'].current_covariate_value is not None else None,
                 })
 
-            if data['covariate_sub'].sock in results:
-                item = data['covariate_sub'].recv(timeout=0)
+            if covariate_pipe in results:
+                item = covariate_pipe.recv()
                 data['filter_model'].update_covariate(int(item))
  
         return fsgui.process.build_process_object(setup, workload)
@@ -213,14 +204,18 @@ class Decoder:
             likelihood *= likelihood_no_spike
             likelihood = self.__normalize(likelihood)
         
-        # spike contribution
-        for obs in observations:
+        # spike contribution, one row per spike in the time bin
+        histograms = [obs['histogram'] for obs in observations if obs['histogram'] is not None]
+        if len(histograms) > 0:
+            # stacking copies, so the received arrays are left as they are
+            histograms = np.stack(histograms)
             # at this point it would be good to replace zeros with small numbers
-            histogram = obs['histogram']
-            if histogram is not None:
-                histogram[histogram == 0] = 1e-7
-                likelihood = likelihood * histogram
-                likelihood = self.__normalize(likelihood)
+            histograms[histograms == 0] = 1e-7
+            # product over spikes in log space, which cannot underflow however many spikes arrive
+            # bins the no-spike terms drove to zero stay at zero
+            with np.errstate(divide='ignore'):
+                log_likelihood = np.log(likelihood) + np.sum(np.log(histograms, dtype='float'), axis=0)
+            likelihood = self.__normalize(np.exp(log_likelihood - np.max(log_likelihood)))
 
         transitioned_prior = (self._prior @ self.transmat)
         posterior = likelihood * transitioned_prior
@@ -1,6 +1,12 @@
 import multiprocessing as mp
 import fsgui.nparray
 import fsgui.node
+import fsgui.events
+import fsgui.filter.spikes.markindex
+import fsgui.filter.spikes.markextract
+import fsgui.filter.spikes.markhistory
+import fsgui.filter.spikes.querycache
+import fsgui.filter.spikes.snapshot
 import json
 import numpy as np
 import time
@@ -8,6 +14,9 @@ import zmq
 import functools
 import itertools
 
+# most spikes taken off the socket for one batch of queries
+MAX_SPIKE_BATCH = 256
+
 class SpikeContentDecoder(fsgui.node.NodeTypeObject):
     def __init__(self, type_id):
         super().__init__(
@@ -148,16 +157,130 @@ class SpikeContentDecoder(fsgui.node.NodeTypeObject):
                 'default': config['tetrode_selection'],
                 'live_editable': True,
             },
+            {
+                'label': 'Mark retention',
+                'name': 'retention',
+                'type': 'select',
+                'options': fsgui.filter.spikes.markhistory.RETENTION_OPTIONS,
+                'default': config.get('retention', 'all'),
+                'tooltip': 'Which marks each tetrode keeps. The bounded policies keep memory and query time flat over long sessions.',
+            },
+            {
+                'label': 'Retention capacity (marks per tetrode)',
+                'name': 'retention_capacity',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 10000000,
+                'default': config.get('retention_capacity', 100000),
+            },
+            {
+                'label': 'Retention window',
+                'name': 'retention_window',
+                'type': 'double',
+                'lower': 0,
+                'upper': 100000,
+                'decimals': 1,
+                'default': config.get('retention_window', 600),
+                'units': 's',
+                'tooltip': 'Age of the oldest mark kept by the time window policy.',
+            },
+            {
+                'label': 'Occupancy',
+                'name': 'occupancy_source',
+                'type': 'select',
+                'options': fsgui.filter.spikes.markhistory.OCCUPANCY_OPTIONS,
+                'default': config.get('occupancy_source', 'marks'),
+                'tooltip': 'Normalize each tetrode by the covariates of its own retained marks, or by one count of covariate samples shared by all tetrodes.',
+            },
+            {
+                'label': 'Query cache size (0 is off)',
+                'name': 'query_cache_size',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 1000000,
+                'default': config.get('query_cache_size', 0),
+                'tooltip': 'Number of recent query results kept, keyed by tetrode and quantized mark.',
+            },
+            {
+                'label': 'Query cache resolution',
+                'name': 'query_cache_resolution',
+                'type': 'double',
+                'lower': 0.001,
+                'upper': 1000,
+                'decimals': 3,
+                'default': config.get('query_cache_resolution', 1.0),
+                'units': 'uV',
+                'tooltip': 'Marks that agree to this resolution on every channel share a cached result.',
+            },
+            {
+                'label': 'Query cache: marks added before refresh',
+                'name': 'query_cache_max_new_marks',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 1000000,
+                'default': config.get('query_cache_max_new_marks', 100),
+                'tooltip': 'A cached result is recomputed once its tetrode has gained this many marks, or when the shared occupancy changes.',
+            },
+            {
+                'label': 'Snapshot directory',
+                'name': 'snapshot_directory',
+                'type': 'string',
+                'default': config.get('snapshot_directory', ''),
+                'tooltip': 'Directory the encoder model is saved to on demand and at unbuild. Leave empty to disable snapshots.',
+            },
+            {
+                'label': 'Warm start from snapshot',
+                'name': 'warm_start',
+                'type': 'boolean',
+                'default': config.get('warm_start', False),
+                'tooltip': 'On build, restore the marks and occupancy saved in this node\'s snapshot.',
+            },
+            {
+                'label': 'Kernel truncation tolerance (log10)',
+                'name': 'kernel_tolerance_exponent',
+                'type': 'integer',
+                'lower': -300,
+                'upper': -1,
+                'default': config.get('kernel_tolerance_exponent', -20),
+                'tooltip': 'Marks whose kernel weight is below 10^this times the kernel peak are skipped. -20 reaches 9.6 sigma, -6 reaches 5.3 sigma.',
+            },
+            {
+                'label': 'Kernel lookup table size (0 is off)',
+                'name': 'kernel_lookup_size',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 10000000,
+                'default': config.get('kernel_lookup_size', 0),
+                'tooltip': 'Evaluate the kernel from an interpolated table instead of exp. With x = ln(10) * |tolerance exponent| / (size - 1), the relative error is at most x^2 / 8 * exp(x), e.g. 9.9e-7 for -20 and 16384.',
+            },
         ]
     
-    def build(self, config, addr_map):
-        config['waveform_length'] = 40
+    def get_gui_config(self):
+        return [
+            {
+                'type': 'button',
+                'label': 'Save encoder snapshot',
+                'name': 'save_snapshot',
+                'pressed': True,
+            },
+        ]
 
+    def build(self, config, addr_map):
         spikes_address=addr_map[config['spikes_source']]
         covariate_address=addr_map[config['covariate_source']]
         update_address=addr_map[config['update_signal_source']]
 
-        def setup(reporter, data):
+        if config.get('snapshot_directory'):
+            snapshot = fsgui.filter.spikes.snapshot.EncoderSnapshot(
+                directory=config['snapshot_directory'],
+                instance_id=config['instance_id'],
+                mark_ndims=config['mark_ndims'],
+                bin_count=config['bin_count'],
+            )
+        else:
+            snapshot = None
+
+        def setup(logging, data):
             data['spikes_sub'] = fsgui.network.UnidirectionalChannelReceiver(spikes_address)
             data['covariate_sub'] = fsgui.network.UnidirectionalChannelReceiver(covariate_address)
             data['update_sub'] = fsgui.network.UnidirectionalChannelReceiver(update_address)
@@ -168,16 +291,43 @@ class SpikeContentDecoder(fsgui.node.NodeTypeObject):
             data['poller'].register(data['covariate_sub'].sock)
             data['poller'].register(data['update_sub'].sock)
 
-            # data['mark_calculator'] = MarkCalculator()
-            data['mark_calculator'] = MarkCalculatorNative(config['mark_ndims'], config['waveform_length'])
+            data['mark_extractor'] = fsgui.filter.spikes.markextract.MarkExtractor(
+                n_channels=config['mark_ndims'],
+                minimum_amplitude=config['minimum_spike_amplitude_filter'],
+                tetrode_selection=config['tetrode_selection'],
+            )
+            if config.get('occupancy_source', 'marks') == 'covariate':
+                data['occupancy'] = fsgui.filter.spikes.markhistory.OccupancyCounter(config['bin_count'])
+            else:
+                data['occupancy'] = None
+            if config.get('query_cache_size', 0) > 0:
+                data['query_cache'] = fsgui.filter.spikes.querycache.QueryCache(
+                    size=config['query_cache_size'],
+                    resolution=config.get('query_cache_resolution', 1.0),
+                    max_new_marks=config.get('query_cache_max_new_marks', 100),
+                )
+            else:
+                data['query_cache'] = None
             data['mark_encoder'] = MarkSpaceEncoderSynchronous(
                 bin_count=config['bin_count'],
                 mark_ndims=config['mark_ndims'],
                 kernel_sigma=config['sigma'],
                 n_minimum_in_region=config['n_minimum_in_region'],
-                region_zscore=config['region_zscore']
+                region_zscore=config['region_zscore'],
+                retention=config.get('retention', 'all'),
+                retention_capacity=config.get('retention_capacity', 100000),
+                # hardware timestamps are 30 kHz
+                retention_window=config.get('retention_window', 600) * 30000,
+                occupancy=data['occupancy'],
+                query_cache=data['query_cache'],
+                kernel_tolerance=10.0 ** config.get('kernel_tolerance_exponent', -20),
+                kernel_lookup_size=config.get('kernel_lookup_size', 0) or None,
             )
 
+            if snapshot is not None and config.get('warm_start', False):
+                n_restored = data['mark_encoder'].load_snapshot(snapshot)
+                logging.info(f'Encoder warm start restored {n_restored} tetrodes')
+
             data['update_model_bool'] = False
             data['current_covariate_value'] = None
 
@@ -207,6 +357,8 @@ class SpikeContentDecoder(fsgui.node.NodeTypeObject):
             # update signals from the GUI
             if connection.pipe_poll(timeout = 0):
                 msg_tag, msg_data = connection.pipe_recv()
+                if msg_tag == 'save_snapshot' and snapshot is not None:
+                    data['mark_encoder'].save_snapshot(snapshot)
                 if msg_tag == 'update':
                     msg_varname, msg_value = msg_data
                     # update mark encoder variables
@@ -218,13 +370,18 @@ class SpikeContentDecoder(fsgui.node.NodeTypeObject):
                             n_minimum_in_region=config['n_minimum_in_region'],
                             region_zscore=config['region_zscore']
                         )
+                    elif msg_varname == 'minimum_spike_amplitude_filter':
+                        data['mark_extractor'].minimum_amplitude = msg_value
+                    elif msg_varname == 'tetrode_selection':
+                        data['mark_extractor'].set_tetrode_selection(msg_value)
 
             t[2] = time.time()
 
             # update sub
             if data['update_sub'].sock in results:
                 item = data['update_sub'].recv()
-                data['update_model_bool'] = item
+                # event-mode filters only publish onsets/offsets, which latch the state
+                data['update_model_bool'] = bool(fsgui.events.latch(item))
 
             t[3] = time.time()
  
@@ -232,24 +389,40 @@ class SpikeContentDecoder(fsgui.node.NodeTypeObject):
             if data['covariate_sub'].sock in results:
                 item = data['covariate_sub'].recv()
                 data['current_covariate_value'] = item
+                if data['occupancy'] is not None and data['update_model_bool'] and item is not None:
+                    data['occupancy'].add(item)
 
             t[4] = time.time()
 
             if data['spikes_sub'].sock in results:
-              
+                # spikes that arrived together (bursts, batched delivery) are encoded in one batch per tetrode
+                received = []
                 spikes_data = data['spikes_sub'].recv()
+                while spikes_data is not None:
+                    received.append(spikes_data)
+                    spikes_data = data['spikes_sub'].recv(timeout=0) if len(received) < MAX_SPIKE_BATCH else None
+
+                if 'mark' in received[0]:
+                    # computed once at the source
+                    marks = np.array([spike['mark'] for spike in received], dtype='float')
+                    peak_amplitudes = np.array([spike['peakAmplitude'] for spike in received])
+                else:
+                    marks, peak_amplitudes = data['mark_extractor'].extract(
+                        np.stack([np.asarray(spike['samples'])[:config['mark_ndims']] for spike in received]))
+                keep = data['mark_extractor'].accepts([spike['nTrodeId'] for spike in received], peak_amplitudes)
+
+                spikes_per_tetrode = {}
+                for spike, mark in zip(itertools.compress(received, keep), marks[keep]):
+                    spikes_per_tetrode.setdefault(spike['nTrodeId'], []).append((mark, spike['localTimestamp']))
 
-                tetrode_id = spikes_data['nTrodeId']
                 bin_id = data['current_covariate_value']
 
-                mark = data['mark_calculator'].compute_mark(spikes_data['samples'])
-
-
-                query_histogram = data['mark_encoder'].query_mark(tetrode_id, mark)
+                for tetrode_id, spikes in spikes_per_tetrode.items():
+                    query_histograms = data['mark_encoder'].query_batch(tetrode_id, [mark for mark, _ in spikes])
 
-
-                if data['update_model_bool']:
-                    data['mark_encoder'].add_mark(tetrode_id, mark, data['current_covariate_value'])
+                    if data['update_model_bool']:
+                        for mark, timestamp in spikes:
+                            data['mark_encoder'].add_mark(tetrode_id, mark, bin_id, timestamp)
 
             t[5] = time.time()
 
@@ -265,13 +438,16 @@ class SpikeContentDecoder(fsgui.node.NodeTypeObject):
                 for i in track:
                     print(f'time {i}: {np.mean(stats[i])*6:.6f}us (sum {np.sum(stats[i])*6:.6f}us)')
 
-                for i in data['mark_calculator'].track:
-                    stats = data['mark_calculator'].stats
-                    print(f'marktime {i}: {np.mean(stats[i])*6:.6f}us (sum {np.sum(stats[i])*6:.6f}us)')
+                if data['query_cache'] is not None:
+                    reporter.send(data['query_cache'].stats())
+
 
 
+        def cleanup(connection, data):
+            if snapshot is not None and 'mark_encoder' in data:
+                data['mark_encoder'].save_snapshot(snapshot)
 
-        return fsgui.process.build_process_object(setup, workload)
+        return fsgui.process.build_process_object(setup, workload, cleanup)
     
 class EncodedSpikeBuffer:
     def __init__(self):
@@ -283,74 +459,20 @@ class EncodedSpikeBuffer:
     def get_buffer(self, timestamp):
         pass
 
-class MarkCalculator:
-    def __init__(self):
-        self.t = {}
-        self.stats = {}
-        self.track = [1,2,3,4,5,6]
-        for i in self.track:
-            self.stats[i] = []
-    
-    def compute_mark(self, samples):
-        self.t[0] = time.time()
-        datapoint = np.array(samples)
-        self.t[1] = time.time()
-        spike_data = np.atleast_2d(datapoint.data)
-        self.t[2] = time.time()
-        channel_peaks = np.max(spike_data, axis=1)
-        self.t[3] = time.time()
-        peak_channel_ind = np.argmax(channel_peaks)
-        self.t[4] = time.time()
-        t_ind = np.argmax(spike_data[peak_channel_ind])
-        self.t[5] = time.time()
-        amp_mark = spike_data[:, t_ind]
-        self.t[6] = time.time()
-
-        for i in self.track:
-            self.stats[i].append(self.t[i] - self.t[i-1])
-
-
-        return amp_mark
-
-class MarkCalculatorNative:
-    def __init__(self, mark_ndims, waveform_length):
-        self.mark_ndims = mark_ndims
-        self.waveform_length = waveform_length
-
-        self.t = {}
-        self.stats = {}
-        self.track = [1,2,3,4]
-        for i in self.track:
-            self.stats[i] = []
-    
-    
-    def compute_mark(self, samples):
-        self.t[0] = time.time()
-        highest_index = 0
-        highest_value = -1
-
-        self.t[1] = time.time()
-        for channel in range(self.mark_ndims):
-            value = max(samples[channel])
-            if value > highest_value:
-                highest_index = samples[channel].index(value)
-                highest_value = value
-        self.t[2] = time.time()
-        mark = [samples[ch][highest_index] for ch in range(self.mark_ndims)]
-        self.t[3] = time.time()
-        mark = np.array(mark)
-        self.t[4] = time.time()
-
-        for i in self.track:
-            self.stats[i].append(self.t[i] - self.t[i-1])
-
-        return mark
-
 class MarkSpaceEncoderSynchronous:
-    def __init__(self, bin_count, mark_ndims, kernel_sigma, n_minimum_in_region, region_zscore):
+    def __init__(self, bin_count, mark_ndims, kernel_sigma, n_minimum_in_region, region_zscore,
+            retention='all', retention_capacity=100000, retention_window=None, occupancy=None, query_cache=None,
+            kernel_tolerance=1e-20, kernel_lookup_size=None):
         self.bin_count = bin_count
         self.mark_ndims = mark_ndims
 
+        # optional fsgui.filter.spikes.querycache.QueryCache
+        self.query_cache = query_cache
+
+        # see fsgui.filter.spikes.markindex.GaussianKernel
+        self.kernel_tolerance = kernel_tolerance
+        self.kernel_lookup_size = kernel_lookup_size
+
         self.update_config(
             kernel_sigma=kernel_sigma,
             n_minimum_in_region=n_minimum_in_region,
@@ -361,18 +483,59 @@ class MarkSpaceEncoderSynchronous:
         self.n_minimum_in_region = n_minimum_in_region
         self.region_zscore = region_zscore
 
+        self.retention = retention
+        self.retention_capacity = retention_capacity
+        self.retention_window = retention_window
+
+        # a shared OccupancyCounter, otherwise each tetrode counts the covariates of its own marks
+        self.occupancy = occupancy
+
         self.observations_per_tetrode = {}
 
-    def add_mark(self, tetrode_id, mark, covariate):
+    def __history(self, tetrode_id):
         if tetrode_id not in self.observations_per_tetrode:
-            self.observations_per_tetrode[tetrode_id] = (
-                fsgui.nparray.ArrayList(width=self.mark_ndims, dtype='float'),
-                fsgui.nparray.ArrayListSingleWidth(dtype='int16'),
+            self.observations_per_tetrode[tetrode_id] = fsgui.filter.spikes.markhistory.MarkHistory(
+                self.mark_ndims,
+                self.bin_count,
+                retention=self.retention,
+                capacity=self.retention_capacity,
+                window=self.retention_window,
+                mark_dtype='float',
+                covariate_dtype='uint16',
             )
+        return self.observations_per_tetrode[tetrode_id]
 
-        mark_history, covariate_history = self.observations_per_tetrode[tetrode_id]
-        mark_history.place(mark)
-        covariate_history.place(covariate)
+    def add_mark(self, tetrode_id, mark, covariate, timestamp=None):
+        self.__history(tetrode_id).add(mark, covariate, timestamp)
+
+    def save_snapshot(self, snapshot):
+        kernel_params = {
+            'sigma': self.kernel_sigma,
+            'n_minimum_in_region': self.n_minimum_in_region,
+            'region_zscore': self.region_zscore,
+        }
+        for tetrode_id, history in self.observations_per_tetrode.items():
+            snapshot.save_tetrode(tetrode_id, history, kernel_params)
+        if self.occupancy is not None:
+            snapshot.save_occupancy(self.occupancy)
+
+    def load_snapshot(self, snapshot):
+        """
+        Restores every compatible tetrode in an EncoderSnapshot. The kernel
+        parameters stay as configured. Returns the number of tetrodes restored.
+        """
+        n_restored = 0
+        for tetrode_id in snapshot.tetrode_ids():
+            history = self.__history(tetrode_id)
+            if snapshot.load_tetrode(tetrode_id, history):
+                n_restored += 1
+            elif history.n_added == 0:
+                del self.observations_per_tetrode[tetrode_id]
+        if self.occupancy is not None:
+            snapshot.load_occupancy(self.occupancy)
+        if self.query_cache is not None:
+            self.query_cache.clear()
+        return n_restored
     
     def query_mark(self, tetrode_id, mark):
         # make sure to pass in marks that are:
@@ -382,70 +545,123 @@ class MarkSpaceEncoderSynchronous:
         if tetrode_id not in self.observations_per_tetrode:
             return None
 
-        if self.__calculate_filter(tetrode_id, mark):
-            return self.__calculate_histogram(tetrode_id, mark)
+        if self.query_cache is not None:
+            key = self.query_cache.key(tetrode_id, mark)
+            version = self.__model_version(tetrode_id)
+            found, query_histogram = self.query_cache.get(key, version)
+            if not found:
+                query_histogram = self.__query_mark(tetrode_id, mark)
+                self.query_cache.put(key, version, query_histogram)
+            return query_histogram
+
+        return self.__query_mark(tetrode_id, mark)
+
+    def __query_mark(self, tetrode_id, mark):
+        # the hypercube count and the kernel candidates come from one neighbourhood query
+        n_in_region, candidates, squared_distances = self.observations_per_tetrode[tetrode_id].query_neighbourhood(
+            mark, self._region_half_box_width, self._kernel_radius)
+
+        if n_in_region >= self.n_minimum_in_region:
+            return self.__calculate_histogram(tetrode_id, candidates, squared_distances)
         else:
             return None
+
+    def __model_version(self, tetrode_id):
+        return (
+            self.observations_per_tetrode[tetrode_id].n_added,
+            self.occupancy.version if self.occupancy is not None else 0,
+        )
         
-    def __calculate_normalized_occupancy(self, tetrode_id):
-        _, covariate_history = self.observations_per_tetrode[tetrode_id]
-        covariate_history = covariate_history.get_slice()
+    def query_batch(self, tetrode_id, marks):
+        """
+        `query_mark` for k marks (k, mark_ndims) of one tetrode at once, with
+        one neighbourhood query and one weighted scatter-add for all of them.
+        Returns a list of k histograms, None where the region held too few marks.
+        """
+        marks = np.atleast_2d(np.asarray(marks, dtype='float'))
+        if tetrode_id not in self.observations_per_tetrode:
+            return [None] * len(marks)
+
+        if self.query_cache is not None:
+            version = self.__model_version(tetrode_id)
+            keys = [self.query_cache.key(tetrode_id, mark) for mark in marks]
+            cached = [self.query_cache.get(key, version) for key in keys]
+
+            misses = [i for i, (found, _) in enumerate(cached) if not found]
+            results = [query_histogram for _, query_histogram in cached]
+            if misses:
+                for i, query_histogram in zip(misses, self.__query_batch(tetrode_id, marks[misses])):
+                    self.query_cache.put(keys[i], version, query_histogram)
+                    results[i] = query_histogram
+            return results
+
+        return self.__query_batch(tetrode_id, marks)
+
+    def __query_batch(self, tetrode_id, marks):
+        history = self.observations_per_tetrode[tetrode_id]
+        n_in_region, owners, candidates, squared_distances = history.query_neighbourhood_batch(
+            marks, self._region_half_box_width, self._kernel_radius)
+
+        # the candidates also cover the region box, only those inside the kernel's radius get a weight
+        within = self._kernel.within(squared_distances)
+        history_weights = self._kernel.weights(squared_distances[within])
+
+        # each mark gets its own run of bins
+        query_histograms = np.bincount(
+            owners[within] * self.bin_count + history.covariates.get_slice()[candidates[within]],
+            weights=history_weights,
+            minlength=len(marks) * self.bin_count).reshape(len(marks), self.bin_count)
 
-        occupancy_histogram = np.bincount(
-            covariate_history,
-            minlength=self.bin_count)
-        occupancy_histogram[occupancy_histogram == 0] = np.mean(occupancy_histogram)
-        return occupancy_histogram / np.sum(occupancy_histogram)
+        if history.weight != 1.0:
+            query_histograms *= history.weight
 
-    def __calculate_histogram(self, tetrode_id, mark):
-        mark_history, covariate_history = self.observations_per_tetrode[tetrode_id]
-        mark_history = mark_history.get_slice()
-        covariate_history = covariate_history.get_slice()
+        query_histograms /= self.__calculate_normalized_occupancy(tetrode_id)
 
-        history_squared_distances = np.sum(
-            np.square(mark_history - mark),
-            axis=1
-        )
+        return [
+            query_histogram if n >= self.n_minimum_in_region else None
+            for query_histogram, n in zip(query_histograms, n_in_region)
+        ]
+
+    def __calculate_normalized_occupancy(self, tetrode_id):
+        if self.occupancy is not None:
+            return self.occupancy.normalized()
+        return self.observations_per_tetrode[tetrode_id].occupancy.normalized()
 
-        # larger k2 is narrower kernel, smaller k2 is wider kernel
-        history_weights = self._k1 * np.exp(self._k2 * history_squared_distances)
-        # necessary to remove super tiny weights because bug in numpy histograms
-        history_weights[history_weights < 1e-20] = 0
+    def __calculate_histogram(self, tetrode_id, candidates, history_squared_distances):
+        history = self.observations_per_tetrode[tetrode_id]
+        covariate_history = history.covariates.get_slice()
+
+        # the candidates also cover the region box, only those inside the kernel's radius get a weight
+        within = self._kernel.within(history_squared_distances)
+        history_weights = self._kernel.weights(history_squared_distances[within])
 
         query_histogram = np.bincount(
-            covariate_history,
+            covariate_history[candidates[within]],
             weights=history_weights,
             minlength=self.bin_count)
 
-        return query_histogram / self.__calculate_normalized_occupancy(tetrode_id)
+        # a sampled history stands for more marks than it holds
+        if history.weight != 1.0:
+            query_histogram *= history.weight
 
-    def __calculate_filter(self, tetrode_id, mark):
-        mark_history, _ = self.observations_per_tetrode[tetrode_id]
-        mark_history = mark_history.get_slice()
-
-        # this is counting spikes within a hypercube around the mark
-        return np.sum(
-            functools.reduce(
-                np.logical_and,
-                itertools.chain.from_iterable([
-                    [
-                        mark_history[:,dim] > mark[dim] - self._region_half_box_width,
-                        mark_history[:,dim] < mark[dim] + self._region_half_box_width,
-                    ]
-                    for dim in range(self.mark_ndims)
-                ]
-        ))) >= self.n_minimum_in_region
+        return query_histogram / self.__calculate_normalized_occupancy(tetrode_id)
 
     def update_config(self, *, kernel_sigma, n_minimum_in_region, region_zscore):
         self.kernel_sigma = kernel_sigma
         self.n_minimum_in_region = n_minimum_in_region
         self.region_zscore = region_zscore
 
-        self._k1 = 1 / (np.sqrt(2*np.pi) * self.kernel_sigma)
-        self._k2 = -0.5 / (self.kernel_sigma**2)
+        self._kernel = fsgui.filter.spikes.markindex.GaussianKernel(
+            self.kernel_sigma, tolerance=self.kernel_tolerance, lookup_size=self.kernel_lookup_size)
 
         self._region_half_box_width = self.region_zscore * self.kernel_sigma
 
+        # marks further than this get no weight
+        self._kernel_radius = self._kernel.radius
+
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
 class OccupancyHistory:
     def __init__(self, bin_count):
         self.bin_count = bin_count
@@ -0,0 +1,378 @@
+import numpy as np
+import fsgui.process
+import fsgui.node
+import fsgui.events
+import fsgui.filter.lfp.ripple_new
+
+
+class BandFilterType(fsgui.node.NodeTypeObject):
+    """
+    Bandpasses and envelopes a channel set once and publishes the result, so any
+    number of threshold detectors can share the same IIR/FIR pass.
+    """
+    def __init__(self, type_id):
+        super().__init__(
+            type_id=type_id,
+            node_class='filter',
+            name='Band filter (shared)',
+            datatype='band_envelope',
+        )
+
+    def write_template(self, config = None):
+        config = config if config is not None else {
+            'type_id': self.type_id(),
+            'instance_id': '',
+            'nickname': self.name(),
+            'source_id': None,
+            'num_signals': 32,
+            'bp_order': 2,
+            'bp_crit_freqs_low': 150,
+            'bp_crit_freqs_high': 250,
+            'lfp_sample_rate': 1500,
+            'env_num_taps': 15,
+            'env_band_edges_low': 50,
+            'env_band_edges_high': 55,
+            'tetrode_selection': None,
+        }
+
+        return [
+            {
+                'name': 'type_id',
+                'type': 'hidden',
+                'default': config['type_id'],
+            },
+            {
+                'name': 'instance_id',
+                'type': 'hidden',
+                'default': config['instance_id'],
+            },
+            {
+                'label': 'Nickname',
+                'name': 'nickname',
+                'type': 'string',
+                'default': config['nickname'],
+                'tooltip': 'This is the name the source is displayed as in menus.',
+            },
+            {
+                'label': 'Source',
+                'name': 'source_id',
+                'type': 'node:float',
+                'default': config['source_id'],
+                'tooltip': 'Source to receive LFP data',
+            },
+            {
+                'label': 'Number of signals (e.g. 32 vs 64 tetrodes)',
+                'name': 'num_signals',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'default': config['num_signals'],
+            },
+            {
+                'label': 'Bandpass filter: order',
+                'name': 'bp_order',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 100,
+                'default': config['bp_order'],
+                'tooltip': 'The order of the IIR filter used to bandpass the LFP data.',
+            },
+            {
+                'label': 'Bandpass filter: low cut',
+                'name': 'bp_crit_freqs_low',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'units': 'Hz',
+                'default': config['bp_crit_freqs_low'],
+                'tooltip': 'The low cut frequency of the IIR bandpass filter.',
+            },
+            {
+                'label': 'Bandpass filter: high cut',
+                'name': 'bp_crit_freqs_high',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'units': 'Hz',
+                'default': config['bp_crit_freqs_high'],
+                'tooltip': 'The high cut frequency of the IIR bandpass filter.',
+            },
+            {
+                'label': 'LFP Sample rate (Hz)',
+                'name': 'lfp_sample_rate',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'default': config['lfp_sample_rate'],
+                'units': 'Hz',
+                'tooltip': 'The sample rate of the LFP data.'
+            },
+            {
+                'label': 'Envelope filter: number of taps',
+                'name': 'env_num_taps',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 100,
+                'units': 'taps',
+                'default': config['env_num_taps'],
+                'tooltip': 'The number of taps or weights in the FIR filter used to envelope the band signal.',
+            },
+            {
+                'label': 'Envelope filter: low cut',
+                'name': 'env_band_edges_low',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'units': 'Hz',
+                'default': config['env_band_edges_low'],
+                'tooltip': 'The low cut frequency of the FIR filter used to envelope the band signal.',
+            },
+            {
+                'label': 'Envelope filter: high cut',
+                'name': 'env_band_edges_high',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'units': 'Hz',
+                'default': config['env_band_edges_high'],
+                'tooltip': 'The high cut frequency of the FIR filter used to envelope the band signal.',
+            },
+            {
+                'label': 'Tetrode selection',
+                'name': 'tetrode_selection',
+                'type': 'tetrode_selection',
+                'default': config['tetrode_selection'],
+            },
+        ]
+
+    def build(self, config, pipe_map):
+        source_pipe = pipe_map[config['source_id']]
+
+        tetrode_ids = fsgui.filter.lfp.ripple_new.select_tetrode_ids(config['tetrode_selection'], config['num_signals'])
+
+        band_filter = fsgui.filter.lfp.ripple_new.EnvelopeEstimator(
+            num_signals=len(tetrode_ids),
+            bp_order=config['bp_order'],
+            bp_crit_freqs=[config['bp_crit_freqs_low'], config['bp_crit_freqs_high']],
+            lfp_sampling_rate=config['lfp_sample_rate'],
+            env_num_taps=config['env_num_taps'],
+            env_band_edges=[config['env_band_edges_low'], config['env_band_edges_high']],
+            env_desired=[1,0],
+        )
+
+        # upper bound on the number of queued LFP samples filtered together
+        max_block_size = 64
+
+        def setup(logging, data):
+            data['filter_model'] = band_filter
+
+        def workload(connection, publisher, reporter, data):
+            if source_pipe.poll(timeout=1):
+                # drain whatever has queued up so it can be filtered as one block
+                items = [source_pipe.recv()]
+                while len(items) < max_block_size and source_pipe.poll(timeout=0):
+                    items.append(source_pipe.recv())
+
+                lfps = np.array([item['lfpData'] for item in items])[:, tetrode_ids]
+                band_block, envelope_block = data['filter_model'].add_new_block(lfps)
+
+                # one message per block, so the channel set is not repeated for every sample
+                publisher.send({
+                    'localTimestamp': [item.get('localTimestamp') for item in items],
+                    'systemTimestamp': [item.get('systemTimestamp') for item in items],
+                    'channel_ids': tetrode_ids,
+                    'band': band_block,
+                    'envelope': envelope_block,
+                })
+
+                reporter.send({
+                    'band_block_size': len(items),
+                })
+
+        return fsgui.process.build_process_object(setup, workload)
+
+class BandThresholdFilterType(fsgui.node.NodeTypeObject):
+    """
+    Ripple-style z-score detector on the envelopes published by a band filter node.
+    Only the thresholding runs here, so extra detector variants are cheap.
+    """
+    def __init__(self, type_id):
+        super().__init__(
+            type_id=type_id,
+            node_class='filter',
+            name='Band envelope threshold filter',
+            datatype='bool',
+        )
+
+    def write_template(self, config = None):
+        config = config if config is not None else {
+            'type_id': self.type_id(),
+            'instance_id': '',
+            'nickname': self.name(),
+            'source_id': None,
+            'sd_threshold': 3.5,
+            'n_above_threshold': 1,
+            'display_channel': 1,
+            'publish_mode': 'samples',
+            'means_magic_input': 50,
+            'sigmas_magic_input': 25,
+        }
+
+        return [
+            {
+                'name': 'type_id',
+                'type': 'hidden',
+                'default': config['type_id'],
+            },
+            {
+                'name': 'instance_id',
+                'type': 'hidden',
+                'default': config['instance_id'],
+            },
+            {
+                'label': 'Nickname',
+                'name': 'nickname',
+                'type': 'string',
+                'default': config['nickname'],
+                'tooltip': 'This is the name the source is displayed as in menus.',
+            },
+            {
+                'label': 'Source',
+                'name': 'source_id',
+                'type': 'node:band_envelope',
+                'default': config['source_id'],
+                'tooltip': 'Band filter node to receive envelopes from',
+            },
+            {
+                'label': 'Mean',
+                'name': 'means_magic_input',
+                'type': 'double',
+                'lower': 0,
+                'upper': 200,
+                'units': 'power',
+                'decimals': 2,
+                'default': config['means_magic_input'],
+                'tooltip': 'Hard coded envelope mean, used for mean + threshold * sd',
+                'live_editable': True,
+            },
+            {
+                'label': 'SD',
+                'name': 'sigmas_magic_input',
+                'type': 'double',
+                'lower': 0,
+                'upper': 200,
+                'units': 'power',
+                'decimals': 2,
+                'default': config['sigmas_magic_input'],
+                'tooltip': 'Hard coded envelope sd, used for mean + threshold * sd',
+                'live_editable': True,
+            },
+            {
+                'label': 'Threshold',
+                'name': 'sd_threshold',
+                'type': 'double',
+                'lower': 0,
+                'upper': 100,
+                'units': 'std',
+                'decimals': 2,
+                'default': config['sd_threshold'],
+                'tooltip': 'The threshold in standard deviations that a channel has to reach in order to count as detected on the channel.',
+                'live_editable': True,
+            },
+            {
+                'label': 'Number of channels above threshold to trigger filter',
+                'name': 'n_above_threshold',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 10000,
+                'units': 'channels',
+                'default': config['n_above_threshold'],
+                'tooltip': 'The number of channels that need to be above threshold to trigger the filter.',
+                'live_editable': True,
+            },
+            {
+                'label': 'Publish',
+                'name': 'publish_mode',
+                'type': 'select',
+                'options': fsgui.filter.lfp.ripple_new.PUBLISH_MODE_OPTIONS,
+                'default': config.get('publish_mode', 'samples'),
+                'tooltip': 'Publish a bool for every LFP sample, or only onset/offset event records (timestamp, peak z-score, channel count, duration).',
+            },
+            {
+                'label': 'Tick: use sampled mean/sd; Untick: use input',
+                'name': 'auto_flag',
+                'type': 'boolean',
+                'default': True,
+                'live_editable': True,
+            },
+            {
+                'label': 'Sample mean/sd now',
+                'name': 'sample_mean_sd',
+                'type': 'boolean',
+                'default': True,
+                'live_editable': True,
+            },
+            {
+                'label': 'Display channel (reporting graphics)',
+                'name': 'display_channel',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 10000,
+                'default': config['display_channel'],
+                'tooltip': 'The channel to display in the reporting graphics view. Ignore if not using graphics.',
+                'live_editable': True,
+            },
+        ]
+
+    def build(self, config, pipe_map):
+        source_pipe = pipe_map[config['source_id']]
+
+        # publish onset/offset records instead of a bool for every sample
+        publish_events = config.get('publish_mode', 'samples') == 'events'
+
+        def find_display_index(channel_ids):
+            return np.where(channel_ids == config['display_channel'] - 1)[0][0]
+
+        def setup(logging, data):
+            # the channel set is only known once the band filter publishes
+            data['detector'] = None
+            data['display_index'] = None
+            data['segmenter'] = fsgui.events.EventSegmenter()
+
+        def workload(connection, publisher, reporter, data):
+            if connection.pipe_poll(timeout = 0):
+                msg_tag, msg_data = connection.pipe_recv()
+                if msg_tag == 'update':
+                    msg_varname, msg_value = msg_data
+                    config[msg_varname] = msg_value
+
+                    if msg_varname in ['means_magic_input', 'sigmas_magic_input'] and data['detector'] is not None:
+                        data['detector'].set_manual(config['means_magic_input'], config['sigmas_magic_input'])
+
+                    if msg_varname == 'display_channel':
+                        data['display_index'] = None
+
+            if source_pipe.poll(timeout=1):
+                item = source_pipe.recv()
+
+                if data['detector'] is None:
+                    data['detector'] = fsgui.filter.lfp.ripple_new.EnvelopeThresholdDetector(
+                        num_signals=len(item['channel_ids']),
+                        means_manual=config['means_magic_input'],
+                        sigmas_manual=config['sigmas_magic_input'],
+                    )
+                if data['display_index'] is None:
+                    data['display_index'] = find_display_index(item['channel_ids'])
+
+                # the band filter publishes a block of samples per message
+                for local_timestamp, system_timestamp, envelope in zip(item['localTimestamp'], item['systemTimestamp'], item['envelope']):
+                    triggered, n_detected, peak_zscore = data['detector'].process_envelope(envelope, config)
+                    if publish_events:
+                        event = data['segmenter'].step(triggered, local_timestamp, peak_zscore, n_detected)
+                        if event is not None:
+                            publisher.send(event)
+                    else:
+                        publisher.send(triggered)
+                    reporter.send(data['detector'].report(system_timestamp, triggered, envelope, config, data['display_index']))
+
+        return fsgui.process.build_process_object(setup, workload)
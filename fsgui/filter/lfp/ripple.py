@@ -2,6 +2,8 @@ import multiprocessing as mp
 import numpy as np
 import fsgui.process
 import fsgui.node
+import fsgui.events
+import fsgui.filter.lfp.ripple_new
 import json
 import shapely
 import time
@@ -28,6 +30,7 @@ class RippleFilterType(fsgui.node.NodeTypeObject):
                 'lockoutTime': 7500,
                 'detectNoRipples': False,
                 'detectNoRipplesTime': 60000,
+                'publish_mode': 'samples',
             }
         )
 
@@ -124,51 +127,71 @@ class RippleFilterType(fsgui.node.NodeTypeObject):
                 'upper': 300000,
                 'default': config['detectNoRipplesTime']
             },
+            {
+                'label': 'Publish',
+                'name': 'publish_mode',
+                'type': 'select',
+                'options': fsgui.filter.lfp.ripple_new.PUBLISH_MODE_OPTIONS,
+                'default': config.get('publish_mode', 'samples'),
+                'tooltip': 'Publish a bool for every LFP sample, or only onset/offset event records (timestamp, peak z-score, channel count, duration).',
+            },
         ]
     
-    def build(self, config, addr_map):
-        pub_address = addr_map[config['source_id']]
+    def build(self, config, pipe_map):
+        source_pipe = pipe_map[config['source_id']]
         
-        rip_filter = RippleFilter(
-            num_tetrodes=16,
-            coefficients=RippleFilterCoefficients19(),
-            params = RippleFilterParams(
-                ripCoeff1=config['ripCoeff1'],
-                ripCoeff2=config['ripCoeff2'],
-                ripple_threshold=config['ripThresh'],
-                sampDivisor=config['sampleDivisor'],
-                n_above_thresh=config['nAboveThresh'],
-                lockoutTime=config['lockoutTime'],
-                detectNoRippleTime=config['detectNoRipplesTime'],
-                dioGatePort=None,
-                detectNoRipples=config['detectNoRipples'],
-                dioGate=None,
-                enabled=None,
-                useCustomBaseline=None,
-                updateCustomBaseline=None
-            ),
-            num_last_values=20
+        params = RippleFilterParams(
+            ripCoeff1=config['ripCoeff1'],
+            ripCoeff2=config['ripCoeff2'],
+            ripple_threshold=config['ripThresh'],
+            sampDivisor=config['sampleDivisor'],
+            n_above_thresh=config['nAboveThresh'],
+            lockoutTime=config['lockoutTime'],
+            detectNoRippleTime=config['detectNoRipplesTime'],
+            dioGatePort=None,
+            detectNoRipples=config['detectNoRipples'],
+            dioGate=None,
+            enabled=None,
+            useCustomBaseline=None,
+            updateCustomBaseline=None
         )
 
+        # publish onset/offset records instead of a bool for every sample
+        publish_events = config.get('publish_mode', 'samples') == 'events'
+
         def setup(logging, data):
-            data['sub'] = fsgui.network.UnidirectionalChannelReceiver(pub_address)
-            data['filter_model'] = rip_filter
+            # sized from the first LFP packet so every tetrode is covered
+            data['filter_model'] = None
+            data['segmenter'] = fsgui.events.EventSegmenter()
 
         def workload(connection, publisher, reporter, data):
-            t0 = time.time()
+            if source_pipe.poll(timeout=1):
+                item = source_pipe.recv()
+                lfps = np.asarray(item['lfpData'], dtype='double')
 
-            item = data['sub'].recv(timeout=500)
-            if item is not None:
-                lfps=item['lfpData']
+                if data['filter_model'] is None:
+                    data['filter_model'] = RippleFilter(
+                        num_tetrodes=len(lfps),
+                        coefficients=RippleFilterCoefficients19(),
+                        params=params,
+                        num_last_values=20
+                    )
 
                 t1 = time.time()
                 triggered = data['filter_model'].process_ripple_data(lfps)
                 t2 = time.time() - t1
 
-                if triggered:
-                    logging.info(f'ripple: {triggered}')
-
-                publisher.send(bool(triggered))
+                if publish_events:
+                    event = data['segmenter'].step(
+                        triggered,
+                        item['localTimestamp'],
+                        data['filter_model'].peak_zscore(),
+                        data['filter_model'].count_above_threshold(),
+                    )
+                    if event is not None:
+                        publisher.send(event)
+                else:
+                    publisher.send(bool(triggered))
                 reporter.send({'sum': t2})
 
         return fsgui.process.build_process_object(setup, workload)
@@ -236,7 +259,12 @@ class RippleFilterParams:
         self.updateCustomBaseline = updateCustomBaseline
 
 class RippleFilter:
-    def __init__(self, num_tetrodes, coefficients, params, num_last_values=20):
+    """
+    FSGui-compatible ripple detector with all tetrodes held in 2D state arrays,
+    so each sample is a handful of vectorized operations regardless of the
+    number of tetrodes.
+    """
+    def __init__(self, num_tetrodes, coefficients, params, num_last_values=20, enabled=None):
         self.num_tetrodes = num_tetrodes
         self.coefficients = coefficients
         self.params = params
@@ -246,43 +274,62 @@ class RippleFilter:
         self.rippleMean = np.zeros(shape=(num_tetrodes,), dtype='double')
         self.rippleSd = np.zeros(shape=(num_tetrodes,), dtype='double')
 
-        self.f_x = fsgui.nparray.MultiCircularArray(shape=(num_tetrodes, self.coefficients.length), dtype='double')
-        self.f_y = fsgui.nparray.MultiCircularArray(shape=(num_tetrodes, self.coefficients.length), dtype='double')
+        # (tetrodes x history), stored twice over so the newest-first window of
+        # the circular history is always the contiguous slice [index, index+length)
+        self.f_x = np.zeros(shape=(num_tetrodes, 2 * self.coefficients.length), dtype='double')
+        self.f_y = np.zeros(shape=(num_tetrodes, 2 * self.coefficients.length), dtype='double')
+        self.f_index = 0
 
-        self.last_vals = {i: fsgui.nparray.CircularArray(self.num_last_values) for i in range(num_tetrodes)}
+        # (tetrodes x last values) of the gains used by calculate_v
+        self.last_vals = np.zeros(shape=(num_tetrodes, self.num_last_values), dtype='double')
+        self.last_vals_index = 0
         self.current_val = np.zeros(shape=(num_tetrodes,), dtype='double')
 
-        self.n_trode_id = np.zeros(shape=(num_tetrodes,), dtype='int')
-        self.enabled = np.zeros(shape=(num_tetrodes,), dtype='bool')
+        self.n_trode_id = np.arange(num_tetrodes)
+        self.enabled = np.ones(shape=(num_tetrodes,), dtype='bool') if enabled is None else np.array(enabled, dtype='bool')
 
     def reset_ripple_data(self):
         self.rippleMean[:] = 0
         self.rippleSd[:] = 0
-        self.f_x.array[:,:] = 0
-        self.f_y.array[:,:] = 0
-        self.last_vals.array[:,:] = 0
+        self.f_x[:,:] = 0
+        self.f_y[:,:] = 0
+        self.f_index = 0
+        self.last_vals[:,:] = 0
+        self.last_vals_index = 0
         self.current_val[:] = 0
     
     def reset_counter(self):
         self.counter = 0
 
-    def update_last_val(self, ntrodeid, value):
+    def update_last_val(self, values):
         """
-        updates last_val and advances last_val index
+        updates last_val for every tetrode and advances last_val index
+
+        returns the mean of the last values from before the update
         """
-        mean = np.mean(self.last_vals[ntrodeid].array)
-        self.last_vals[ntrodeid].place(value)
+        mean = np.mean(self.last_vals, axis=1)
+        self.last_vals[:, self.last_vals_index] = values
+        self.last_vals_index = (self.last_vals_index + 1) % self.num_last_values
         return mean
 
     def filter_channel(self, lfps):
         """
         updates f_x, f_y and advances filter index
         """
-        self.f_x.place(lfps)
-        self.f_y.set(0)
+        length = self.coefficients.length
+        self.f_index = (self.f_index - 1) % length
+        i = self.f_index
+
+        self.f_x[:, i] = lfps
+        self.f_x[:, i + length] = lfps
+        # the current output does not contribute to itself
+        self.f_y[:, i] = 0
+        self.f_y[:, i + length] = 0
 
-        vals = np.dot(self.f_x.get_slice, self.coefficients.numerator) - np.dot(self.f_y.get_slice, self.coefficients.denominator)
-        self.f_y.place(vals)
+        vals = np.dot(self.f_x[:, i:i+length], self.coefficients.numerator) - np.dot(self.f_y[:, i:i+length], self.coefficients.denominator)
+
+        self.f_y[:, i] = vals
+        self.f_y[:, i + length] = vals
 
         return vals
 
@@ -302,13 +349,10 @@ class RippleFilter:
         if run_update_mean_sd:
             self.update_mean_sd(magnitude_rds)
 
-        for ntrodeid, d in enumerate(lfps):
-            magnitude_rd = magnitude_rds[ntrodeid]
-
-            if run_calculate_v:
-                self.current_val[ntrodeid] = self.calculate_v(ntrodeid, magnitude_rd)
-            else:
-                self.current_val[ntrodeid] = self.rippleMean[ntrodeid]
+        if run_calculate_v:
+            self.current_val[:] = self.calculate_v(magnitude_rds)
+        else:
+            self.current_val[:] = self.rippleMean
 
         return self.count_above_threshold() >= self.params.n_above_thresh
 
@@ -320,15 +364,15 @@ class RippleFilter:
         self.rippleMean[:] += diff / self.params.sampDivisor
         self.rippleSd[:] += (np.abs(diff) - self.rippleSd[:]) / self.params.sampDivisor
 
-    def calculate_v(self, ntrodeid, ripple_signal):
-        df = ripple_signal - self.current_val[ntrodeid]
-        if df > 0:
-            gain = self.update_last_val(ntrodeid, self.params.ripCoeff1)
-        else:
-            gain = self.params.ripCoeff2
-            self.update_last_val(ntrodeid, gain)
-        
-        return self.current_val[ntrodeid] + df * gain
+    def calculate_v(self, ripple_signal):
+        df = ripple_signal - self.current_val
+        rising = df > 0
+
+        # rising edges follow the average of recent gains, falling edges decay with ripCoeff2
+        mean_last_val = self.update_last_val(np.where(rising, self.params.ripCoeff1, self.params.ripCoeff2))
+        gain = np.where(rising, mean_last_val, self.params.ripCoeff2)
+
+        return self.current_val + df * gain
         
     def count_above_threshold(self):
         if self.params.useCustomBaseline:
@@ -342,4 +386,12 @@ class RippleFilter:
         threshold = mean + self.params.ripple_threshold * sd
 
         return np.sum((self.current_val > threshold)*self.enabled)
-        
\ No newline at end of file
+
+    def peak_zscore(self):
+        """
+        Largest (current_val - mean) / sd over the enabled tetrodes with a nonzero sd.
+        """
+        valid = self.enabled & (self.rippleSd > 0)
+        if not np.any(valid):
+            return 0.0
+        return float(np.max((self.current_val[valid] - self.rippleMean[valid]) / self.rippleSd[valid]))
@@ -2,14 +2,34 @@ import ghostipy as gsp
 import scipy.signal
 
 import multiprocessing as mp
+import multiprocessing.shared_memory
 import numpy as np
 import fsgui.process
 import fsgui.node
+import fsgui.events
+import glob
 import json
+import os
 import time
 import fsgui.nparray
+import fsgui.streamfilter
 
 
+PUBLISH_MODE_OPTIONS = [
+    {'name': 'samples', 'label': 'Every sample (bool)'},
+    {'name': 'events', 'label': 'Onset/offset events'},
+]
+
+def select_tetrode_ids(tetrode_selection, num_signals):
+    """
+    Converts a tetrode_selection form value (1-based tetrodes) into 0-based indices into lfpData.
+    """
+    tetrodes = tetrode_selection['tetrodes']
+    if tetrode_selection['is_include']:
+        return np.array(tetrodes) - 1
+    else:
+        return np.setdiff1d(np.arange(num_signals), np.array(tetrodes) - 1)
+
 class RippleFilterType(fsgui.node.NodeTypeObject):
     def __init__(self, type_id):
         super().__init__(
@@ -39,6 +59,12 @@ class RippleFilterType(fsgui.node.NodeTypeObject):
             'auto_config': True,
             'sample_mean_sd': False,
             'display_channel': 1,
+            'num_workers': 1,
+            'publish_mode': 'samples',
+            'baseline_directory': '',
+            'warm_start': False,
+            'baseline_prior_samples': 15000,
+            'checkpoint_interval': 60,
             'means_magic_input':50,
             'sigmas_magic_input':25,
         }
@@ -222,20 +248,66 @@ class RippleFilterType(fsgui.node.NodeTypeObject):
                 'tooltip': 'The channel to display in the reporting graphics view. Ignore if not using graphics.',
                 'live_editable': True,
             },
+            {
+                'label': 'Publish',
+                'name': 'publish_mode',
+                'type': 'select',
+                'options': PUBLISH_MODE_OPTIONS,
+                'default': config.get('publish_mode', 'samples'),
+                'tooltip': 'Publish a bool for every LFP sample, or only onset/offset event records (timestamp, peak z-score, channel count, duration).',
+            },
+            {
+                'label': 'Worker processes',
+                'name': 'num_workers',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 64,
+                'default': config.get('num_workers', 1),
+                'tooltip': 'Number of processes the channels are sharded across. Use more than one for high channel counts.',
+            },
+            {
+                'label': 'Baseline checkpoint directory',
+                'name': 'baseline_directory',
+                'type': 'string',
+                'default': config.get('baseline_directory', ''),
+                'tooltip': 'Directory the per-channel mean/sd baseline is checkpointed to. Leave empty to disable checkpoints.',
+            },
+            {
+                'label': 'Warm start from latest baseline checkpoint',
+                'name': 'warm_start',
+                'type': 'boolean',
+                'default': config.get('warm_start', False),
+                'tooltip': 'On build, load the most recent checkpoint with the same filter parameters.',
+            },
+            {
+                'label': 'Warm start weight',
+                'name': 'baseline_prior_samples',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 100000000,
+                'units': 'samples',
+                'default': config.get('baseline_prior_samples', 15000),
+                'tooltip': 'The loaded baseline counts as at most this many samples, so new data takes over after about as many samples.',
+            },
+            {
+                'label': 'Checkpoint interval',
+                'name': 'checkpoint_interval',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 100000,
+                'units': 's',
+                'default': config.get('checkpoint_interval', 60),
+                'tooltip': 'How often the baseline is checkpointed while running. It is also checkpointed at unbuild.',
+            },
         ]
     
     def build(self, config, pipe_map):
         source_pipe = pipe_map[config['source_id']]
 
-        tetrodes = config['tetrode_selection']['tetrodes']
-        if config['tetrode_selection']['is_include']:
-            tetrode_ids = np.array(tetrodes) - 1
-        else:
-            tetrode_ids = np.setdiff1d(np.arange(config['num_signals']), np.array(tetrodes) - 1)
+        tetrode_ids = select_tetrode_ids(config['tetrode_selection'], config['num_signals'])
         num_signals = len(tetrode_ids)
 
-        rip_filter = EnvelopeEstimator(
-            num_signals=num_signals,
+        estimator_kwargs = dict(
             bp_order=config['bp_order'],
             bp_crit_freqs=[config['bp_crit_freqs_low'], config['bp_crit_freqs_high']],
             lfp_sampling_rate=config['lfp_sample_rate'],
@@ -245,26 +317,66 @@ class RippleFilterType(fsgui.node.NodeTypeObject):
             env_desired=[1,0],
         )
 
-        def estimate_new_stats_welford(new_value, mean, M2, count):
-            count += 1
-            delta = (new_value - mean)
-            mean += delta / count
-            delta2 = (new_value - mean)
-            M2 += (delta*delta2)
-            return mean, M2, count
+        # more than one worker shards the channels across processes
+        num_workers = min(config.get('num_workers', 1), num_signals)
+
+        # upper bound on the number of queued LFP samples filtered together
+        max_block_size = 64
+
+        # publish onset/offset records instead of a bool for every sample
+        publish_events = config.get('publish_mode', 'samples') == 'events'
+
+        if config.get('baseline_directory'):
+            checkpoint = BaselineCheckpoint(
+                directory=config['baseline_directory'],
+                instance_id=config['instance_id'],
+                channel_ids=tetrode_ids,
+                filter_params=[
+                    config['bp_order'],
+                    config['bp_crit_freqs_low'],
+                    config['bp_crit_freqs_high'],
+                    config['lfp_sample_rate'],
+                    config['env_num_taps'],
+                    config['env_band_edges_low'],
+                    config['env_band_edges_high'],
+                ],
+            )
+        else:
+            checkpoint = None
 
         def setup(logging, data):
-            data['filter_model'] = rip_filter
-            data['means'] = np.zeros(num_signals)
-            data['M2'] = np.zeros(num_signals)
-            data['counts'] = np.zeros(num_signals) + 1 #add 1 to prevent zero
-            data['sigmas'] = np.zeros(num_signals) + 1 #previously: np.zeros(num_signals), prevent zero
-            data['means_manual'] = config['means_magic_input'] + np.zeros(num_signals)
-            data['sigmas_manual'] = config['sigmas_magic_input'] + np.zeros(num_signals)
+            if num_workers > 1:
+                data['filter_model'] = None
+                data['detector'] = ShardedEnvelopeDetector(
+                    num_signals=num_signals,
+                    num_workers=num_workers,
+                    max_block_size=max_block_size,
+                    estimator_kwargs=estimator_kwargs,
+                    means_manual=config['means_magic_input'],
+                    sigmas_manual=config['sigmas_magic_input'],
+                )
+            else:
+                data['filter_model'] = EnvelopeEstimator(num_signals=num_signals, **estimator_kwargs)
+                data['detector'] = EnvelopeThresholdDetector(
+                    num_signals=num_signals,
+                    means_manual=config['means_magic_input'],
+                    sigmas_manual=config['sigmas_magic_input'],
+                )
+
+            if checkpoint is not None and config.get('warm_start', False):
+                n_restored = checkpoint.load_into(data['detector'], prior_samples=config.get('baseline_prior_samples', 15000))
+                logging.info(f'Ripple baseline warm start restored {n_restored} of {num_signals} channels')
+            data['last_checkpoint_time'] = time.time()
+
+            data['segmenter'] = fsgui.events.EventSegmenter()
 
             data['display_index'] = np.where(tetrode_ids == config['display_channel'] - 1)[0][0]
 
         def workload(connection, publisher, reporter, data):
+            if checkpoint is not None and time.time() - data['last_checkpoint_time'] > config.get('checkpoint_interval', 60):
+                checkpoint.save(data['detector'])
+                data['last_checkpoint_time'] = time.time()
+
             if connection.pipe_poll(timeout = 0):
                 msg_tag, msg_data = connection.pipe_recv()
                 if msg_tag == 'update':
@@ -274,61 +386,223 @@ class RippleFilterType(fsgui.node.NodeTypeObject):
                     if msg_varname == 'auto_flag':
                         print('Changing between auto/input threshold now')
 
-                    if msg_varname == 'means_magic_input':
-                        print('updating magic input ripple mean to ',config['means_magic_input'])
-                        data['means_manual'] = config['means_magic_input'] + np.zeros(num_signals) #np.zeros(num_signals)
-
-                    if msg_varname == 'sigmas_magic_input':
-                        print('updating magic input ripple sigma to ',config['sigmas_magic_input'])
-                        data['sigmas_manual'] = config['sigmas_magic_input'] + np.zeros(num_signals) #np.zeros(num_signals)
-
+                    if msg_varname in ['means_magic_input', 'sigmas_magic_input']:
+                        print(f'updating magic input ripple mean/sigma to {config["means_magic_input"]}/{config["sigmas_magic_input"]}')
+                        data['detector'].set_manual(config['means_magic_input'], config['sigmas_magic_input'])
 
                     if msg_varname == 'display_channel':
                         data['display_index'] = np.where(tetrode_ids == config['display_channel'] - 1)[0][0]
 
             if source_pipe.poll(timeout=1):
-                item = source_pipe.recv()
-
-                lfps = np.array(item['lfpData'])[tetrode_ids]
-                ripple_data, envelope = data['filter_model'].add_new_data(lfps)
-
-                # sampling or not
-                if config['sample_mean_sd']:
-                    # updates stats
-                    data['means'], data['M2'], data['counts']= estimate_new_stats_welford(
-                        envelope, data['means'], data['M2'], data['counts']
-                    )
-                    data['sigmas'] = np.sqrt(data['M2'] / data['counts'])
-
-                # triggering
-                if config['auto_flag']:
-                    threshold_mean = data['means']
-                    threshold_sd = data['sigmas']
+                # drain whatever has queued up so it can be filtered as one block
+                items = [source_pipe.recv()]
+                while len(items) < max_block_size and source_pipe.poll(timeout=0):
+                    items.append(source_pipe.recv())
+
+                lfps = np.array([item['lfpData'] for item in items])[:, tetrode_ids]
+
+                if data['filter_model'] is None:
+                    n_detected_block, peak_zscore_block, envelope_block = data['detector'].process_block(lfps, config)
+                    triggered_block = (n_detected_block >= config['n_above_threshold']).tolist()
+                    n_detected_block = n_detected_block.tolist()
+                    peak_zscore_block = peak_zscore_block.tolist()
                 else:
-                    threshold_mean = data['means_manual']
-                    threshold_sd = data['sigmas_manual']
-                z_score_envelope = (envelope - threshold_mean) / threshold_sd
-                n_detected = np.sum(z_score_envelope > config['sd_threshold'])
-                triggered = n_detected >= config['n_above_threshold']
-
-
-                # convert from numpy type to Python type
-                triggered = bool(triggered)
-                publisher.send(triggered)
-
-                reporter.send({
-                    'rip_timestamp': item['systemTimestamp'],
-                    'rip_detected': triggered,
-                    'rip_mean_threshold': threshold_mean[data['display_index']].tolist(),
-                    'rip_sd_threshold': threshold_sd[data['display_index']].tolist(),
-                    'rip_envelope': envelope[data['display_index']].tolist(),
-                    'rip_mean': data['means'][data['display_index']].tolist(),
-                    'rip_sd': data['sigmas'][data['display_index']].tolist(),
-                })
-
-        return fsgui.process.build_process_object(setup, workload)
+                    ripple_block, envelope_block = data['filter_model'].add_new_block(lfps)
+                    triggered_block, n_detected_block, peak_zscore_block = zip(*[
+                        data['detector'].process_envelope(envelope, config) for envelope in envelope_block])
+
+                for item, envelope, triggered, n_detected, peak_zscore in zip(items, envelope_block, triggered_block, n_detected_block, peak_zscore_block):
+                    if publish_events:
+                        event = data['segmenter'].step(triggered, item['localTimestamp'], peak_zscore, n_detected)
+                        if event is not None:
+                            publisher.send(event)
+                    else:
+                        publisher.send(triggered)
+                    reporter.send(data['detector'].report(item['systemTimestamp'], triggered, envelope, config, data['display_index']))
+
+        def cleanup(connection, data):
+            if checkpoint is not None and 'detector' in data:
+                checkpoint.save(data['detector'])
+
+            if isinstance(data.get('detector'), ShardedEnvelopeDetector):
+                data['detector'].close()
+
+        return fsgui.process.build_process_object(setup, workload, cleanup)
     
 
+class EnvelopeThresholdDetector:
+    """
+    Keeps a running (Welford) mean and sd of each channel's envelope and counts
+    the channels whose z-scored envelope crosses the threshold.
+    """
+    def __init__(self, num_signals, means_manual=0, sigmas_manual=0, stats=None, reset_stats=True):
+        """
+        stats: optional (4, num_signals) array holding the means, M2, counts and
+            sigmas rows, e.g. a view into shared memory. The rows are updated in place.
+        reset_stats: start the stats from scratch. Workers attaching to stats that
+            the owner already set up (and may have restored) leave them as they are.
+        """
+        self.num_signals = num_signals
+
+        if stats is None:
+            stats = np.zeros((4, num_signals))
+        self.means, self.M2, self.counts, self.sigmas = stats
+        if reset_stats:
+            self.means[:] = 0
+            self.M2[:] = 0
+            self.counts[:] = 1 #add 1 to prevent zero
+            self.sigmas[:] = 1 #previously: np.zeros(num_signals), prevent zero
+
+        self.set_manual(means_manual, sigmas_manual)
+
+    def set_manual(self, means, sigmas):
+        self.means_manual = means + np.zeros(self.num_signals)
+        self.sigmas_manual = sigmas + np.zeros(self.num_signals)
+
+    def update_stats(self, envelope):
+        self.counts += 1
+        delta = (envelope - self.means)
+        self.means += delta / self.counts
+        delta2 = (envelope - self.means)
+        self.M2 += (delta*delta2)
+        self.sigmas[:] = np.sqrt(self.M2 / self.counts)
+
+    def thresholds(self, auto_flag):
+        if auto_flag:
+            return self.means, self.sigmas
+        else:
+            return self.means_manual, self.sigmas_manual
+
+    def score(self, envelope, sd_threshold, auto_flag):
+        """
+        Returns the number of channels above threshold and the largest z-score.
+        """
+        threshold_mean, threshold_sd = self.thresholds(auto_flag)
+        z_score_envelope = (envelope - threshold_mean) / threshold_sd
+        return int(np.sum(z_score_envelope > sd_threshold)), float(np.max(z_score_envelope))
+
+    def count_above_threshold(self, envelope, sd_threshold, auto_flag):
+        n_detected, _ = self.score(envelope, sd_threshold, auto_flag)
+        return n_detected
+
+    def process_envelope(self, envelope, config):
+        """
+        Runs one envelope sample through the stats and threshold using the
+        node's live config.
+
+        Returns whether the detector triggered, the number of channels above
+        threshold and the peak z-score.
+        """
+        # sampling or not
+        if config['sample_mean_sd']:
+            self.update_stats(envelope)
+
+        n_detected, peak_zscore = self.score(envelope, config['sd_threshold'], config['auto_flag'])
+
+        # convert from numpy type to Python type
+        return bool(n_detected >= config['n_above_threshold']), n_detected, peak_zscore
+
+    def report(self, timestamp, triggered, envelope, config, display_index):
+        threshold_mean, threshold_sd = self.thresholds(config['auto_flag'])
+        return {
+            'rip_timestamp': timestamp,
+            'rip_detected': triggered,
+            'rip_mean_threshold': threshold_mean[display_index].tolist(),
+            'rip_sd_threshold': threshold_sd[display_index].tolist(),
+            'rip_envelope': envelope[display_index].tolist(),
+            'rip_mean': self.means[display_index].tolist(),
+            'rip_sd': self.sigmas[display_index].tolist(),
+        }
+
+class BaselineCheckpoint:
+    """
+    Saves a detector's per-channel Welford stats to an .npz file and restores them
+    into a newly built detector, so the baseline does not have to converge again.
+    Each node overwrites its own file; any checkpoint in the directory with the
+    same filter parameters can be used to warm start.
+    """
+    prefix = 'ripple_baseline_'
+
+    def __init__(self, directory, instance_id, channel_ids, filter_params):
+        self.directory = directory
+        self.path = os.path.join(directory, f'{self.prefix}{instance_id}.npz')
+        self.channel_ids = np.asarray(channel_ids)
+        self.filter_params = np.asarray(filter_params, dtype='double')
+
+    def save(self, detector):
+        """
+        Writes the checkpoint, unless no channel has sampled any stats yet
+        (e.g. sample_mean_sd is off), which would overwrite an earlier
+        checkpoint with the detector's placeholders. Returns whether it wrote.
+        """
+        if not np.any(self.__sampled(detector.M2, detector.counts)):
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # write then rename so a crash never leaves a truncated checkpoint behind
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f,
+                channel_ids=self.channel_ids,
+                filter_params=self.filter_params,
+                means=detector.means,
+                M2=detector.M2,
+                counts=detector.counts,
+                saved_time=time.time(),
+            )
+        os.replace(temp_path, self.path)
+        return True
+
+    @staticmethod
+    def __sampled(M2, counts):
+        # a new detector starts at M2 0 and count 1, which restores to a zero sd
+        return np.logical_and(M2 > 0, counts > 1)
+
+    def find_latest(self):
+        """
+        Returns the path of the most recently written compatible checkpoint, or None.
+        """
+        paths = sorted(glob.glob(os.path.join(self.directory, f'{self.prefix}*.npz')), key=os.path.getmtime, reverse=True)
+        for path in paths:
+            try:
+                with np.load(path) as checkpoint:
+                    if np.array_equal(checkpoint['filter_params'], self.filter_params) and len(np.intersect1d(checkpoint['channel_ids'], self.channel_ids)) > 0:
+                        return path
+            except (OSError, KeyError, ValueError):
+                continue
+        return None
+
+    def load_into(self, detector, prior_samples, path=None):
+        """
+        Copies the stats of matching channels into the detector. Each channel's
+        count is capped at prior_samples, with M2 scaled alongside so the sd is
+        unchanged, which controls how quickly new data takes over.
+
+        Channels that had not sampled any stats keep the detector's defaults.
+        Returns the number of channels restored.
+        """
+        path = path if path is not None else self.find_latest()
+        if path is None:
+            return 0
+
+        with np.load(path) as checkpoint:
+            _, index_new, index_old = np.intersect1d(self.channel_ids, checkpoint['channel_ids'], return_indices=True)
+
+            sampled = self.__sampled(checkpoint['M2'][index_old], checkpoint['counts'][index_old])
+            index_new, index_old = index_new[sampled], index_old[sampled]
+
+            counts_old = checkpoint['counts'][index_old]
+            counts_new = np.clip(counts_old, 1, prior_samples)
+
+            detector.means[index_new] = checkpoint['means'][index_old]
+            detector.M2[index_new] = checkpoint['M2'][index_old] * counts_new / counts_old
+            detector.counts[index_new] = counts_new
+            detector.sigmas[index_new] = np.sqrt(detector.M2[index_new] / detector.counts[index_new])
+
+        return len(index_new)
+
 class EnvelopeEstimator:
     def __init__(self, num_signals, bp_order=2, bp_crit_freqs=[150,250], lfp_sampling_rate=1500, env_num_taps=15, env_band_edges=[50,55], env_desired=[1,0]):
         # set up iir
@@ -339,50 +613,207 @@ class EnvelopeEstimator:
             fs=lfp_sampling_rate,
             btype='bandpass',
             ftype='butter',
-        )[:, :, None]
-
-        ns = sos.shape[0]
-        self._b_ripple = sos[:, :3] # (ns, 3, num_signals)
-        self._a_ripple = sos[:, 3:] # (ns, 3, num_signals)
-
-        self._x_ripple = np.zeros((ns, 3, num_signals))
-        self._y_ripple = np.zeros((ns, 3, num_signals))
+        )
+        self._ripple_filter = fsgui.streamfilter.SOSFilter(sos, num_signals)
 
         # set up envelope filter
-        self._b_env = gsp.firdesign(
+        b_env = gsp.firdesign(
             env_num_taps,
             env_band_edges,
             env_desired,
             fs=lfp_sampling_rate,
-        )[:, None]
-        self._x_env = np.zeros((self._b_env.shape[0], num_signals))
+        )
+        self._env_filter = fsgui.streamfilter.FIRFilter(b_env, num_signals)
+
+        # a trailing zero keeps lfilter on its recursive path, which gives
+        # identical results for any block size (the pure FIR path does not)
+        self._a_env = np.array([1.0, 0.0])
+
+        # per-sample output buffers, reused on every call
+        self._ripple_data = np.zeros((num_signals,))
+        self._env_squared = np.zeros((num_signals,))
+        self._env = np.zeros((num_signals,))
+
+    def add_new_block(self, data):
+        """
+        data: (n_samples, num_signals) block of LFP, oldest sample first
+
+        The filter state is carried over between calls, so the output is the
+        same whether the samples arrive in one block or one at a time.
+        """
+        # IIR ripple bandpass
+        ripple_data, self._ripple_filter.zi[:] = scipy.signal.sosfilt(
+            self._ripple_filter.sos, data, axis=0, zi=self._ripple_filter.zi)
+
+        # FIR estimate envelope
+        env_squared, env_state = scipy.signal.lfilter(
+            self._env_filter.b, self._a_env, ripple_data**2, axis=0, zi=self._env_filter.get_state())
+        self._env_filter.set_state(env_state)
+        env = np.sqrt(env_squared)
+
+        return ripple_data, env
 
     def add_new_data(self, data):
-        # coming in parallel, data has width of num_signals
+        """
+        data: (num_signals,) single LFP sample
 
+        Runs without allocating; the returned arrays are overwritten on the next call.
+        """
         # IIR ripple bandpass
-        ns = self._a_ripple.shape[0]
-        for ii in range(ns):
-
-            self._x_ripple[ii, 1:] = self._x_ripple[ii, :-1]
-            if ii == 0: # new input is incoming data
-                self._x_ripple[ii, 0] = data
-            else: # new input is IIR output of previous stage
-                self._x_ripple[ii, 0] = self._y_ripple[ii - 1, 0]
-
-            self._y_ripple[ii, 1:] = self._y_ripple[ii, :-1]
-            ripple_data = (
-                np.sum(self._b_ripple[ii] * self._x_ripple[ii], axis=0) -
-                np.sum(self._a_ripple[ii, 1:] * self._y_ripple[ii, 1:], axis=0)
-            )
-            self._y_ripple[ii, 0] = ripple_data
-        
+        ripple_data = self._ripple_filter.filter_sample(data, out=self._ripple_data)
 
         # FIR estimate envelope
-        self._x_env[1:] = self._x_env[:-1]
-        self._x_env[0] = ripple_data**2
-        # parallel dot product without saying it's a dot product
-        env = np.sqrt(np.sum(self._b_env * self._x_env, axis=0))
+        np.multiply(ripple_data, ripple_data, out=self._env_squared)
+        env = self._env_filter.filter_sample(self._env_squared, out=self._env)
+        np.sqrt(env, out=env)
 
         return ripple_data, env
 
+def _attach_shared_array(shm, shape, dtype, offset):
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+    return array, offset + array.nbytes
+
+class ShardedSharedArrays:
+    """
+    The blocks exchanged between the coordinator and the shard workers, laid
+    out back to back in one shared memory segment.
+    """
+    def __init__(self, num_signals, num_workers, max_block_size, name=None):
+        self.num_signals = num_signals
+        self.num_workers = num_workers
+        self.max_block_size = max_block_size
+
+        layout = [
+            ('lfps', (max_block_size, num_signals), 'double'),
+            ('envelopes', (max_block_size, num_signals), 'double'),
+            ('stats', (4, num_signals), 'double'),
+            ('n_detected', (num_workers, max_block_size), 'int64'),
+            ('peak_zscore', (num_workers, max_block_size), 'double'),
+        ]
+        size = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in layout)
+
+        if name is None:
+            self.shm = mp.shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = mp.shared_memory.SharedMemory(name=name)
+
+        offset = 0
+        for array_name, shape, dtype in layout:
+            array, offset = _attach_shared_array(self.shm, shape, dtype, offset)
+            setattr(self, array_name, array)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        # drop the views before closing, the buffer can not be released while they exist
+        del self.lfps, self.envelopes, self.stats, self.n_detected, self.peak_zscore
+        self.shm.close()
+
+def _shard_worker(conn, shm_name, num_signals, num_workers, max_block_size, worker_index, channel_slice, estimator_kwargs):
+    shared = ShardedSharedArrays(num_signals, num_workers, max_block_size, name=shm_name)
+    start, stop = channel_slice
+
+    estimator = EnvelopeEstimator(num_signals=stop - start, **estimator_kwargs)
+    # the stats were reset by ShardedEnvelopeDetector and may since have been restored from a checkpoint
+    detector = EnvelopeThresholdDetector(num_signals=stop - start, stats=shared.stats[:, start:stop], reset_stats=False)
+
+    manual = None
+    try:
+        while True:
+            msg_tag, msg_data = conn.recv()
+            if msg_tag == 'stop':
+                break
+            elif msg_tag == 'block':
+                n_samples, config = msg_data
+
+                if manual != (config['means_magic_input'], config['sigmas_magic_input']):
+                    manual = (config['means_magic_input'], config['sigmas_magic_input'])
+                    detector.set_manual(*manual)
+
+                _, envelopes = estimator.add_new_block(shared.lfps[:n_samples, start:stop])
+                shared.envelopes[:n_samples, start:stop] = envelopes
+
+                for i, envelope in enumerate(envelopes):
+                    if config['sample_mean_sd']:
+                        detector.update_stats(envelope)
+                    shared.n_detected[worker_index, i], shared.peak_zscore[worker_index, i] = detector.score(envelope, config['sd_threshold'], config['auto_flag'])
+
+                conn.send(n_samples)
+    finally:
+        del detector
+        shared.close()
+
+class ShardedEnvelopeDetector(EnvelopeThresholdDetector):
+    """
+    Splits the channel set into contiguous shards, each filtered and thresholded
+    by its own worker process. LFP blocks, envelopes and stats are exchanged
+    through shared memory; the workers only return the number of channels above
+    threshold per sample, which are summed here.
+    """
+    def __init__(self, num_signals, num_workers, max_block_size, estimator_kwargs, means_manual=0, sigmas_manual=0):
+        self.num_signals = num_signals
+        self.num_workers = num_workers
+        self.max_block_size = max_block_size
+
+        self.shared = ShardedSharedArrays(num_signals, num_workers, max_block_size)
+
+        # the stats live in shared memory and are updated by the workers
+        super().__init__(num_signals, means_manual, sigmas_manual, stats=self.shared.stats)
+
+        bounds = np.linspace(0, num_signals, num_workers + 1).astype(int)
+        self._conns = []
+        self._procs = []
+        for worker_index in range(num_workers):
+            conn, worker_conn = mp.Pipe(duplex=True)
+            proc = mp.Process(target=_shard_worker, args=(
+                worker_conn,
+                self.shared.name,
+                num_signals,
+                num_workers,
+                max_block_size,
+                worker_index,
+                (bounds[worker_index], bounds[worker_index + 1]),
+                estimator_kwargs,
+            ))
+            proc.start()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+    def process_block(self, lfps, config):
+        """
+        lfps: (n_samples, num_signals) with n_samples <= max_block_size
+
+        Returns the number of channels above threshold and the peak z-score for
+        each sample, and the (n_samples, num_signals) envelopes, a view that is
+        overwritten by the next block.
+        """
+        n_samples = len(lfps)
+        self.shared.lfps[:n_samples] = lfps
+
+        worker_config = {
+            key: config[key]
+            for key in ['sample_mean_sd', 'sd_threshold', 'auto_flag', 'means_magic_input', 'sigmas_magic_input']
+        }
+        for conn in self._conns:
+            conn.send(('block', (n_samples, worker_config)))
+        for conn in self._conns:
+            conn.recv()
+
+        n_detected = np.sum(self.shared.n_detected[:, :n_samples], axis=0)
+        peak_zscore = np.max(self.shared.peak_zscore[:, :n_samples], axis=0)
+        return n_detected, peak_zscore, self.shared.envelopes[:n_samples]
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(('stop', None))
+            except BrokenPipeError:
+                pass
+        for proc in self._procs:
+            proc.join()
+
+        del self.means, self.M2, self.counts, self.sigmas
+        self.shared.close()
+        self.shared.shm.unlink()
@@ -2,6 +2,8 @@ import multiprocessing as mp
 import numpy as np
 import fsgui.process
 import fsgui.node
+import fsgui.streamfilter
+import fsgui.filter.lfp.ripple_new
 import json
 import logging
 
@@ -122,6 +124,131 @@ class ThetaFilterType(fsgui.node.NodeTypeObject):
 
         return fsgui.process.build_process_object(setup, workload)
 
+class MultiChannelThetaFilterType(fsgui.node.NodeTypeObject):
+    def __init__(self, type_id):
+        super().__init__(
+            type_id=type_id,
+            node_class='filter',
+            name='Theta filter (zero crossing, multi-channel)',
+            datatype='bool',
+       )
+
+    def write_template(self, config = None):
+        config = config if config is not None else {
+            'type_id': self.type_id(),
+            'instance_id': '',
+            'nickname': self.name(),
+            'source_id': None,
+            'thetaPhase': 0,
+            'num_signals': 32,
+            'tetrode_selection': None,
+            'sample_rate': 1500,
+            'trigger_mode': 'consensus',
+        }
+
+        return [
+            {
+                'name': 'type_id',
+                'type': 'hidden',
+                'default': config['type_id'],
+            },
+            {
+                'name': 'instance_id',
+                'type': 'hidden',
+                'default': config['instance_id'],
+            },
+            {
+                'label': 'Nickname',
+                'name': 'nickname',
+                'type': 'string',
+                'default': config['nickname'],
+                'tooltip': 'This is the name the source is displayed as in menus.',
+            },
+            {
+                'label': 'Source',
+                'name': 'source_id',
+                'type': 'node:float',
+                'default': config['source_id'],
+                'tooltip': 'Source to receive LFP data',
+            },
+            {
+                'label': 'Desired phase of stimulation',
+                'name': 'thetaPhase',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 360*4,
+                'default': config['thetaPhase'],
+                'units': 'deg',
+            },
+            {
+                'label': 'Number of signals (e.g. 32 vs 64 tetrodes)',
+                'name': 'num_signals',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'default': config['num_signals'],
+            },
+            {
+                'label': 'Tetrode selection',
+                'name': 'tetrode_selection',
+                'type': 'tetrode_selection',
+                'default': config['tetrode_selection'],
+            },
+            {
+                'label': 'Sample rate (Hz)',
+                'name': 'sample_rate',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'default': config['sample_rate'],
+                'units': 'Hz',
+            },
+            {
+                'label': 'Trigger',
+                'name': 'trigger_mode',
+                'type': 'select',
+                'options': [
+                    {'name': 'consensus', 'label': 'Median phase across channels'},
+                    {'name': 'any', 'label': 'Any channel (per-channel triggers)'},
+                ],
+                'default': config['trigger_mode'],
+            },
+        ]
+
+    def build(self, config, pipe_map):
+        source_pipe = pipe_map[config['source_id']]
+
+        tetrode_ids = fsgui.filter.lfp.ripple_new.select_tetrode_ids(config['tetrode_selection'], config['num_signals'])
+
+        theta_filter = MultiChannelThetaFilter(
+            coefficients=ThetaFilterCoefficientsDefault(),
+            params=ThetaFilterParams(targetPhase=config['thetaPhase']),
+            sample_rate=config['sample_rate'],
+            num_signals=len(tetrode_ids),
+        )
+
+        use_consensus = config['trigger_mode'] == 'consensus'
+
+        def setup(logging, data):
+            data['filter_model'] = theta_filter
+
+        def workload(connection, publisher, reporter, data):
+            if source_pipe.poll(timeout=1):
+                item = source_pipe.recv()
+                lfps = np.asarray(item['lfpData'], dtype='double')[tetrode_ids]
+
+                channel_triggered, consensus_triggered, consensus_phase = data['filter_model'].process_theta_data(lfps, item['localTimestamp'])
+                triggered = consensus_triggered if use_consensus else bool(np.any(channel_triggered))
+
+                publisher.send(triggered)
+                reporter.send({
+                    'trig': triggered,
+                    'channel_trig': channel_triggered.tolist(),
+                    'phase': consensus_phase,
+                })
+
+        return fsgui.process.build_process_object(setup, workload)
+
 class ThetaFilterParams:
     def __init__(self, targetPhase):
         self.targetPhase = targetPhase
@@ -146,8 +273,11 @@ class ThetaFilter:
         self.params = params
         self.sample_rate = sample_rate
 
-        # current filter state
-        self.z = np.zeros(shape=(self.coefficients.length,), dtype='double')
+        # current filter state, the coefficients form a single second-order section
+        self.filter = fsgui.streamfilter.SOSFilter(
+            np.concatenate([self.coefficients.numerator, self.coefficients.denominator]),
+            num_signals=1,
+        )
         
         # The last filtered LFP value
         self.fLFPLast = 0
@@ -174,11 +304,7 @@ class ThetaFilter:
             raise ValueError(f'Invalid target phase: {self.params.targetPhase}')
 
     def __filter_data(self, lfp):
-        fLFP = self.coefficients.numerator[0] * lfp + self.z[0]
-        for i in range(1, self.coefficients.length):
-            # update the filter state for the next iteration
-            self.z[i-1] = self.coefficients.numerator[i] * lfp + self.z[i] - self.coefficients.denominator[i]*fLFP
-        return fLFP
+        return self.filter.filter_value(lfp)
     
     def process_theta_data(self, lfpVal, sampleTime):
         fLFPCurrent = self.__filter_data(lfpVal)
@@ -199,3 +325,108 @@ class ThetaFilter:
         triggered = self.nextTrigger <= sampleTime if self.nextTrigger is not None else False
 
         return triggered, self.fLFPLast, self.nextTrigger, sampleTime, self.periodEstimate
+
+class MultiChannelThetaFilter:
+    """
+    ThetaFilter over a set of channels, with the filter state and the zero
+    crossing bookkeeping held as (num_signals,) arrays.
+
+    Besides the per-channel triggers of ThetaFilter, the phase of every channel
+    is extrapolated from its last upward zero crossing and period estimate, and
+    a consensus trigger fires when the median of those phases crosses the target.
+    """
+    def __init__(self, coefficients, params, sample_rate, num_signals):
+        self.coefficients = coefficients
+        self.params = params
+        self.sample_rate = sample_rate
+        self.num_signals = num_signals
+
+        # single channel logic, including the target phase validation
+        self.reference = ThetaFilter(coefficients, params, sample_rate)
+        self.useUpCross = self.reference.useUpCross
+        self.degFromZeroCross = self.reference.degFromZeroCross
+
+        self.filter = fsgui.streamfilter.SOSFilter(
+            np.concatenate([self.coefficients.numerator, self.coefficients.denominator]),
+            num_signals=num_signals,
+        )
+
+        self.fLFP = np.zeros((num_signals,))
+        self.fLFPLast = np.zeros((num_signals,))
+        self.upZeroCrossLast = np.full((num_signals,), -1e100)
+        self.periodEstimate = np.full((num_signals,), 1e100)
+        # nan where there is no pending trigger
+        self.nextTrigger = np.full((num_signals,), np.nan)
+        self.triggered = np.zeros((num_signals,), dtype='bool')
+
+        self._crossing = np.zeros((num_signals,), dtype='bool')
+        self._other = np.zeros((num_signals,), dtype='bool')
+        self._candidate = np.zeros((num_signals,))
+        self._phase = np.zeros((num_signals,))
+
+        self.target_phase = np.radians(self.params.targetPhase % 360)
+        self.last_offset = None
+
+    def __update_crossings(self, sampleTime):
+        f, last, crossing, other = self.fLFP, self.fLFPLast, self._crossing, self._other
+
+        # rising edges update the period estimate
+        np.greater_equal(f, 0, out=crossing)
+        np.less(last, 0, out=other)
+        np.logical_and(crossing, other, out=crossing)
+        np.subtract(sampleTime, self.upZeroCrossLast, out=self._candidate)
+        np.copyto(self.periodEstimate, self._candidate, where=crossing)
+        np.copyto(self.upZeroCrossLast, sampleTime, where=crossing)
+
+        if not self.useUpCross:
+            np.less_equal(f, 0, out=crossing)
+            np.greater(last, 0, out=other)
+            np.logical_and(crossing, other, out=crossing)
+
+        np.multiply(self.periodEstimate, self.degFromZeroCross/360.0, out=self._candidate)
+        np.add(self._candidate, sampleTime, out=self._candidate)
+        np.copyto(self.nextTrigger, self._candidate, where=crossing)
+
+        np.copyto(self.fLFPLast, f)
+
+    def consensus_phase(self, sampleTime):
+        """
+        Median phase in radians (negative cosine reference) over the channels that
+        have a period estimate, or None before any channel has seen two crossings.
+        """
+        valid = self.periodEstimate < 1e99
+        if not np.any(valid):
+            return None
+
+        # an upward zero crossing of a negative cosine is at 90 degrees
+        phase = self._phase[:np.count_nonzero(valid)]
+        np.subtract(sampleTime, self.upZeroCrossLast[valid], out=phase)
+        np.divide(phase, self.periodEstimate[valid], out=phase)
+        np.multiply(phase, 2*np.pi, out=phase)
+        np.add(phase, np.pi/2, out=phase)
+
+        # median of the offsets from the circular mean, so the result does not depend on wrapping
+        mean = np.angle(np.sum(np.exp(1j * phase)))
+        offsets = (phase - mean + np.pi) % (2*np.pi) - np.pi
+        return float((mean + np.median(offsets)) % (2*np.pi))
+
+    def process_theta_data(self, lfps, sampleTime):
+        """
+        lfps: (num_signals,) LFP sample
+
+        Returns (per-channel triggers, consensus trigger, consensus phase in radians or None).
+        """
+        self.filter.filter_sample(lfps, out=self.fLFP)
+        self.__update_crossings(sampleTime)
+
+        np.less_equal(self.nextTrigger, sampleTime, out=self.triggered)
+
+        phase = self.consensus_phase(sampleTime)
+        consensus_triggered = False
+        if phase is not None:
+            # fire when the wrapped distance to the target changes sign going forward
+            offset = (phase - self.target_phase + np.pi) % (2*np.pi) - np.pi
+            consensus_triggered = self.last_offset is not None and self.last_offset < 0 <= offset and offset - self.last_offset < np.pi
+            self.last_offset = offset
+
+        return self.triggered, consensus_triggered, phase
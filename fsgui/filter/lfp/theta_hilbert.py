@@ -6,6 +6,8 @@ import json
 import logging
 
 import fsgui.nparray
+import fsgui.filter.lfp.ripple_new
+import scipy.fft
 import scipy.signal
 import time
 
@@ -29,6 +31,10 @@ class ThetaPhaseHilbertFilterType(fsgui.node.NodeTypeObject):
             'lfp_sample_rate': 1500,
             'timestamp_interval': 20,
             'trim_proportion': 0.15,
+            'phase_update_ms': 0,
+            'channel_mode': 'reference',
+            'num_signals': 32,
+            'tetrode_selection': None,
         }
 
         return [
@@ -74,6 +80,30 @@ class ThetaPhaseHilbertFilterType(fsgui.node.NodeTypeObject):
                 'default': config['reference_ntrode'],
                 'tooltip': 'The ntrode to use as the reference to calculate theta filter on.',
             },
+            {
+                'label': 'Channels',
+                'name': 'channel_mode',
+                'type': 'select',
+                'options': [
+                    {'name': 'reference', 'label': 'Reference tetrode'},
+                    {'name': 'selection', 'label': 'Tetrode selection (circular mean phase)'},
+                ],
+                'default': config.get('channel_mode', 'reference'),
+            },
+            {
+                'label': 'Number of signals (e.g. 32 vs 64 tetrodes)',
+                'name': 'num_signals',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'default': config.get('num_signals', 32),
+            },
+            {
+                'label': 'Tetrode selection',
+                'name': 'tetrode_selection',
+                'type': 'tetrode_selection',
+                'default': config.get('tetrode_selection'),
+            },
             {
                 'label': 'LFP Sample rate (Hz)',
                 'name': 'lfp_sample_rate',
@@ -100,20 +130,39 @@ class ThetaPhaseHilbertFilterType(fsgui.node.NodeTypeObject):
                 'upper': 1,
                 'default': config['trim_proportion'],
             },
+            {
+                'label': 'Phase model update interval',
+                'name': 'phase_update_ms',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 1000,
+                'default': config.get('phase_update_ms', 0),
+                'units': 'ms',
+                'tooltip': 'Refit the Hilbert phase model only this often and extrapolate the phase in between using the estimated frequency. Triggers fire where the extrapolated phase crosses the target, on every sample. 0 refits on every sample.',
+            },
         ]
 
     def build(self, config, pipe_map):
         source_pipe = pipe_map[config['source_id']]
 
+        if config.get('channel_mode', 'reference') == 'selection':
+            tetrode_ids = fsgui.filter.lfp.ripple_new.select_tetrode_ids(config['tetrode_selection'], config['num_signals'])
+            num_signals = len(tetrode_ids)
+            select_lfp = lambda lfp_data: np.asarray(lfp_data)[tetrode_ids]
+        else:
+            tetrode_id = config['reference_ntrode']
+            num_signals = None
+            select_lfp = lambda lfp_data: lfp_data[tetrode_id]
+
         theta_filter = ThetaHilbertYuleWalkerFilter(
             phase_deg=config['theta_filter_degrees'],
             samples_per_second=config['lfp_sample_rate'],
             timestamp_interval=config['timestamp_interval'],
             trim_proportion=config['trim_proportion'],
+            update_interval=max(1, round(config.get('phase_update_ms', 0) * config['lfp_sample_rate'] / 1000)),
+            num_signals=num_signals,
         )
 
-        tetrode_id=config['reference_ntrode']
-
         def setup(logging, data):
             data['filter_model'] = theta_filter
             data['last_known_theta_val'] = 0
@@ -121,7 +170,7 @@ class ThetaPhaseHilbertFilterType(fsgui.node.NodeTypeObject):
         def workload(connection, publisher, reporter, data):
             if source_pipe.poll(timeout=1):
                 item = source_pipe.recv()
-                lfpVal=item['lfpData'][tetrode_id]
+                lfpVal=select_lfp(item['lfpData'])
                 sampleTime=item['localTimestamp']
 
                 triggered, theta_val = data['filter_model'].process_theta_data(lfpVal, sampleTime)
@@ -153,12 +202,45 @@ class FirstOrderButterworthThetaFilter:
             output='ba',
             fs=self.sample_rate
         )
-    
-    def filter_signal(self, signal):
-        return scipy.signal.filtfilt(self.theta_num, self.theta_denom, signal)
+
+        # filtfilt's defaults, cached so they are not recomputed on every call
+        self.padlen = 3 * max(len(self.theta_num), len(self.theta_denom))
+        self.zi = scipy.signal.lfilter_zi(self.theta_num, self.theta_denom)
+        self._zi_scaled = None
+        self._extended = None
+
+    def filter_signal(self, signal, out=None):
+        """
+        Zero-phase filtfilt of `signal` along its last axis. With `out` the odd
+        extension and initial conditions are built in preallocated buffers and the
+        result is written into `out`; the arithmetic is the same as scipy.signal.filtfilt.
+        """
+        if out is None:
+            return scipy.signal.filtfilt(self.theta_num, self.theta_denom, signal)
+
+        n, padlen = signal.shape[-1], self.padlen
+        extended_shape = signal.shape[:-1] + (n + 2 * padlen,)
+        if self._extended is None or self._extended.shape != extended_shape:
+            self._extended = np.empty(extended_shape)
+            self._zi_scaled = np.empty(signal.shape[:-1] + self.zi.shape)
+        extended = self._extended
+
+        # odd extension: 2*x[0] - x[padlen:0:-1], x, 2*x[-1] - x[-2:-(padlen+2):-1]
+        np.subtract(2 * signal[..., :1], signal[..., padlen:0:-1], out=extended[..., :padlen])
+        extended[..., padlen:padlen+n] = signal
+        np.subtract(2 * signal[..., -1:], signal[..., -2:-(padlen+2):-1], out=extended[..., padlen+n:])
+
+        np.multiply(self.zi, extended[..., :1], out=self._zi_scaled)
+        forward, _ = scipy.signal.lfilter(self.theta_num, self.theta_denom, extended, zi=self._zi_scaled)
+
+        np.multiply(self.zi, forward[..., -1:], out=self._zi_scaled)
+        backward, _ = scipy.signal.lfilter(self.theta_num, self.theta_denom, forward[..., ::-1], zi=self._zi_scaled)
+
+        out[...] = backward[..., -(padlen+1):-(padlen+n+1):-1]
+        return out
 
 class ARForwardPredictor:
-    def __init__(self, ar_params, input_length, n_future_samples):
+    def __init__(self, ar_params, input_length, n_future_samples, num_signals=None):
         self.ar_params = ar_params
         self.order = len(self.ar_params)
 
@@ -170,23 +252,106 @@ class ARForwardPredictor:
             for j in range(self.order):
                 self.weights[j,t] = np.dot(np.flip(self.ar_params), self.weights[j, t-self.order:t])
 
-        self.full_buffer = np.empty((input_length + n_future_samples,))
-    
+        # only the columns past the identity block produce new samples
+        self.future_weights = np.ascontiguousarray(self.weights[:, self.order:])
+
+        # with num_signals, every row is a channel and all are predicted in one matmul
+        length = input_length + n_future_samples
+        self.full_buffer = np.empty((length,) if num_signals is None else (num_signals, length))
+
     def forward_predict_ar(self, input_signal):
-        self.full_buffer[:len(input_signal)] = input_signal
-        self.full_buffer[len(input_signal):] = np.matmul(input_signal[-self.order:], self.weights)[self.order:]
+        n = input_signal.shape[-1]
+        self.full_buffer[..., :n] = input_signal
+        np.matmul(input_signal[..., -self.order:], self.future_weights, out=self.full_buffer[..., n:])
         return self.full_buffer
 
+class HilbertTransform:
+    """
+    scipy.signal.hilbert for a fixed input length, with the FFT length fixed to
+    scipy.fft.next_fast_len and the spectra kept in preallocated buffers.
+    With `num_signals` the rows of a (num_signals, length) input are
+    transformed in one batched FFT.
+    """
+    def __init__(self, length, num_signals=None):
+        self.length = length
+        self.nfft = scipy.fft.next_fast_len(length)
+
+        # one-sided spectrum weights, as in scipy.signal.hilbert
+        self.h = np.zeros((self.nfft,))
+        if self.nfft % 2 == 0:
+            self.h[0] = self.h[self.nfft // 2] = 1
+            self.h[1:self.nfft // 2] = 2
+        else:
+            self.h[0] = 1
+            self.h[1:(self.nfft + 1) // 2] = 2
+
+        shape = (self.nfft,) if num_signals is None else (num_signals, self.nfft)
+        self._padded = np.zeros(shape, dtype='complex')
+        self._spectrum = np.empty(shape, dtype='complex')
+        self._analytic = np.empty(shape, dtype='complex')
+
+    def analytic_signal(self, signal):
+        self._padded[..., :self.length] = signal
+        np.fft.fft(self._padded, out=self._spectrum)
+        np.multiply(self._spectrum, self.h, out=self._spectrum)
+        np.fft.ifft(self._spectrum, out=self._analytic)
+        return self._analytic[..., :self.length]
+
+class PhaseUnwrapper:
+    """
+    np.unwrap(np.angle(z)) for a fixed length, written into preallocated buffers.
+    """
+    def __init__(self, length):
+        self.phase = np.empty((length,))
+        self._dd = np.empty((length - 1,))
+        self._ddmod = np.empty((length - 1,))
+        self._mask = np.empty((length - 1,), dtype='bool')
+        self._mask_other = np.empty((length - 1,), dtype='bool')
+
+    def unwrapped_angle(self, z):
+        phase, dd, ddmod = self.phase, self._dd, self._ddmod
+        mask, mask_other = self._mask, self._mask_other
+
+        np.arctan2(z.imag, z.real, out=phase)
+
+        # same steps as np.unwrap with the default discontinuity of pi
+        np.subtract(phase[1:], phase[:-1], out=dd)
+        np.add(dd, np.pi, out=ddmod)
+        np.mod(ddmod, 2*np.pi, out=ddmod)
+        np.subtract(ddmod, np.pi, out=ddmod)
+        np.equal(ddmod, -np.pi, out=mask)
+        np.greater(dd, 0, out=mask_other)
+        np.logical_and(mask, mask_other, out=mask)
+        np.copyto(ddmod, np.pi, where=mask)
+
+        # ddmod becomes the correction, zeroed where the jump was already small
+        np.subtract(ddmod, dd, out=ddmod)
+        np.abs(dd, out=dd)
+        np.less(dd, np.pi, out=mask)
+        np.copyto(ddmod, 0, where=mask)
+
+        np.cumsum(ddmod, out=ddmod)
+        np.add(phase[1:], ddmod, out=phase[1:])
+        return phase
+
 class ThetaHilbertYuleWalkerFilter:
-    def __init__(self, phase_deg = 90, samples_per_second = 1500, timestamp_interval = 20, trim_proportion = 0.15):
+    """
+    With `num_signals`, lfpVal is a (num_signals,) sample and every channel goes
+    through the filter, AR prediction and Hilbert transform as one batch. The
+    phase is then the circular mean of the channel phases, each channel
+    weighted equally.
+    """
+    def __init__(self, phase_deg = 90, samples_per_second = 1500, timestamp_interval = 20, trim_proportion = 0.15, update_interval = 1, num_signals = None):
         self.sample_rate = samples_per_second
+        self.num_signals = num_signals
         self.trim_n_samples = int(self.sample_rate * trim_proportion)
         self.timestamp_interval = timestamp_interval
 
-        # create buffers
+        # create buffers. timestamps are not buffered, the sample i places before
+        # the newest one is at sampleTime - i * timestamp_interval
         self.buffer_length = self.sample_rate * 1
-        self.lfp_buffer = fsgui.nparray.CircularArray(length=self.buffer_length)
-        self.time_buffer = fsgui.nparray.CircularArray(length=self.buffer_length)
+        self.lfp_buffer = fsgui.nparray.SlidingWindowArray(length=self.buffer_length, num_signals=num_signals)
+        self.theta_data = np.zeros(self.lfp_buffer.get_slice.shape)
 
         # we assume a negative cosine wave for phase based on old FSGui conventions
         assert phase_deg >= 0 and phase_deg <= 360
@@ -210,57 +375,136 @@ class ThetaHilbertYuleWalkerFilter:
             -7.72185455e-02
         ]
 
-        self.ar_predictor = ARForwardPredictor(self.ar_params, self.buffer_length - 2 * self.trim_n_samples, 2 * self.trim_n_samples)
+        self.ar_predictor = ARForwardPredictor(self.ar_params, self.buffer_length - 2 * self.trim_n_samples, 2 * self.trim_n_samples, num_signals=num_signals)
+        self.hilbert = HilbertTransform(self.buffer_length, num_signals=num_signals)
+        self.unwrapper = PhaseUnwrapper(self.buffer_length)
+
+        if num_signals is not None:
+            self._amplitude = np.empty((num_signals, self.buffer_length))
+            self._unit_phasor = np.empty((num_signals, self.buffer_length), dtype='complex')
+            self._mean_phasor = np.empty((self.buffer_length,), dtype='complex')
 
         self.next_trigger_estimate = None
 
+        # with update_interval > 1 the phase model is refit every update_interval samples
+        # and the phase in between is extrapolated at the estimated frequency
+        self.update_interval = update_interval
+        self.samples_until_update = 0
+        self.phase_model = None
+        self.last_offset = None
+        self.trigger_armed = True
+
     def __trim_both_edges(self, signal):
-        return signal[self.trim_n_samples:-self.trim_n_samples]
+        return signal[..., self.trim_n_samples:-self.trim_n_samples]
+
+    def __fit_phase(self):
+        """
+        Returns the amplitude at the point estimate and the unwrapped phase of the
+        AR-extended theta band, computed from self.theta_data. The phase is a view
+        of a reused buffer.
+        """
+        # trim off the edge effects
+        theta_trim = self.__trim_both_edges(self.theta_data)
+
+        theta_predicted = self.ar_predictor.forward_predict_ar(theta_trim)
+        analytic_signal = self.hilbert.analytic_signal(theta_predicted)
+
+        if self.num_signals is None:
+            instantaneous_phase = self.unwrapper.unwrapped_angle(analytic_signal)
+            return np.abs(analytic_signal[-self.trim_n_samples]), instantaneous_phase
+
+        # circular mean over channels: sum of unit phasors, guarding empty channels
+        np.abs(analytic_signal, out=self._amplitude)
+        amplitude = np.mean(self._amplitude[:, -self.trim_n_samples])
+        np.maximum(self._amplitude, np.finfo('double').tiny, out=self._amplitude)
+        np.divide(analytic_signal, self._amplitude, out=self._unit_phasor)
+        np.sum(self._unit_phasor, axis=0, out=self._mean_phasor)
+
+        instantaneous_phase = self.unwrapper.unwrapped_angle(self._mean_phasor)
+        return amplitude, instantaneous_phase
+
+    def __latest_theta(self):
+        if self.num_signals is None:
+            return self.theta_data[-1]
+        return np.mean(self.theta_data[:, -1])
+
+    def __estimate_trigger(self, instantaneous_phase, sampleTime):
+        # calculate unwrapped target phase
+        phase_point_estimate = instantaneous_phase[-self.trim_n_samples]
+        local_phase = phase_point_estimate % (2*np.pi)
+        next_target_phase = phase_point_estimate + (self.phase_rad - local_phase) % (2*np.pi)
+
+        # at which point will the phase equal our target phase
+        phase_array_index = np.searchsorted(instantaneous_phase, next_target_phase)
+        future_relative_index = phase_array_index - self.buffer_length + self.trim_n_samples
+
+        # avoid setting next estimate too close or too far into the future
+        if self.trim_n_samples / 4 < future_relative_index and future_relative_index < self.trim_n_samples / 2:
+            self.next_trigger_estimate = sampleTime + self.timestamp_interval * (future_relative_index)
+
+    def __fit_phase_model(self, sampleTime):
+        self.theta_filter.filter_signal(self.lfp_buffer.get_slice, out=self.theta_data)
+        amplitude, instantaneous_phase = self.__fit_phase()
+
+        # mean frequency (radians per sample) over the samples leading up to the point estimate
+        phase_point_estimate = instantaneous_phase[-self.trim_n_samples]
+        omega = (phase_point_estimate - instantaneous_phase[-2*self.trim_n_samples]) / self.trim_n_samples
+
+        self.phase_model = {
+            'phase': phase_point_estimate,
+            'timestamp': sampleTime,
+            'omega': omega,
+            'amplitude': amplitude,
+        }
 
-    def process_theta_data(self, lfpVal, sampleTime):
-        # place data and get lfp buffer
+    def extrapolate_phase(self, sampleTime):
+        """
+        Unwrapped phase at `sampleTime` according to the last fitted phase model.
+        """
+        elapsed_samples = (sampleTime - self.phase_model['timestamp']) / self.timestamp_interval
+        return self.phase_model['phase'] + self.phase_model['omega'] * elapsed_samples
+
+    def __process_theta_data_decimated(self, lfpVal, sampleTime):
         self.lfp_buffer.place(lfpVal)
-        self.time_buffer.place(sampleTime)
 
-        # extra computation
-        lfp_data = np.flip(self.lfp_buffer.get_slice)
-        theta_data = self.theta_filter.filter_signal(lfp_data)
+        self.samples_until_update -= 1
+        if self.samples_until_update <= 0:
+            self.samples_until_update = self.update_interval
+            self.__fit_phase_model(sampleTime)
 
-        if self.next_trigger_estimate is not None:
-            if self.next_trigger_estimate <= sampleTime:
-                self.next_trigger_estimate = None
-                return True, theta_data[-1]
-            else:
-                return False, theta_data[-1]
-        else:
-            lfp_data = np.flip(self.lfp_buffer.get_slice)
-            lfp_data_ts = np.flip(self.time_buffer.get_slice)
-
-            # filter data
-            theta_data = self.theta_filter.filter_signal(lfp_data)
+        phase = self.extrapolate_phase(sampleTime)
 
-            # trim off the edge effects
-            theta_trim = self.__trim_both_edges(theta_data)
-            theta_trim_ts = self.__trim_both_edges(lfp_data_ts)
+        # fire when the wrapped distance to the target changes sign going forward, on every
+        # sample, so no crossing is missed however long the refit interval is
+        offset = (phase - self.phase_rad + np.pi) % (2 * np.pi) - np.pi
+        triggered = self.trigger_armed and self.last_offset is not None and self.last_offset < 0 <= offset and offset - self.last_offset < np.pi
+        self.last_offset = offset
 
-            # theta_predicted, theta_predicted_ts = self.__forward_predict_ar(theta_trim, theta_trim_ts, n_future_samples=2*self.trim_n_samples)
-            theta_predicted = self.ar_predictor.forward_predict_ar(theta_trim)
-            theta_predicted_ts = np.hstack([theta_trim_ts, [theta_trim_ts[-1] + 20 * (i+1) for i in range(2*self.trim_n_samples)]])
+        # a refit can step the phase back over the target, re-arm only half a cycle before the next crossing
+        if triggered:
+            self.trigger_armed = False
+        elif offset < -np.pi / 2:
+            self.trigger_armed = True
 
-            analytic_signal = scipy.signal.hilbert(theta_predicted)
-            instantaneous_phase = np.unwrap(np.angle(analytic_signal))
+        theta_val = self.phase_model['amplitude'] * np.cos(phase)
+        return triggered, theta_val
 
-            # calculate unwrapped target phase
-            phase_point_estimate = instantaneous_phase[-self.trim_n_samples]
-            local_phase = phase_point_estimate % (2*np.pi)
-            next_target_phase = phase_point_estimate + (self.phase_rad - local_phase) % (2*np.pi)
+    def process_theta_data(self, lfpVal, sampleTime):
+        if self.update_interval > 1:
+            return self.__process_theta_data_decimated(lfpVal, sampleTime)
 
-            # at which point will the phase equal our target phase
-            phase_array_index = np.searchsorted(instantaneous_phase, next_target_phase)
-            future_relative_index = phase_array_index - len(lfp_data_ts) + self.trim_n_samples
+        # place data and filter the buffer, oldest sample first
+        self.lfp_buffer.place(lfpVal)
+        self.theta_filter.filter_signal(self.lfp_buffer.get_slice, out=self.theta_data)
 
-            # avoid setting next estimate too close or too far into the future
-            if self.trim_n_samples / 4 < future_relative_index and future_relative_index < self.trim_n_samples / 2:
-                self.next_trigger_estimate = lfp_data_ts[-1] + self.timestamp_interval * (future_relative_index)
+        if self.next_trigger_estimate is not None:
+            if self.next_trigger_estimate <= sampleTime:
+                self.next_trigger_estimate = None
+                return True, self.__latest_theta()
+            else:
+                return False, self.__latest_theta()
+        else:
+            _, instantaneous_phase = self.__fit_phase()
+            self.__estimate_trigger(instantaneous_phase, sampleTime)
 
-            return False, theta_data[-1]
+            return False, self.__latest_theta()
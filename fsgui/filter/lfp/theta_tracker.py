@@ -0,0 +1,223 @@
+import numpy as np
+import scipy.signal
+import fsgui.process
+import fsgui.node
+import fsgui.streamfilter
+import fsgui.filter.lfp.ripple_new
+
+class ThetaPhaseTrackerFilterType(fsgui.node.NodeTypeObject):
+    def __init__(self, type_id):
+        super().__init__(
+            type_id=type_id,
+            node_class='filter',
+            name='Theta filter (phase tracker)',
+            datatype='bool',
+       )
+
+    def write_template(self, config = None):
+        config = config if config is not None else {
+            'type_id': self.type_id(),
+            'instance_id': '',
+            'nickname': self.name(),
+            'source_id': None,
+            'thetaPhase': 0,
+            'num_signals': 32,
+            'tetrode_selection': None,
+            'sample_rate': 1500,
+            'resonator_bandwidth': 7.0,
+        }
+
+        return [
+            {
+                'name': 'type_id',
+                'type': 'hidden',
+                'default': config['type_id'],
+            },
+            {
+                'name': 'instance_id',
+                'type': 'hidden',
+                'default': config['instance_id'],
+            },
+            {
+                'label': 'Nickname',
+                'name': 'nickname',
+                'type': 'string',
+                'default': config['nickname'],
+                'tooltip': 'This is the name the source is displayed as in menus.',
+            },
+            {
+                'label': 'Source',
+                'name': 'source_id',
+                'type': 'node:float',
+                'default': config['source_id'],
+                'tooltip': 'Source to receive LFP data',
+            },
+            {
+                'label': 'Desired phase of stimulation',
+                'name': 'thetaPhase',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 360,
+                'default': config['thetaPhase'],
+                'units': 'deg',
+            },
+            {
+                'label': 'Number of signals (e.g. 32 vs 64 tetrodes)',
+                'name': 'num_signals',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'default': config['num_signals'],
+            },
+            {
+                'label': 'Tetrode selection',
+                'name': 'tetrode_selection',
+                'type': 'tetrode_selection',
+                'default': config['tetrode_selection'],
+            },
+            {
+                'label': 'Sample rate (Hz)',
+                'name': 'sample_rate',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 100000,
+                'default': config['sample_rate'],
+                'units': 'Hz',
+            },
+            {
+                'label': 'Resonator bandwidth',
+                'name': 'resonator_bandwidth',
+                'type': 'double',
+                'lower': 0.1,
+                'upper': 100,
+                'decimals': 2,
+                'default': config['resonator_bandwidth'],
+                'units': 'Hz',
+                'tooltip': 'Bandwidth of the complex resonator that produces the analytic signal. Narrower is smoother but follows frequency changes more slowly.',
+            },
+        ]
+
+    def build(self, config, pipe_map):
+        source_pipe = pipe_map[config['source_id']]
+
+        tetrode_ids = fsgui.filter.lfp.ripple_new.select_tetrode_ids(config['tetrode_selection'], config['num_signals'])
+
+        tracker = ThetaPhaseTracker(
+            num_signals=len(tetrode_ids),
+            sample_rate=config['sample_rate'],
+            target_phase_deg=config['thetaPhase'],
+            resonator_bandwidth=config['resonator_bandwidth'],
+        )
+
+        def setup(logging, data):
+            data['filter_model'] = tracker
+
+        def workload(connection, publisher, reporter, data):
+            if source_pipe.poll(timeout=1):
+                item = source_pipe.recv()
+                lfps = np.asarray(item['lfpData'], dtype='double')[tetrode_ids]
+
+                triggered, phase, frequency = data['filter_model'].process_theta_data(lfps)
+
+                publisher.send(triggered)
+                reporter.send({
+                    'trig': triggered,
+                    'theta_phase': np.degrees(phase),
+                    'theta_freq': frequency,
+                })
+
+        return fsgui.process.build_process_object(setup, workload)
+
+class ThetaPhaseTracker:
+    """
+    Causal instantaneous theta phase in constant time per sample, for any
+    number of channels at once.
+
+    Each channel is bandpassed and then run through two complex one-pole
+    resonators tuned to the centre frequency, whose output is an analytic
+    signal. The frequency is tracked from the phase advance between samples,
+    and the phase response of the whole filter chain at that frequency is
+    subtracted, so the phase is corrected at the endpoint rather than delayed.
+
+    The consensus phase is the amplitude-weighted circular mean over channels,
+    and a trigger fires on the sample where it crosses the target phase. Phase
+    follows the negative cosine convention of the other theta filters.
+    """
+    def __init__(self, num_signals, sample_rate, target_phase_deg, resonator_bandwidth=7.0,
+            band=(4.0, 12.0), center_frequency=8.0, frequency_time_constant=0.15):
+        self.num_signals = num_signals
+        self.sample_rate = sample_rate
+
+        assert target_phase_deg >= 0 and target_phase_deg <= 360
+        self.target_phase = ((target_phase_deg + 180) % 360) / 360.0 * 2 * np.pi
+
+        sos = scipy.signal.butter(N=1, Wn=band, btype='bandpass', output='sos', fs=sample_rate)
+        self.bandpass = fsgui.streamfilter.SOSFilter(sos, num_signals=num_signals)
+
+        # pole radius from the one-pole bandwidth, unity gain and zero phase at the centre
+        radius = 1 - np.pi * resonator_bandwidth / sample_rate
+        self.omega_center = 2 * np.pi * center_frequency / sample_rate
+        self.pole = radius * np.exp(1j * self.omega_center)
+        self.gain = 1 - radius
+
+        # phase response of the filter chain over the band, looked up at the tracked frequency
+        self.omega_grid = np.linspace(2 * np.pi * band[0] / sample_rate, 2 * np.pi * band[1] / sample_rate, 1000)
+        _, response = scipy.signal.sosfreqz(sos, worN=self.omega_grid)
+        response *= (self.gain / (1 - self.pole * np.exp(-1j * self.omega_grid))) ** 2
+        self.phase_response = np.unwrap(np.angle(response))
+
+        self.frequency_smoothing = 1 / (frequency_time_constant * sample_rate)
+
+        self._band = np.zeros((num_signals,))
+        self._stage1 = np.zeros((num_signals,), dtype='complex')
+        self._stage2 = np.zeros((num_signals,), dtype='complex')
+        self._previous = np.zeros((num_signals,), dtype='complex')
+        self._tmp = np.zeros((num_signals,), dtype='complex')
+        self._increment = np.zeros((num_signals,))
+        self.omega = np.full((num_signals,), self.omega_center)
+        self.phase = np.zeros((num_signals,))
+
+        self.last_offset = None
+
+    def __resonate(self, state, x):
+        # state = pole * state + gain * x
+        np.multiply(state, self.pole, out=state)
+        np.multiply(x, self.gain, out=self._tmp)
+        np.add(state, self._tmp, out=state)
+
+    def process_theta_data(self, lfps):
+        """
+        lfps: (num_signals,) LFP sample
+
+        Returns (triggered, consensus phase in radians, consensus frequency in Hz).
+        """
+        self.bandpass.filter_sample(lfps, out=self._band)
+
+        np.copyto(self._previous, self._stage2)
+        self.__resonate(self._stage1, self._band)
+        self.__resonate(self._stage2, self._stage1)
+
+        # frequency from the phase advance, smoothed and kept inside the band
+        np.conjugate(self._previous, out=self._previous)
+        np.multiply(self._stage2, self._previous, out=self._tmp)
+        np.arctan2(self._tmp.imag, self._tmp.real, out=self._increment)
+        np.subtract(self._increment, self.omega, out=self._increment)
+        np.multiply(self._increment, self.frequency_smoothing, out=self._increment)
+        np.add(self.omega, self._increment, out=self.omega)
+        np.clip(self.omega, self.omega_grid[0], self.omega_grid[-1], out=self.omega)
+
+        # remove the chain's phase response at the tracked frequency
+        np.arctan2(self._stage2.imag, self._stage2.real, out=self.phase)
+        np.subtract(self.phase, np.interp(self.omega, self.omega_grid, self.phase_response), out=self.phase)
+
+        # amplitude weighted circular mean
+        consensus = np.sum(np.abs(self._stage2) * np.exp(1j * self.phase))
+        phase = np.angle(consensus) % (2 * np.pi)
+        frequency = float(np.mean(self.omega)) * self.sample_rate / (2 * np.pi)
+
+        # fire when the wrapped distance to the target changes sign going forward
+        offset = (phase - self.target_phase + np.pi) % (2 * np.pi) - np.pi
+        triggered = self.last_offset is not None and self.last_offset < 0 <= offset and offset - self.last_offset < np.pi
+        self.last_offset = offset
+
+        return triggered, float(phase), frequency
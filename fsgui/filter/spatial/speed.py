@@ -2,6 +2,7 @@ import multiprocessing as mp
 import numpy as np
 import fsgui.process
 import fsgui.node
+import fsgui.streamfilter
 
 
 class SpeedFilterType(fsgui.node.NodeTypeObject):
@@ -168,13 +169,11 @@ class KinematicsEstimator(object):
         self._sf = scale_factor
         self._dt = dt
 
-        self._b_x = np.array(xfilter)
-        self._b_y = np.array(yfilter)
-        self._b_speed = np.array(speedfilter)
+        self._filter_x = fsgui.streamfilter.FIRFilter(xfilter, num_signals=1)
+        self._filter_y = fsgui.streamfilter.FIRFilter(yfilter, num_signals=1)
+        self._filter_speed = fsgui.streamfilter.FIRFilter(speedfilter, num_signals=1)
 
-        self._buf_x = np.zeros(self._b_x.shape[0])
-        self._buf_y = np.zeros(self._b_y.shape[0])
-        self._buf_speed = np.zeros(self._b_speed.shape[0])
+        self._out = np.zeros(1)
 
         self._last_x = -1
         self._last_y = -1
@@ -193,18 +192,18 @@ class KinematicsEstimator(object):
             return x, y, 0
 
         if smooth_x:
-            xv = self._smooth(x * self._sf, self._b_x, self._buf_x)
+            xv = self._smooth(x * self._sf, self._filter_x)
         else:
             xv = x
 
         if smooth_y:
-            yv = self._smooth(y * self._sf, self._b_y, self._buf_y)
+            yv = self._smooth(y * self._sf, self._filter_y)
         else:
             yv = y
 
         sv = np.sqrt((yv - self._last_y)**2 + (xv - self._last_x)**2) / self._dt
         if smooth_speed:
-            sv = self._smooth(sv, self._b_speed, self._buf_speed)
+            sv = self._smooth(sv, self._filter_speed)
 
         # now that the speed has been estimated, the current x and y values
         # become the most recent (last) x and y values
@@ -214,11 +213,9 @@ class KinematicsEstimator(object):
 
         return xv, yv, sv
 
-    def _smooth(self, newval, coefs, buf):
+    def _smooth(self, newval, fir_filter):
 
-        # mutates data!
-        buf[1:] = buf[:-1]
-        buf[0] = newval
-        rv = np.sum(coefs * buf, axis=0)
+        # mutates filter state!
+        rv = float(fir_filter.filter_sample(newval, out=self._out)[0])
 
         return rv
\ No newline at end of file
@@ -0,0 +1,87 @@
+import numpy as np
+
+class MarkExtractor:
+    """
+    Turns spike waveforms into marks for the mark-space encoders, for any
+    number of spikes at once.
+
+    The amplitude mark is every channel's value at the sample where the
+    waveform peaks, the first occurrence of the largest value over all
+    channels. Optional features, appended in this order:
+
+        trough: every channel's value at the trough of the peak channel,
+            its smallest value at or after the peak
+        width: samples from the peak to that trough
+
+    Only the first `n_channels` channels are used, all of them if None.
+
+    Spikes are kept if their nTrodeId is in `tetrode_selection` (a
+    tetrode_selection form value of nTrodeIds, None keeps all) and their
+    peak is at least `minimum_amplitude` (None keeps all).
+    """
+    def __init__(self, n_channels=None, trough=False, width=False, minimum_amplitude=None, tetrode_selection=None):
+        self.n_channels = n_channels
+        self.trough = trough
+        self.width = width
+        self.minimum_amplitude = minimum_amplitude
+        self.set_tetrode_selection(tetrode_selection)
+
+    def set_tetrode_selection(self, tetrode_selection):
+        if tetrode_selection is None:
+            self.tetrode_ids, self.is_include = np.empty((0,), dtype=int), False
+        else:
+            self.tetrode_ids = np.asarray(tetrode_selection['tetrodes'], dtype=int)
+            self.is_include = bool(tetrode_selection['is_include'])
+
+    def mark_ndims(self, n_channels):
+        """
+        Length of the marks extracted from spikes with `n_channels` channels.
+        """
+        if self.n_channels is not None:
+            n_channels = min(n_channels, self.n_channels)
+        return n_channels * (2 if self.trough else 1) + (1 if self.width else 0)
+
+    def extract(self, waveforms):
+        """
+        waveforms: (k, channels, samples) spikes, or one (channels, samples) spike
+
+        Returns (marks, peak amplitudes), (k, mark_ndims) and (k,), or a
+        single mark and peak for a single spike.
+        """
+        waveforms = np.asarray(waveforms, dtype='float')
+        single = waveforms.ndim == 2
+        if single:
+            waveforms = waveforms[np.newaxis]
+        if self.n_channels is not None:
+            waveforms = waveforms[:, :self.n_channels]
+
+        k, _, n_samples = waveforms.shape
+        spikes = np.arange(k)
+
+        # channel-major order finds the first channel holding the largest value, then its first sample
+        peak = np.argmax(waveforms.reshape(k, -1), axis=1)
+        peak_channel, peak_sample = np.divmod(peak, n_samples)
+        peak_amplitudes = waveforms[spikes, peak_channel, peak_sample]
+
+        features = [waveforms[spikes, :, peak_sample]]
+        if self.trough or self.width:
+            after_peak = np.arange(n_samples) >= peak_sample[:, np.newaxis]
+            trough_sample = np.argmin(np.where(after_peak, waveforms[spikes, peak_channel], np.inf), axis=1)
+            if self.trough:
+                features.append(waveforms[spikes, :, trough_sample])
+            if self.width:
+                features.append((trough_sample - peak_sample)[:, np.newaxis].astype('float'))
+        marks = np.concatenate(features, axis=1)
+
+        if single:
+            return marks[0], peak_amplitudes[0]
+        return marks, peak_amplitudes
+
+    def accepts(self, ntrode_ids, peak_amplitudes):
+        """
+        Whether each spike passes the tetrode selection and amplitude threshold.
+        """
+        keep = np.isin(ntrode_ids, self.tetrode_ids) == self.is_include
+        if self.minimum_amplitude is not None:
+            keep &= np.asarray(peak_amplitudes) >= self.minimum_amplitude
+        return keep
@@ -0,0 +1,224 @@
+import numpy as np
+import fsgui.nparray
+import fsgui.filter.spikes.markindex
+
+RETENTION_OPTIONS = [
+    {'name': 'all', 'label': 'Keep every mark'},
+    {'name': 'ring', 'label': 'Most recent marks'},
+    {'name': 'window', 'label': 'Marks within a time window'},
+    {'name': 'reservoir', 'label': 'Uniform sample of all marks'},
+]
+
+OCCUPANCY_OPTIONS = [
+    {'name': 'marks', 'label': 'Covariate at each retained mark (per tetrode)'},
+    {'name': 'covariate', 'label': 'Covariate samples while updating (shared)'},
+]
+
+class OccupancyCounter:
+    """
+    Counts per covariate bin, updated one observation at a time. The
+    normalized occupancy, with empty bins filled by the mean count, is
+    cached until the counts change.
+
+    One counter can be shared by the encoders of every tetrode.
+    """
+    def __init__(self, bin_count):
+        self.bin_count = bin_count
+        self.counts = np.zeros((bin_count,), dtype=np.int64)
+        self.version = 0
+        self._cached = None
+
+    def add(self, bin_id):
+        self.counts[int(bin_id)] += 1
+        self.version += 1
+        self._cached = None
+
+    def remove(self, bin_id):
+        self.counts[int(bin_id)] -= 1
+        self.version += 1
+        self._cached = None
+
+    def set_counts(self, counts):
+        self.counts[:] = counts
+        self.version += 1
+        self._cached = None
+
+    def __calculate(self):
+        if self._cached is None:
+            histogram = self.counts.copy()
+            histogram[histogram == 0] = np.mean(histogram)
+            self._cached = (histogram, histogram / np.sum(histogram))
+        return self._cached
+
+    def histogram(self):
+        """
+        Counts with empty bins filled by the mean count.
+        """
+        return self.__calculate()[0]
+
+    def normalized(self):
+        return self.__calculate()[1]
+
+class MarkHistory:
+    """
+    The marks seen on one tetrode, the covariate bin each was recorded at, and
+    the spatial index over the marks.
+
+    `retention` decides what is kept:
+        'all'        every mark, the history grows for the whole session
+        'ring'       the latest `capacity` marks
+        'window'     marks within `window` timestamps of the latest one, at most `capacity`
+        'reservoir'  a uniform sample of `capacity` marks out of all marks seen,
+                     histograms over it are scaled up by `weight`
+
+    The bounded policies keep memory and query cost flat however long the
+    session runs.
+
+    Marks stay float64 so the k-d tree can share them without a copy. Bin
+    ids are stored as uint16 and used for indexing as they are.
+
+    `occupancy` counts the covariates of the retained marks and is kept up
+    to date as marks are added, overwritten or leave the time window. The
+    window assumes timestamps arrive in order.
+    """
+    def __init__(self, mark_ndims, bin_count, retention='all', capacity=100000, window=None, mark_dtype='float', covariate_dtype='uint16'):
+        self.retention = retention
+        self.occupancy = OccupancyCounter(bin_count)
+        # with window retention, marks placed so far that have left the window or been overwritten
+        self.n_expired = 0
+
+        if retention == 'all':
+            self.marks = fsgui.nparray.ArrayList(width=mark_ndims, dtype=mark_dtype)
+            self.covariates = fsgui.nparray.ArrayListSingleWidth(dtype=covariate_dtype)
+        else:
+            if retention == 'ring':
+                self.marks = fsgui.nparray.RingArrayList(capacity, width=mark_ndims, dtype=mark_dtype)
+            elif retention == 'window':
+                self.marks = fsgui.nparray.TimeWindowArrayList(capacity, window, width=mark_ndims, dtype=mark_dtype)
+            elif retention == 'reservoir':
+                self.marks = fsgui.nparray.ReservoirArrayList(capacity, width=mark_ndims, dtype=mark_dtype)
+            else:
+                raise ValueError(f'Unknown mark retention policy: {retention}')
+            # written through `put` into whichever slot the mark went to
+            self.covariates = fsgui.nparray.RingArrayList(capacity, dtype=covariate_dtype)
+
+        self.index = fsgui.filter.spikes.markindex.MarkIndex()
+
+    def add(self, mark, covariate, timestamp=None):
+        if self.retention == 'all':
+            self.marks.place(mark)
+            self.covariates.place(covariate)
+            self.occupancy.add(covariate)
+            return
+
+        if self.retention == 'window':
+            self.__expire(timestamp)
+            slot = self.marks.place(mark, timestamp)
+        else:
+            slot = self.marks.place(mark)
+
+        if slot is None:
+            return
+
+        if slot < self.covariates.index and self.retention != 'window':
+            self.occupancy.remove(self.covariates.array[slot])
+        self.covariates.put(slot, covariate)
+        self.occupancy.add(covariate)
+        self.index.mark_modified(slot)
+
+    def __expire(self, timestamp):
+        # marks leave the window oldest first, ahead of the one the new mark overwrites
+        capacity = self.marks.capacity
+        n_placed = self.marks.n_placed
+        latest = timestamp if self.marks.latest_timestamp is None else max(self.marks.latest_timestamp, timestamp)
+        cutoff = latest - self.marks.window
+
+        while self.n_expired < n_placed and self.marks.timestamps[self.n_expired % capacity] < cutoff:
+            self.occupancy.remove(self.covariates.array[self.n_expired % capacity])
+            self.n_expired += 1
+
+        overwritten = n_placed - capacity
+        if overwritten >= self.n_expired:
+            self.occupancy.remove(self.covariates.array[overwritten % capacity])
+            self.n_expired = overwritten + 1
+
+    @property
+    def n_added(self):
+        """
+        Marks added over the history's lifetime, kept or not.
+        """
+        return self.marks.index if self.retention == 'all' else self.marks.n_placed
+
+    @property
+    def weight(self):
+        """
+        Marks seen per mark kept.
+        """
+        return 1.0 if self.retention == 'all' else self.marks.weight
+
+    def export(self):
+        """
+        The retained marks, oldest first where the policy keeps an order, as
+        (marks, covariates, timestamps or None, marks added).
+        """
+        marks = self.marks.get_slice()
+        covariates = self.covariates.get_slice()
+        if self.retention in ('all', 'reservoir'):
+            return marks, covariates, None, self.n_added
+
+        # the ring's oldest slot is the next one to be overwritten
+        order = np.roll(np.arange(self.marks.index), -(self.marks.n_placed % self.marks.capacity) if self.marks.n_placed > self.marks.capacity else 0)
+        if self.retention == 'window':
+            order = order[self.marks.live_mask(order)]
+            return marks[order], covariates[order], self.marks.timestamps[order], self.n_added
+        return marks[order], covariates[order], None, self.n_added
+
+    def restore(self, marks, covariates, timestamps, n_added):
+        """
+        Replaces the history with exported rows, oldest first. With 'all' the
+        arrays are used as they are, e.g. memory mapped, and copied into a
+        growable buffer only when the next mark is added. The bounded
+        policies keep the newest rows that fit.
+        """
+        if self.retention == 'all':
+            # an empty array could not grow, the history keeps its own buffers
+            if len(marks) > 0:
+                self.marks.array, self.covariates.array = marks, covariates
+            self.marks.index = self.covariates.index = len(marks)
+        else:
+            capacity = self.marks.capacity
+            newest = slice(max(0, len(marks) - capacity), len(marks))
+            n_rows = newest.stop - newest.start
+
+            self.marks.array[:n_rows] = marks[newest]
+            self.covariates.array[:n_rows] = covariates[newest]
+            self.marks.index = self.covariates.index = n_rows
+
+            # a full reservoir carries on sampling from everything it has seen
+            self.marks.n_placed = n_added if self.retention == 'reservoir' and n_rows == capacity else n_rows
+
+            if self.retention == 'window':
+                # rows saved without timestamps stay live until the ring overwrites them
+                self.marks.timestamps[:n_rows] = timestamps[newest] if timestamps is not None else np.inf
+                live = self.marks.timestamps[:n_rows][np.isfinite(self.marks.timestamps[:n_rows])]
+                self.marks.latest_timestamp = live.max() if len(live) > 0 else None
+
+        self.n_expired = 0
+        self.index.reset()
+        self.occupancy.set_counts(np.bincount(self.covariates.get_slice(), minlength=self.occupancy.bin_count))
+
+    def query_neighbourhood(self, center, half_width, radius):
+        """
+        `MarkIndex.query_neighbourhood` over the retained marks.
+        """
+        return self.index.query_neighbourhood(
+            self.marks.get_slice(), center, half_width, radius,
+            row_filter=self.marks.live_mask if self.retention == 'window' else None)
+
+    def query_neighbourhood_batch(self, centers, half_width, radius):
+        """
+        `MarkIndex.query_neighbourhood_batch` over the retained marks.
+        """
+        return self.index.query_neighbourhood_batch(
+            self.marks.get_slice(), centers, half_width, radius,
+            row_filter=self.marks.live_mask if self.retention == 'window' else None)
@@ -0,0 +1,231 @@
+import itertools
+import numpy as np
+import scipy.spatial
+
+class MarkIndex:
+    """
+    Spatial index over the rows of a growing mark history, so neighbourhood
+    queries do not scan the whole history.
+
+    Rows up to the last rebuild are held in a k-d tree, rows appended since
+    form a small unindexed tail that is checked directly. The tree is rebuilt
+    once the tail reaches `rebuild_fraction` of the indexed rows, which keeps
+    the amortized cost per added mark at O(log n).
+
+    The index does not own the marks: every call is handed the current
+    history, e.g. `ArrayList.get_slice()`. Rows may only be appended, or
+    overwritten in place when reported with `mark_modified`, as the bounded
+    histories in `fsgui.nparray` do. Overwritten rows are left out of the
+    tree's answers and checked directly like the tail until the next rebuild.
+    """
+    def __init__(self, rebuild_fraction=0.1, min_tail_length=256):
+        self.rebuild_fraction = rebuild_fraction
+        self.min_tail_length = min_tail_length
+
+        self.reset()
+
+    def reset(self):
+        self.tree = None
+        self.n_indexed = 0
+        self.modified = np.zeros((0,), dtype=bool)
+        self.modified_rows = []
+
+    def mark_modified(self, row):
+        """
+        Report that `row` of the history was overwritten since it was added.
+        """
+        if row < self.n_indexed and not self.modified[row]:
+            self.modified[row] = True
+            self.modified_rows.append(row)
+
+    def __update(self, marks):
+        unindexed_length = len(marks) - self.n_indexed + len(self.modified_rows)
+        if unindexed_length >= max(self.min_tail_length, self.rebuild_fraction * self.n_indexed):
+            self.tree = scipy.spatial.KDTree(marks, copy_data=False)
+            self.n_indexed = len(marks)
+            self.modified = np.zeros((self.n_indexed,), dtype=bool)
+            self.modified_rows = []
+
+    def query_ball(self, marks, center, radius, p=2.0):
+        """
+        Returns the row indices of `marks` within `radius` of `center` under
+        the Minkowski p-norm, boundary included, in no particular order.
+        """
+        self.__update(marks)
+
+        if self.tree is not None:
+            indexed = np.asarray(self.tree.query_ball_point(center, radius, p=p, return_sorted=False), dtype=np.intp)
+        else:
+            indexed = np.empty((0,), dtype=np.intp)
+
+        if self.modified_rows:
+            indexed = indexed[~self.modified[indexed]]
+
+        rows = self.__unindexed_rows(marks)
+        if len(rows) == 0:
+            return indexed
+
+        distance = np.abs(marks[rows] - center)
+        if np.isinf(p):
+            distance = np.max(distance, axis=1)
+        else:
+            distance = np.sum(distance ** p, axis=1) ** (1 / p)
+        return np.concatenate([indexed, rows[distance <= radius]])
+
+    def __unindexed_rows(self, marks):
+        # rows the tree cannot answer for, overwritten ones and the tail
+        tail = np.arange(self.n_indexed, len(marks), dtype=np.intp)
+        if self.modified_rows:
+            return np.concatenate([np.asarray(self.modified_rows, dtype=np.intp), tail])
+        return tail
+
+    def count_in_box(self, marks, center, half_width):
+        """
+        Number of rows strictly inside the hypercube of `half_width` around `center`.
+        """
+        # the tree query is padded against rounding, the exact bounds are applied to the candidates
+        candidates = marks[self.query_ball(marks, center, half_width * (1 + 1e-9), p=np.inf)]
+        inside = np.logical_and(candidates > center - half_width, candidates < center + half_width)
+        return int(np.count_nonzero(np.all(inside, axis=1)))
+
+    def query_neighbourhood(self, marks, center, half_width, radius, row_filter=None):
+        """
+        One pass for both of the encoders' per-spike questions. Returns
+
+            (number of rows strictly inside the hypercube of `half_width`,
+             ascending row indices of the candidates,
+             squared distances of the candidates to `center`)
+
+        where the candidates include every row within `radius` (Euclidean) and
+        every row in the hypercube. Ascending order keeps sums over the
+        candidates in the same order as sums over the whole history.
+
+        `row_filter` maps row indices to a bool mask of the rows to consider,
+        e.g. `TimeWindowArrayList.live_mask`.
+        """
+        reach = max(radius, half_width * np.sqrt(marks.shape[1])) * (1 + 1e-9)
+        candidates = np.sort(self.query_ball(marks, center, reach))
+        if row_filter is not None:
+            candidates = candidates[row_filter(candidates)]
+        offsets = marks[candidates]
+        offsets -= center
+
+        n_in_box = int(np.count_nonzero(np.all(np.abs(offsets) < half_width, axis=1)))
+
+        squared_distance = np.sum(np.square(offsets), axis=1)
+        return n_in_box, candidates, squared_distance
+
+    def query_neighbourhood_batch(self, marks, centers, half_width, radius, row_filter=None):
+        """
+        `query_neighbourhood` for k centers (k, ndims) in one pass. Returns
+
+            (number of rows strictly inside each center's hypercube, shape (k,),
+             center of each candidate pair,
+             row of each candidate pair,
+             squared distance of each candidate pair)
+
+        with the pairs ordered by center and then by ascending row, so the
+        pairs of one center are exactly what `query_neighbourhood` returns.
+        """
+        self.__update(marks)
+        k = len(centers)
+        reach = max(radius, half_width * np.sqrt(marks.shape[1])) * (1 + 1e-9)
+
+        if self.tree is not None:
+            neighbours = self.tree.query_ball_point(centers, reach, return_sorted=False)
+            counts = np.fromiter(map(len, neighbours), dtype=np.intp, count=k)
+            owners = np.repeat(np.arange(k, dtype=np.intp), counts)
+            rows = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=np.intp, count=int(np.sum(counts)))
+            if self.modified_rows:
+                unmodified = ~self.modified[rows]
+                owners, rows = owners[unmodified], rows[unmodified]
+        else:
+            owners = rows = np.empty((0,), dtype=np.intp)
+
+        unindexed_rows = self.__unindexed_rows(marks)
+        if len(unindexed_rows) > 0:
+            distance = np.sum(np.abs(marks[unindexed_rows] - centers[:, np.newaxis, :]) ** 2, axis=2) ** (1 / 2)
+            nearby_owners, nearby = np.nonzero(distance <= reach)
+            owners = np.concatenate([owners, nearby_owners])
+            rows = np.concatenate([rows, unindexed_rows[nearby]])
+
+        # one sort of combined keys puts the pairs in center order, then row order
+        keys = owners * len(marks) + rows
+        keys.sort()
+        owners, rows = np.divmod(keys, len(marks))
+        if row_filter is not None:
+            keep = row_filter(rows)
+            owners, rows = owners[keep], rows[keep]
+
+        offsets = marks[rows]
+        offsets -= centers[owners]
+
+        inside = np.all(np.abs(offsets) < half_width, axis=1)
+        n_in_box = np.bincount(owners[inside], minlength=k)
+
+        squared_distance = np.sum(np.square(offsets), axis=1)
+        return n_in_box, owners, rows, squared_distance
+
+def kernel_truncation_radius(k1, k2, weight_floor):
+    """
+    Distance beyond which the kernel k1 * exp(k2 * d^2) falls below `weight_floor`.
+    """
+    return np.sqrt(max(0.0, np.log(weight_floor / k1) / k2))
+
+class GaussianKernel:
+    """
+    The encoders' kernel k1 * exp(k2 * d^2) for `sigma`, truncated at the
+    radius where it falls to `tolerance` times its peak k1, i.e.
+    sigma * sqrt(2 ln(1 / tolerance)). Marks beyond the radius get no
+    weight, so each truncated mark changes a histogram bin by less than
+    `tolerance` * k1.
+
+    With `lookup_size` the kernel is read from a table of that many
+    entries over [0, radius^2] in d^2, linearly interpolated. With spacing
+    h = radius^2 / (lookup_size - 1), interpolating exp(k2 * d^2) has a
+    relative error of at most (k2 h)^2 / 8 * exp(|k2| h) at every
+    distance, which is
+
+        (ln(1 / tolerance) / (lookup_size - 1))^2 / 8
+
+    to first order, and is kept as `lookup_error_bound`. Histograms are
+    sums of positive weights, so they share the bound. For tolerance 1e-20
+    and 16384 entries it is 9.9e-7.
+    """
+    def __init__(self, sigma, tolerance=1e-20, lookup_size=None):
+        self.k1 = 1 / (np.sqrt(2*np.pi) * sigma)
+        self.k2 = -0.5 / (sigma**2)
+
+        self.radius = kernel_truncation_radius(self.k1, self.k2, tolerance * self.k1)
+        self.squared_radius = self.radius ** 2
+
+        if lookup_size:
+            assert lookup_size >= 2
+            self._spacing = self.squared_radius / (lookup_size - 1)
+            # one entry past the radius so the last interval interpolates too
+            self._table = self.k1 * np.exp(self.k2 * self._spacing * np.arange(lookup_size + 1))
+            self._slope = np.diff(self._table)
+
+            step = abs(self.k2) * self._spacing
+            self.lookup_error_bound = step ** 2 / 8 * np.exp(step)
+        else:
+            self._table = None
+            self.lookup_error_bound = 0.0
+
+    def within(self, squared_distance):
+        """
+        Whether each squared distance is inside the truncation radius.
+        """
+        return squared_distance <= self.squared_radius
+
+    def weights(self, squared_distance):
+        """
+        Kernel weights for squared distances inside the truncation radius.
+        """
+        if self._table is None:
+            return self.k1 * np.exp(self.k2 * squared_distance)
+
+        position = squared_distance / self._spacing
+        entry = position.astype(np.intp)
+        position -= entry
+        return self._table[entry] + position * self._slope[entry]
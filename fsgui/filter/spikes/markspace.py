@@ -1,6 +1,13 @@
+import collections
 import multiprocessing as mp
 import fsgui.nparray
 import fsgui.node
+import fsgui.events
+import fsgui.filter.spikes.markindex
+import fsgui.filter.spikes.markextract
+import fsgui.filter.spikes.markhistory
+import fsgui.filter.spikes.querycache
+import fsgui.filter.spikes.snapshot
 import json
 import numpy as np
 import time
@@ -96,30 +103,159 @@ class MarkSpaceEncoderType(fsgui.node.NodeTypeObject):
                 'tooltip': 'Sigma controls the width of the kernel; a larger sigma is a wider kernel',
                 'live_editable': True,
             },
+            {
+                'label': 'Mark retention',
+                'name': 'retention',
+                'type': 'select',
+                'options': fsgui.filter.spikes.markhistory.RETENTION_OPTIONS,
+                'default': config.get('retention', 'all'),
+                'tooltip': 'Which marks each tetrode keeps. The bounded policies keep memory and query time flat over long sessions.',
+            },
+            {
+                'label': 'Retention capacity (marks per tetrode)',
+                'name': 'retention_capacity',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 10000000,
+                'default': config.get('retention_capacity', 100000),
+            },
+            {
+                'label': 'Retention window',
+                'name': 'retention_window',
+                'type': 'double',
+                'lower': 0,
+                'upper': 100000,
+                'decimals': 1,
+                'default': config.get('retention_window', 600),
+                'units': 's',
+                'tooltip': 'Age of the oldest mark kept by the time window policy.',
+            },
+            {
+                'label': 'Occupancy',
+                'name': 'occupancy_source',
+                'type': 'select',
+                'options': fsgui.filter.spikes.markhistory.OCCUPANCY_OPTIONS,
+                'default': config.get('occupancy_source', 'marks'),
+                'tooltip': 'Normalize each tetrode by the covariates of its own retained marks, or by one count of covariate samples shared by all tetrodes.',
+            },
+            {
+                'label': 'Worker processes',
+                'name': 'num_workers',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 64,
+                'default': config.get('num_workers', 1),
+                'tooltip': 'Number of processes the tetrodes are sharded across. Use more than one for many tetrodes with long histories.',
+            },
+            {
+                'label': 'Query cache size (0 is off)',
+                'name': 'query_cache_size',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 1000000,
+                'default': config.get('query_cache_size', 0),
+                'tooltip': 'Number of recent query results kept, keyed by tetrode and quantized mark.',
+            },
+            {
+                'label': 'Query cache resolution',
+                'name': 'query_cache_resolution',
+                'type': 'double',
+                'lower': 0.001,
+                'upper': 1000,
+                'decimals': 3,
+                'default': config.get('query_cache_resolution', 1.0),
+                'units': 'uV',
+                'tooltip': 'Marks that agree to this resolution on every channel share a cached result.',
+            },
+            {
+                'label': 'Query cache: marks added before refresh',
+                'name': 'query_cache_max_new_marks',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 1000000,
+                'default': config.get('query_cache_max_new_marks', 100),
+                'tooltip': 'A cached result is recomputed once its tetrode has gained this many marks, or when the shared occupancy changes.',
+            },
+            {
+                'label': 'Snapshot directory',
+                'name': 'snapshot_directory',
+                'type': 'string',
+                'default': config.get('snapshot_directory', ''),
+                'tooltip': 'Directory the encoder model is saved to on demand and at unbuild. Leave empty to disable snapshots.',
+            },
+            {
+                'label': 'Warm start from snapshot',
+                'name': 'warm_start',
+                'type': 'boolean',
+                'default': config.get('warm_start', False),
+                'tooltip': 'On build, restore the marks and occupancy saved in this node\'s snapshot.',
+            },
+            {
+                'label': 'Kernel truncation tolerance (log10)',
+                'name': 'kernel_tolerance_exponent',
+                'type': 'integer',
+                'lower': -300,
+                'upper': -1,
+                'default': config.get('kernel_tolerance_exponent', -20),
+                'tooltip': 'Marks whose kernel weight is below 10^this times the kernel peak are skipped. -20 reaches 9.6 sigma, -6 reaches 5.3 sigma.',
+            },
+            {
+                'label': 'Kernel lookup table size (0 is off)',
+                'name': 'kernel_lookup_size',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 10000000,
+                'default': config.get('kernel_lookup_size', 0),
+                'tooltip': 'Evaluate the kernel from an interpolated table instead of exp. With x = ln(10) * |tolerance exponent| / (size - 1), the relative error is at most x^2 / 8 * exp(x), e.g. 9.9e-7 for -20 and 16384.',
+            },
+            {
+                'label': 'Report query diagnostics',
+                'name': 'report_diagnostics',
+                'type': 'boolean',
+                'default': config.get('report_diagnostics', False),
+                'tooltip': 'Report the unnormalized histograms and the distance and weight distributions of sampled queries.',
+            },
+            {
+                'label': 'Diagnostics interval',
+                'name': 'diagnostics_interval',
+                'type': 'integer',
+                'lower': 1,
+                'upper': 1000000,
+                'default': config.get('diagnostics_interval', 100),
+                'units': 'spikes',
+                'tooltip': 'With diagnostics on, every Nth spike is sampled. 1 samples every spike.',
+            },
         ]
     
+    def get_gui_config(self):
+        return [
+            {
+                'type': 'button',
+                'label': 'Save encoder snapshot',
+                'name': 'save_snapshot',
+                'pressed': True,
+            },
+            {
+                'type': 'button',
+                'label': 'Report diagnostics for next spike',
+                'name': 'sample_diagnostics',
+                'pressed': True,
+            },
+        ]
+
     def build(self, config, addr_map):
         spikes_address=addr_map[config['spikes_source']]
         covariate_address=addr_map[config['covariate_source']]
         update_address=addr_map[config['update_signal_source']]
 
-        encoder = MarkSpaceEncoder(
-            mark_ndims=config['mark_ndims'],
-            bin_count=config['bin_count'],
-            sigma=config['sigma'],
-        )
-
+        num_workers = config.get('num_workers', 1)
+        count_covariate_occupancy = config.get('occupancy_source', 'marks') == 'covariate'
+        diagnostics_interval = config.get('diagnostics_interval', 100) if config.get('report_diagnostics', False) else None
 
-        def compute_mark(datapoint):
-            spike_data = np.atleast_2d(datapoint.data)
-            channel_peaks = np.max(spike_data, axis=1)
-            peak_channel_ind = np.argmax(channel_peaks)
-            t_ind = np.argmax(spike_data[peak_channel_ind])
-            amp_mark = spike_data[:, t_ind]
+        # for spikes that arrive without a mark from the source
+        mark_extractor = fsgui.filter.spikes.markextract.MarkExtractor()
 
-            return amp_mark
-
-        def setup(reporter, data):
+        def setup(logging, data):
             data['spikes_sub'] = fsgui.network.UnidirectionalChannelReceiver(spikes_address)
             data['covariate_sub'] = fsgui.network.UnidirectionalChannelReceiver(covariate_address)
             data['update_sub'] = fsgui.network.UnidirectionalChannelReceiver(update_address)
@@ -130,165 +266,464 @@ class MarkSpaceEncoderType(fsgui.node.NodeTypeObject):
             data['poller'].register(data['covariate_sub'].sock)
             data['poller'].register(data['update_sub'].sock)
 
-            data['filter_model'] = {}
+            if num_workers > 1:
+                data['encoder'] = ShardedMarkSpaceEncoder(config, num_workers)
+            else:
+                data['encoder'] = MarkSpaceEncoderShard(config)
+            if config.get('snapshot_directory') and config.get('warm_start', False):
+                logging.info(f'Encoder warm start restored {data["encoder"].n_restored} tetrodes')
             data['update_model_bool'] = False
             data['current_covariate_value'] = None
+            data['spike_count'] = 0
+            data['diagnostics_requested'] = False
 
         def workload(connection, publisher, reporter, data):
             t0 = time.time()
-            results = dict(data['poller'].poll(timeout=500))
+            # while workers hold spikes, come back quickly for their results
+            results = dict(data['poller'].poll(timeout=1 if data['encoder'].n_pending > 0 else 500))
 
             if connection.pipe_poll(timeout = 0):
                 msg_tag, msg_data = connection.pipe_recv()
+                if msg_tag == 'save_snapshot':
+                    data['encoder'].save_snapshot()
+                if msg_tag == 'sample_diagnostics':
+                    data['diagnostics_requested'] = True
                 if msg_tag == 'update':
                     msg_varname, msg_value = msg_data
                     if msg_varname == 'sigma':
-                        for model in data['filter_model'].values():
-                            model.update_sigma(msg_value)
+                        data['encoder'].update_sigma(msg_value)
 
             if data['spikes_sub'].sock in results:
                 spikes_data = data['spikes_sub'].recv()
                 # we have a spike
-                samples = np.array(spikes_data['samples'])
+                if 'mark' in spikes_data:
+                    mark = np.asarray(spikes_data['mark'], dtype='float')
+                else:
+                    mark, _ = mark_extractor.extract(np.atleast_2d(spikes_data['samples']))
                 t1 = time.time()
 
-                mark = compute_mark(samples)
+                # diagnostics only for sampled spikes, or the one asked for from the GUI
+                diagnostics = data['diagnostics_requested'] or (
+                    diagnostics_interval is not None and data['spike_count'] % diagnostics_interval == 0)
+                data['diagnostics_requested'] = False
+                data['spike_count'] += 1
+
+                data['encoder'].submit({
+                    'tetrode_id': spikes_data['nTrodeId'],
+                    'timestamp': spikes_data['localTimestamp'],
+                    'mark': mark,
+                    'covariate': data['current_covariate_value'],
+                    'update_model': data['update_model_bool'],
+                    'receive_time': t1 - t0,
+                    'diagnostics': diagnostics,
+                })
 
-                query_result = data['filter_model'].setdefault(spikes_data['nTrodeId'], MarkSpaceEncoder(mark_ndims=config['mark_ndims'], bin_count=config['bin_count'], sigma=config['sigma'])).query(mark)
-                if query_result is not None:
-                    query_histogram_normalized = query_result[0].tolist()
-                    query_histogram = query_result[1].tolist()
-                    occupancy_histogram = query_result[2].tolist()
-                    occupancy_histogram_normalized = query_result[3].tolist()
-                    distance_dist = query_result[4].tolist()
-                    weights_dist = query_result[5].tolist()
+            # results come back in submission order for each tetrode
+            for spike, query_histogram_normalized, diagnostics, query_time, cache_stats in data['encoder'].collect():
+                if diagnostics is not None:
+                    query_histogram = diagnostics['query_histogram'].tolist()
+                    occupancy_histogram = diagnostics['occupancy_histogram'].tolist()
+                    distance_dist = diagnostics['distance_dist'].tolist()
+                    weights_dist = diagnostics['weights_dist'].tolist()
                 else:
-                    query_histogram_normalized = None
                     query_histogram = None
                     occupancy_histogram = None
-                    occupancy_histogram_normalized = None
                     distance_dist = None
                     weights_dist = None
 
-                t2 = time.time()
-
                 publisher.send({
-                    'timestamp': spikes_data['localTimestamp'],
-                    'electrode_group_id': spikes_data['nTrodeId'],
-                    'histogram': query_histogram_normalized,
-                    'bin_id': data['current_covariate_value'],
+                    'timestamp': spike['timestamp'],
+                    'electrode_group_id': spike['tetrode_id'],
+                    # an array, the pipe to the decoder pickles it without a list conversion
+                    'histogram': query_histogram_normalized.astype('float32') if query_histogram_normalized is not None else None,
+                    'bin_id': spike['covariate'],
                 })
 
                 reporter.send({
-                    'me_receive_time': t1 - t0,
-                    'me_query_time': t2 - t1,
-                    'me_mark': mark.tolist(),
+                    'me_receive_time': spike['receive_time'],
+                    'me_query_time': query_time,
+                    'me_mark': spike['mark'].tolist(),
                     'me_query_histogram': query_histogram,
                     'me_occupancy_histogram': occupancy_histogram,
                     'me_distance_dist': distance_dist,
                     'me_weights_dist': weights_dist,
-                    'me_covariate': np.bincount([data['current_covariate_value']], minlength=config['bin_count']).tolist() if data['current_covariate_value'] is not None else None,
+                    'me_covariate': np.bincount([spike['covariate']], minlength=config['bin_count']).tolist() if spike['covariate'] is not None else None,
+                    'me_cache': cache_stats,
                 })
 
-                if data['update_model_bool']:
-                    data['filter_model'].get(spikes_data['nTrodeId']).add_mark(mark)
-
             if data['update_sub'].sock in results:
                 item = data['update_sub'].recv(timeout=500)
-                data['update_model_bool'] = bool(item)
+                # event-mode filters only publish onsets/offsets, which latch the state
+                data['update_model_bool'] = bool(fsgui.events.latch(item))
 
             if data['covariate_sub'].sock in results:
                 item = data['covariate_sub'].recv(timeout=500)
-                for model in data['filter_model'].values():
-                    model.update_covariate(int(item))
                 data['current_covariate_value'] = int(item)
+                if count_covariate_occupancy and data['update_model_bool']:
+                    data['encoder'].observe_covariate(int(item))
+
+        def cleanup(connection, data):
+            if 'encoder' in data:
+                data['encoder'].save_snapshot()
+                data['encoder'].close()
+
+        return fsgui.process.build_process_object(setup, workload, cleanup)
+
+class MarkSpaceEncoderShard:
+    """
+    The encoders of the tetrodes one process owns, with the occupancy counter
+    and query cache they share. Spikes are encoded in the order they are
+    submitted and the results wait for `collect`.
+
+    A shard owns the nTrodeIds equal to `shard_index` modulo `num_shards`.
+    With a snapshot directory configured it saves its tetrodes on
+    `save_snapshot` and, with warm start, restores them when created.
+    """
+    def __init__(self, config, shard_index=0, num_shards=1):
+        self.config = dict(config)
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.encoders = {}
+
+        if self.config.get('occupancy_source', 'marks') == 'covariate':
+            self.occupancy = fsgui.filter.spikes.markhistory.OccupancyCounter(self.config['bin_count'])
+        else:
+            self.occupancy = None
+
+        if self.config.get('query_cache_size', 0) > 0:
+            self.query_cache = fsgui.filter.spikes.querycache.QueryCache(
+                size=self.config['query_cache_size'],
+                resolution=self.config.get('query_cache_resolution', 1.0),
+                max_new_marks=self.config.get('query_cache_max_new_marks', 100),
+            )
+        else:
+            self.query_cache = None
 
-        return fsgui.process.build_process_object(setup, workload)
+        self.results = collections.deque()
+        self.n_restored = 0
+
+        if self.config.get('snapshot_directory'):
+            self.snapshot = fsgui.filter.spikes.snapshot.EncoderSnapshot(
+                directory=self.config['snapshot_directory'],
+                instance_id=self.config['instance_id'],
+                mark_ndims=self.config['mark_ndims'],
+                bin_count=self.config['bin_count'],
+            )
+            if self.config.get('warm_start', False):
+                self.n_restored = self.load_snapshot()
+        else:
+            self.snapshot = None
+
+    def owns(self, tetrode_id):
+        return tetrode_id % self.num_shards == self.shard_index
+
+    def save_snapshot(self):
+        if self.snapshot is None:
+            return
+        for tetrode_id, encoder in self.encoders.items():
+            self.snapshot.save_tetrode(tetrode_id, encoder.observations, {'sigma': self.config['sigma']})
+        # every shard holds the same shared counts
+        if self.occupancy is not None and self.shard_index == 0:
+            self.snapshot.save_occupancy(self.occupancy)
+
+    def load_snapshot(self):
+        """
+        Restores the owned, compatible tetrodes of the snapshot. The kernel
+        stays as configured. Returns the number of tetrodes restored.
+        """
+        n_restored = 0
+        for tetrode_id in filter(self.owns, self.snapshot.tetrode_ids()):
+            if self.snapshot.load_tetrode(tetrode_id, self.__encoder(tetrode_id).observations):
+                n_restored += 1
+            else:
+                del self.encoders[tetrode_id]
+        if self.occupancy is not None:
+            self.snapshot.load_occupancy(self.occupancy)
+        return n_restored
+
+    def __encoder(self, tetrode_id):
+        if tetrode_id not in self.encoders:
+            self.encoders[tetrode_id] = MarkSpaceEncoder(
+                mark_ndims=self.config['mark_ndims'],
+                bin_count=self.config['bin_count'],
+                sigma=self.config['sigma'],
+                retention=self.config.get('retention', 'all'),
+                retention_capacity=self.config.get('retention_capacity', 100000),
+                # hardware timestamps are 30 kHz
+                retention_window=self.config.get('retention_window', 600) * 30000,
+                occupancy=self.occupancy,
+                query_cache=self.query_cache,
+                tetrode_id=tetrode_id,
+                kernel_tolerance=10.0 ** self.config.get('kernel_tolerance_exponent', -20),
+                kernel_lookup_size=self.config.get('kernel_lookup_size', 0) or None,
+            )
+        return self.encoders[tetrode_id]
+
+    @property
+    def n_pending(self):
+        return len(self.results)
+
+    def update_sigma(self, sigma):
+        self.config['sigma'] = sigma
+        for encoder in self.encoders.values():
+            encoder.update_sigma(sigma)
+
+    def observe_covariate(self, bin_id):
+        """
+        Counts a covariate sample seen while the model is updating.
+        """
+        if self.occupancy is not None:
+            self.occupancy.add(bin_id)
+
+    def submit(self, spike):
+        """
+        spike: dict with 'tetrode_id', 'mark', 'covariate', 'update_model',
+        'timestamp' and optionally 'diagnostics', passed back with the result
+        """
+        t = time.time()
+        encoder = self.__encoder(spike['tetrode_id'])
+        if spike.get('diagnostics', False):
+            query_histogram, diagnostics = encoder.query_diagnostics(spike['mark'])
+        else:
+            query_histogram, diagnostics = encoder.query(spike['mark']), None
+        query_time = time.time() - t
+
+        if spike['update_model']:
+            encoder.update_covariate(spike['covariate'])
+            encoder.add_mark(spike['mark'], spike['timestamp'])
+
+        cache_stats = self.query_cache.stats() if self.query_cache is not None else None
+        self.results.append((spike, query_histogram, diagnostics, query_time, cache_stats))
+
+    def collect(self):
+        """
+        Returns the (spike, normalized query histogram, diagnostics, query
+        time, cache stats) of every spike encoded since the last call.
+        """
+        results = list(self.results)
+        self.results.clear()
+        return results
+
+    def close(self):
+        pass
+
+def _encoder_shard_worker(conn, config, shard_index, num_shards):
+    shard = MarkSpaceEncoderShard(config, shard_index, num_shards)
+    conn.send(shard.n_restored)
+
+    while True:
+        msg_tag, msg_data = conn.recv()
+        if msg_tag == 'stop':
+            break
+        elif msg_tag == 'spike':
+            shard.submit(msg_data)
+            conn.send(shard.collect())
+        elif msg_tag == 'sigma':
+            shard.update_sigma(msg_data)
+        elif msg_tag == 'covariate':
+            shard.observe_covariate(msg_data)
+        elif msg_tag == 'snapshot':
+            shard.save_snapshot()
+
+class ShardedMarkSpaceEncoder:
+    """
+    Spreads the tetrodes over worker processes, each running a
+    MarkSpaceEncoderShard for the nTrodeIds with `tetrode_id % num_workers`
+    equal to its index. Covariate and kernel updates go to every worker.
+    Spikes are handed over without waiting, so the workers encode in
+    parallel. Each worker answers in order, so results for one tetrode
+    never overtake each other.
+    """
+    def __init__(self, config, num_workers):
+        self.num_workers = num_workers
+        self.n_pending = 0
+
+        self._conns = []
+        self._procs = []
+        for worker_index in range(num_workers):
+            conn, worker_conn = mp.Pipe(duplex=True)
+            proc = mp.Process(target=_encoder_shard_worker, args=(worker_conn, dict(config), worker_index, num_workers))
+            proc.start()
+            # only the worker holds its end, so its pipe reads EOF once it exits
+            worker_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+        # each worker reports the tetrodes it restored once it is ready
+        self.n_restored = sum(self.__recv(worker_index) for worker_index in range(num_workers))
+
+    def __check_alive(self, worker_index):
+        proc = self._procs[worker_index]
+        if not proc.is_alive():
+            self.close()
+            raise RuntimeError(f'Mark space encoder worker {worker_index} exited with code {proc.exitcode}')
+
+    def __recv(self, worker_index):
+        # polls so that a worker dying before it answers raises instead of blocking forever
+        conn = self._conns[worker_index]
+        while not conn.poll(1):
+            self.__check_alive(worker_index)
+        try:
+            return conn.recv()
+        except EOFError:
+            self._procs[worker_index].join(1)
+            self.__check_alive(worker_index)
+            raise
+
+    def __broadcast(self, msg_tag, msg_data):
+        for conn in self._conns:
+            conn.send((msg_tag, msg_data))
+
+    def update_sigma(self, sigma):
+        self.__broadcast('sigma', sigma)
+
+    def observe_covariate(self, bin_id):
+        self.__broadcast('covariate', bin_id)
+
+    def save_snapshot(self):
+        self.__broadcast('snapshot', None)
+
+    def submit(self, spike):
+        self._conns[spike['tetrode_id'] % self.num_workers].send(('spike', spike))
+        self.n_pending += 1
+
+    def collect(self):
+        results = []
+        for worker_index, conn in enumerate(self._conns):
+            while conn.poll(0):
+                results.extend(self.__recv(worker_index))
+        if self.n_pending > len(results):
+            for worker_index in range(self.num_workers):
+                self.__check_alive(worker_index)
+        self.n_pending -= len(results)
+        return results
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(('stop', None))
+            except BrokenPipeError:
+                pass
+        for proc in self._procs:
+            proc.join()
 
 class MarkSpaceEncoder:
-    def __init__(self, mark_ndims, bin_count=20, sigma=1):
+    def __init__(self, mark_ndims, bin_count=20, sigma=1, retention='all', retention_capacity=100000, retention_window=None, occupancy=None,
+            query_cache=None, tetrode_id=None, kernel_tolerance=1e-20, kernel_lookup_size=None):
         self.bin_count = bin_count
+        self.kernel_tolerance = kernel_tolerance
+        self.kernel_lookup_size = kernel_lookup_size
+
+        # optional fsgui.filter.spikes.querycache.QueryCache, shared by the node's encoders
+        self.query_cache = query_cache
+        self.tetrode_id = tetrode_id
 
         # Gaussian kernel parameters
-        self.update_sigma(sigma)
+        self.__set_kernel(sigma)
 
         self.current_covariate_value = None
-        self.observations_mark = fsgui.nparray.ArrayList(width=mark_ndims, dtype='float')
-        self.observations_covariate = fsgui.nparray.ArrayList(width=1, dtype='float')
+        self.observations = fsgui.filter.spikes.markhistory.MarkHistory(
+            mark_ndims,
+            bin_count,
+            retention=retention,
+            capacity=retention_capacity,
+            window=retention_window,
+            mark_dtype='float',
+            covariate_dtype='uint16',
+        )
+
+        # a shared OccupancyCounter, otherwise the covariates of this tetrode's marks
+        self.shared_occupancy = occupancy
+        self.occupancy = occupancy if occupancy is not None else self.observations.occupancy
     
     def update_sigma(self, sigma):
-        self._k1 = 1 / (np.sqrt(2*np.pi) * sigma)
-        self._k2 = -0.5 / (sigma**2)
+        self.__set_kernel(sigma)
+
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    def __set_kernel(self, sigma):
+        self._kernel = fsgui.filter.spikes.markindex.GaussianKernel(
+            sigma, tolerance=self.kernel_tolerance, lookup_size=self.kernel_lookup_size)
+        self._kernel_radius = self._kernel.radius
 
     def update_covariate(self, covariate_value):
         self.current_covariate_value = covariate_value
 
-    def add_mark(self, mark_value):
+    def add_mark(self, mark_value, timestamp=None):
         if self.current_covariate_value is not None:
-            self.observations_mark.place(mark_value)
-            self.observations_covariate.place(self.current_covariate_value)
+            self.observations.add(mark_value, self.current_covariate_value, timestamp)
 
-    def __calculate_filter(self, mark_value):
-        # these are configurations
-        n_std, std = (5, 20)
-        n_marks_min = 10
-
-        half_box_width = n_std * std
-
-        return np.sum(
-            functools.reduce(
-                np.logical_and,
-                itertools.chain.from_iterable([
-                    [
-                        self.observations_mark.get_slice()[:,dim] > mark_value[dim] - half_box_width,
-                        self.observations_mark.get_slice()[:,dim] < mark_value[dim] + half_box_width,
-                    ]
-                    for dim in range(self.observations_mark.get_slice().shape[1])
-                ]
-        ))) >= n_marks_min
-
-    def __calculate_histogram(self, mark_value):
-
-        squared_distance = np.sum(
-            np.square(self.observations_mark.get_slice() - mark_value),
-            axis=1
-        )
-
-        # larger k2 is narrower kernel, smaller k2 is wider kernel
-        observation_weights = self._k1 * np.exp(self._k2 * squared_distance)
-        # necessary to remove super tiny weights because bug in numpy histograms
-        observation_weights[observation_weights < 1e-20] = 0
-        observation_covariates = self.observations_covariate.get_slice().flatten().astype(np.int32)
+    def __calculate_histogram(self, candidates, squared_distance, diagnostics=False):
+        # the candidates also cover the count box, only those inside the kernel's radius get a weight
+        within = self._kernel.within(squared_distance)
+        observation_weights = self._kernel.weights(squared_distance[within])
+        observation_covariates = self.observations.covariates.get_slice()
 
         query_histogram = np.bincount(
-            observation_covariates,
+            observation_covariates[candidates[within]],
             weights=observation_weights,
             minlength=self.bin_count)
 
-        occupancy_histogram = np.bincount(
-            observation_covariates,
-            minlength=self.bin_count)
-        occupancy_histogram[occupancy_histogram == 0] = np.mean(occupancy_histogram)
-        occupancy_histogram_normalized = occupancy_histogram / np.sum(occupancy_histogram)
+        # a sampled history stands for more marks than it holds
+        if self.observations.weight != 1.0:
+            query_histogram *= self.observations.weight
 
-        query_histogram_normalized = query_histogram / occupancy_histogram_normalized
+        query_histogram_normalized = query_histogram / self.occupancy.normalized()
+        if not diagnostics:
+            return query_histogram_normalized, None
 
-        # for debugging
+        # for debugging, over the marks near the query
+        candidate_weights = np.zeros(squared_distance.shape)
+        candidate_weights[within] = observation_weights
         distance_dist, _ = np.histogram(squared_distance, bins = 30)
-        weights_dist, _ = np.histogram(observation_weights, bins = 30)
-
-        return (
-            # this is the main value we need
-            query_histogram_normalized,
-            query_histogram,
-            occupancy_histogram,
-            occupancy_histogram_normalized,
-            distance_dist,
-            weights_dist,
-            )
+        weights_dist, _ = np.histogram(candidate_weights, bins = 30)
+
+        return query_histogram_normalized, {
+            'query_histogram': query_histogram,
+            'occupancy_histogram': self.occupancy.histogram(),
+            'distance_dist': distance_dist,
+            'weights_dist': weights_dist,
+        }
+
+    def query_diagnostics(self, m):
+        """
+        `query` without the cache, also returning the unnormalized histograms
+        and the distance and weight distributions behind it, or None for
+        them where the region held too few marks.
+        """
+        return self.__query(m, diagnostics=True)
 
     def query(self, m):
-        if self.__calculate_filter(m):
-            return self.__calculate_histogram(m)
+        """
+        The normalized query histogram, or None where the region held too few marks.
+        """
+        if self.query_cache is not None:
+            key = self.query_cache.key(self.tetrode_id, m)
+            version = (
+                self.observations.n_added,
+                self.shared_occupancy.version if self.shared_occupancy is not None else 0,
+            )
+            found, result = self.query_cache.get(key, version)
+            if not found:
+                result, _ = self.__query(m)
+                self.query_cache.put(key, version, result)
+            return result
+
+        result, _ = self.__query(m)
+        return result
+
+    def __query(self, m, diagnostics=False):
+        # these are configurations
+        n_std, std = (5, 20)
+        n_marks_min = 10
+
+        half_box_width = n_std * std
+
+        n_in_box, candidates, squared_distance = self.observations.query_neighbourhood(
+            m, half_box_width, self._kernel_radius)
+
+        if n_in_box >= n_marks_min:
+            return self.__calculate_histogram(candidates, squared_distance, diagnostics)
         else:
-            return None
\ No newline at end of file
+            return None, None
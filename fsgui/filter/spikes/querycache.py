@@ -0,0 +1,63 @@
+import collections
+import numpy as np
+
+class QueryCache:
+    """
+    LRU cache of encoder query results, keyed by tetrode and by the mark
+    quantized to `resolution` (µV). Marks come from ADC values, so spikes of
+    one unit often land on the same key.
+
+    Each entry remembers the model version it was computed at, a pair of
+    (marks added to the tetrode, version of the shared occupancy). It is
+    served until `max_new_marks` more marks have been added or the shared
+    occupancy has changed. Cached arrays are made read-only.
+    """
+    def __init__(self, size, resolution, max_new_marks):
+        self.size = size
+        self.resolution = resolution
+        self.max_new_marks = max_new_marks
+
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tetrode_id, mark):
+        return (tetrode_id, np.round(np.asarray(mark) / self.resolution).astype(np.int64).tobytes())
+
+    def get(self, key, version):
+        """
+        Returns (found, result).
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            result, (n_marks, occupancy_version) = entry
+            if version[0] - n_marks < self.max_new_marks and version[1] == occupancy_version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, result
+            del self.entries[key]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, version, result):
+        for value in (result if isinstance(result, tuple) else (result,)):
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+
+        self.entries[key] = (result, version)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_hit_rate': self.hits / lookups if lookups > 0 else None,
+            'cache_entries': len(self.entries),
+        }
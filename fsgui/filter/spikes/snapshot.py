@@ -0,0 +1,103 @@
+import glob
+import os
+import re
+import time
+import numpy as np
+
+class EncoderSnapshot:
+    """
+    Saves encoder models to a directory, one set of files per tetrode, and
+    restores them into newly built encoders, so a rebuilt node is informative
+    straight away instead of waiting for the animal to cover the track again.
+
+    Each tetrode's marks, covariates and timestamps are plain .npy files that
+    are loaded memory mapped: restoring does not read or copy the marks, the
+    spatial index is built on the tetrode's first query. The small .npz next
+    to them (written last) holds the kernel parameters and the marks added
+    over the model's lifetime. Files are written then renamed, so a crash
+    leaves the previous snapshot of that tetrode usable.
+
+    Files are per tetrode so that worker processes can save and load the
+    tetrodes they own independently.
+    """
+    prefix = 'encoder_snapshot_'
+
+    def __init__(self, directory, instance_id, mark_ndims, bin_count):
+        self.path = os.path.join(directory, f'{self.prefix}{instance_id}')
+        self.mark_ndims = mark_ndims
+        self.bin_count = bin_count
+
+    def __write(self, name, write):
+        temp_path = os.path.join(self.path, f'{name}.tmp')
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, os.path.join(self.path, name))
+
+    def save_tetrode(self, tetrode_id, history, kernel_params):
+        os.makedirs(self.path, exist_ok=True)
+
+        marks, covariates, timestamps, n_added = history.export()
+        name = f'tetrode_{tetrode_id}'
+        self.__write(f'{name}.marks.npy', lambda f: np.save(f, np.ascontiguousarray(marks, dtype='float')))
+        self.__write(f'{name}.covariates.npy', lambda f: np.save(f, np.ascontiguousarray(covariates)))
+        if timestamps is not None:
+            self.__write(f'{name}.timestamps.npy', lambda f: np.save(f, timestamps))
+        self.__write(f'{name}.npz', lambda f: np.savez(
+            f,
+            n_rows=len(marks),
+            n_added=n_added,
+            mark_ndims=self.mark_ndims,
+            bin_count=self.bin_count,
+            has_timestamps=timestamps is not None,
+            saved_time=time.time(),
+            **{f'kernel_{key}': value for key, value in kernel_params.items()},
+        ))
+
+    def save_occupancy(self, occupancy):
+        os.makedirs(self.path, exist_ok=True)
+        self.__write('occupancy.npz', lambda f: np.savez(f, counts=occupancy.counts, bin_count=self.bin_count))
+
+    def tetrode_ids(self):
+        ids = []
+        for path in glob.glob(os.path.join(self.path, 'tetrode_*.npz')):
+            match = re.fullmatch(r'tetrode_(\d+)\.npz', os.path.basename(path))
+            if match is not None:
+                ids.append(int(match.group(1)))
+        return sorted(ids)
+
+    def load_tetrode(self, tetrode_id, history):
+        """
+        Restores the tetrode's snapshot into `history`. Returns whether it
+        was compatible (same mark dimensions and bin count) and complete.
+        """
+        name = os.path.join(self.path, f'tetrode_{tetrode_id}')
+        try:
+            with np.load(f'{name}.npz') as meta:
+                if int(meta['mark_ndims']) != self.mark_ndims or int(meta['bin_count']) != self.bin_count:
+                    return False
+                n_rows = int(meta['n_rows'])
+                n_added = int(meta['n_added'])
+                has_timestamps = bool(meta['has_timestamps'])
+
+            marks = np.load(f'{name}.marks.npy', mmap_mode='r')
+            covariates = np.load(f'{name}.covariates.npy', mmap_mode='r')
+            timestamps = np.load(f'{name}.timestamps.npy', mmap_mode='r') if has_timestamps else None
+        except (OSError, KeyError, ValueError):
+            return False
+
+        # the arrays are renamed into place before the .npz, a mismatch means a save was interrupted
+        if len(marks) != n_rows or len(covariates) != n_rows or (timestamps is not None and len(timestamps) != n_rows):
+            return False
+
+        history.restore(marks, covariates, timestamps, n_added)
+        return True
+
+    def load_occupancy(self, occupancy):
+        try:
+            with np.load(os.path.join(self.path, 'occupancy.npz')) as saved:
+                if int(saved['bin_count']) != self.bin_count:
+                    return False
+                occupancy.set_counts(saved['counts'])
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
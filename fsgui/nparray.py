@@ -21,6 +21,33 @@ class CircularArray:
     def get_slice(self):
         return np.roll(self.array, -self.index)
 
+class SlidingWindowArray:
+    """
+    Slice view goes forward, oldest to newest, and is a view rather than a copy.
+    Every sample is written twice into a buffer of twice the length, so the
+    latest `length` samples are always contiguous.
+
+    With `num_signals` each sample is a (num_signals,) vector and the slice
+    is (num_signals, length).
+    """
+    def __init__(self, length, dtype=None, num_signals=None):
+        self.length = length
+        shape = (2 * self.length,) if num_signals is None else (num_signals, 2 * self.length)
+        self.array = np.zeros(shape, dtype=dtype)
+        self.index = 0
+
+        assert length > 0
+
+    def place(self, x):
+        self.array[..., self.index] = x
+        self.array[..., self.index + self.length] = x
+        self.index += 1
+        self.index %= self.length
+
+    @property
+    def get_slice(self):
+        return self.array[..., self.index:self.index + self.length]
+
 class MultiCircularArray:
     """
     Slice view goes forward.
@@ -47,6 +74,12 @@ class MultiCircularArray:
         return np.roll(self.array, -self.index, axis=1)
 
 
+def _grown(array, n_used):
+    # double into fresh zeroed pages, copying the used rows once
+    grown = np.zeros(shape=(2 * array.shape[0],) + array.shape[1:], dtype=array.dtype)
+    grown[:n_used] = array[:n_used]
+    return grown
+
 class ArrayList:
     def __init__(self, width, capacity=10000, dtype=None):
         self.array = np.zeros(shape=(capacity, width), dtype=dtype)
@@ -54,7 +87,7 @@ class ArrayList:
     
     def place(self, x):
         if self.index >= self.array.shape[0]:
-            self.array = np.vstack((self.array, np.zeros_like(self.array)))
+            self.array = _grown(self.array, self.index)
         self.array[self.index, :] = x
         self.index += 1
 
@@ -68,9 +101,101 @@ class ArrayListSingleWidth:
     
     def place(self, x):
         if self.index >= self.array.shape[0]:
-            self.array = np.concatenate([self.array, np.zeros_like(self.array)])
+            self.array = _grown(self.array, self.index)
         self.array[self.index] = x
         self.index += 1
 
     def get_slice(self):
-        return self.array[:self.index]
\ No newline at end of file
+        return self.array[:self.index]
+
+class RingArrayList:
+    """
+    Fixed-capacity counterpart of ArrayList that keeps the most recent
+    `capacity` rows, overwriting the oldest. Rows are never moved, so a row's
+    slot stays valid until it is overwritten.
+
+    `place` returns the slot the row was written to, or None if the row was
+    not kept. Aligned side arrays (e.g. the covariate of each mark) use `put`
+    to write into the same slot. `get_slice` is in slot order, not time order.
+
+    With `width=None` each row is a scalar.
+    """
+    def __init__(self, capacity, width=None, dtype=None):
+        assert capacity > 0
+        self.capacity = capacity
+        shape = (capacity,) if width is None else (capacity, width)
+        self.array = np.zeros(shape=shape, dtype=dtype)
+        self.index = 0
+        self.n_placed = 0
+
+    def _select_slot(self):
+        return self.n_placed % self.capacity
+
+    def place(self, x):
+        slot = self._select_slot()
+        self.n_placed += 1
+        if slot is not None:
+            self.put(slot, x)
+        return slot
+
+    def put(self, slot, x):
+        self.array[slot] = x
+        self.index = max(self.index, slot + 1)
+
+    @property
+    def weight(self):
+        """
+        Factor that scales counts over the kept rows to counts over all placed rows.
+        """
+        return 1.0
+
+    def get_slice(self):
+        return self.array[:self.index]
+
+class ReservoirArrayList(RingArrayList):
+    """
+    Fixed-capacity uniform sample of every row ever placed (reservoir
+    sampling, algorithm R). Once full, the n-th row replaces a random slot
+    with probability capacity / n and is otherwise dropped, so each kept
+    row stands for `weight` = n / capacity placed rows.
+    """
+    def __init__(self, capacity, width=None, dtype=None, seed=None):
+        super().__init__(capacity, width=width, dtype=dtype)
+        self.rng = np.random.default_rng(seed)
+
+    def _select_slot(self):
+        if self.n_placed < self.capacity:
+            return self.n_placed
+        slot = int(self.rng.integers(0, self.n_placed + 1))
+        return slot if slot < self.capacity else None
+
+    @property
+    def weight(self):
+        return self.n_placed / self.index if self.index > 0 else 1.0
+
+class TimeWindowArrayList(RingArrayList):
+    """
+    Ring of at most `capacity` rows, of which only those placed within
+    `window` of the latest timestamp are live. Expired rows stay in their
+    slots until overwritten, callers mask them with `live_mask`.
+    """
+    def __init__(self, capacity, window, width=None, dtype=None):
+        super().__init__(capacity, width=width, dtype=dtype)
+        self.window = window
+        self.timestamps = np.zeros(shape=(capacity,))
+        self.latest_timestamp = None
+
+    def place(self, x, timestamp):
+        slot = super().place(x)
+        self.timestamps[slot] = timestamp
+        self.latest_timestamp = timestamp if self.latest_timestamp is None else max(self.latest_timestamp, timestamp)
+        return slot
+
+    def live_mask(self, slots=None):
+        """
+        Whether each of `slots` (default all slots in use) is inside the window.
+        """
+        timestamps = self.timestamps[:self.index] if slots is None else self.timestamps[slots]
+        if self.latest_timestamp is None:
+            return np.ones(timestamps.shape, dtype=bool)
+        return timestamps >= self.latest_timestamp - self.window
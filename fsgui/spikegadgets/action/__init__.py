@@ -1,4 +1,5 @@
 import fsgui.process
+import fsgui.events
 import fsgui.network
 import functools
 import fsgui.spikegadgets.trodesnetwork as trodesnetwork
@@ -229,7 +230,8 @@ def build_shortcut_command(
         for sub_name, source_pipe in pipe_map.items():
             if source_pipe.poll(timeout=0):
                 value = source_pipe.recv()
-                data['sub_values'][sub_name] = value
+                # event-mode filters only publish onsets/offsets, which latch the state
+                data['sub_values'][sub_name] = fsgui.events.latch(value)
 
         def evaluate_node(node, data):
             if 'gate' == node['data']['type']:
@@ -2,6 +2,7 @@ import multiprocessing as mp
 import fsgui.process
 import fsgui.node
 import fsgui.network
+import fsgui.filter.spikes.markextract
 import fsgui.spikegadgets.trodes
 import fsgui.spikegadgets.trodesnetwork as trodesnetwork
 import logging
@@ -57,7 +58,55 @@ class SpikesDataType(fsgui.node.NodeTypeObject):
                 'tooltip': 'This is multiplied by every spike value.',
                 'live_editable': True,
             },
- 
+            {
+                'label': 'Compute marks',
+                'name': 'compute_marks',
+                'type': 'boolean',
+                'default': config.get('compute_marks', False),
+                'tooltip': 'Extract each spike\'s mark here, once, and publish it with the spike as \'mark\' and \'peakAmplitude\'. Spikes failing the selection or threshold below are dropped.',
+            },
+            {
+                'label': 'Mark channels (0 is all)',
+                'name': 'mark_channels',
+                'type': 'integer',
+                'lower': 0,
+                'upper': 256,
+                'default': config.get('mark_channels', 0),
+                'tooltip': 'Number of leading channels of each nTrode used for the mark.',
+            },
+            {
+                'label': 'Mark feature: trough',
+                'name': 'mark_trough',
+                'type': 'boolean',
+                'default': config.get('mark_trough', False),
+                'tooltip': 'Append every channel\'s value at the trough of the peak channel. Encoders need mark dimensions to match.',
+            },
+            {
+                'label': 'Mark feature: width',
+                'name': 'mark_width',
+                'type': 'boolean',
+                'default': config.get('mark_width', False),
+                'tooltip': 'Append the number of samples from peak to trough. Encoders need mark dimensions to match.',
+            },
+            {
+                'label': 'Mark filter: minimum spike amplitude',
+                'name': 'minimum_spike_amplitude',
+                'type': 'double',
+                'lower': 0,
+                'upper': 10000,
+                'decimals': 2,
+                'default': config.get('minimum_spike_amplitude', 0),
+                'units': 'uV',
+                'live_editable': True,
+            },
+            {
+                'label': 'Mark filter: tetrode selection',
+                'name': 'tetrode_selection',
+                'type': 'tetrode_selection',
+                'default': config.get('tetrode_selection'),
+                'tooltip': 'nTrodeIds whose spikes are published when computing marks.',
+                'live_editable': True,
+            },
         ]
 
     def build(self, config, addr_map):
@@ -69,6 +118,16 @@ class SpikesDataType(fsgui.node.NodeTypeObject):
 
         def setup(reporter, data):
             data['spikes_sub'] = trodesnetwork.SourceSubscriber('source.waveforms', server_address = f'{self.network_location.address}:{self.network_location.port}')
+            if config.get('compute_marks', False):
+                data['mark_extractor'] = fsgui.filter.spikes.markextract.MarkExtractor(
+                    n_channels=config.get('mark_channels', 0) or None,
+                    trough=config.get('mark_trough', False),
+                    width=config.get('mark_width', False),
+                    minimum_amplitude=config.get('minimum_spike_amplitude', 0),
+                    tetrode_selection=config.get('tetrode_selection'),
+                )
+            else:
+                data['mark_extractor'] = None
 
         def workload(connection, publisher, reporter, data):
             if connection.pipe_poll(timeout = 0):
@@ -76,10 +135,23 @@ class SpikesDataType(fsgui.node.NodeTypeObject):
                 if msg_tag == 'update':
                     msg_varname, msg_value = msg_data
                     config[msg_varname] = msg_value
+                    if data['mark_extractor'] is not None:
+                        data['mark_extractor'].minimum_amplitude = config.get('minimum_spike_amplitude', 0)
+                        data['mark_extractor'].set_tetrode_selection(config.get('tetrode_selection'))
 
             spikes_data = data['spikes_sub'].receive(timeout=50)
             if spikes_data is not None:
-                spikes_data['samples'] = (np.array(spikes_data['samples']) * config['voltage_scaling_factor']).tolist()
-                publisher.send(spikes_data)
+                samples = np.array(spikes_data['samples']) * config['voltage_scaling_factor']
+                spikes_data['samples'] = samples.tolist()
+
+                accepted = True
+                if data['mark_extractor'] is not None:
+                    mark, peak_amplitude = data['mark_extractor'].extract(samples)
+                    accepted = data['mark_extractor'].accepts(spikes_data['nTrodeId'], peak_amplitude)
+                    spikes_data['mark'] = mark.tolist()
+                    spikes_data['peakAmplitude'] = float(peak_amplitude)
+
+                if accepted:
+                    publisher.send(spikes_data)
        
         return fsgui.process.build_process_object(setup, workload)
\ No newline at end of file
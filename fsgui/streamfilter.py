@@ -0,0 +1,136 @@
+import numpy as np
+
+class SOSFilter:
+    """
+    Cascade of second-order IIR sections in transposed direct form II.
+
+    Filters one multi-channel sample per call, updating the state in place so
+    nothing is allocated on the per-sample path. The state has the same layout
+    and arithmetic as scipy.signal.sosfilt, so `zi` can be handed back and forth
+    with block filtering and the outputs agree exactly.
+    """
+    def __init__(self, sos, num_signals):
+        self.sos = np.array(np.atleast_2d(sos), dtype='double')
+        self.num_signals = num_signals
+
+        # python floats so the coefficients broadcast without creating arrays
+        self._coefficients = [tuple(float(c) for c in section) for section in self.sos]
+
+        # (n_sections, 2, num_signals), matches sosfilt's zi for axis=0
+        self.zi = np.zeros((self.sos.shape[0], 2, num_signals), dtype='double')
+
+        self._x = np.zeros((num_signals,), dtype='double')
+        self._y = np.zeros((num_signals,), dtype='double')
+        self._tmp = np.zeros((num_signals,), dtype='double')
+
+    def reset(self):
+        self.zi[:] = 0
+
+    def filter_sample(self, x, out):
+        """
+        x: (num_signals,) or scalar input sample
+        out: (num_signals,) buffer the filtered sample is written into
+        """
+        section_in, section_out, tmp = self._x, self._y, self._tmp
+        np.copyto(section_in, x)
+
+        for (b0, b1, b2, _, a1, a2), z in zip(self._coefficients, self.zi):
+            # y = b0*x + z0
+            np.multiply(section_in, b0, out=section_out)
+            np.add(section_out, z[0], out=section_out)
+            # z0 = b1*x - a1*y + z1
+            np.multiply(section_in, b1, out=z[0])
+            np.multiply(section_out, a1, out=tmp)
+            np.subtract(z[0], tmp, out=z[0])
+            np.add(z[0], z[1], out=z[0])
+            # z1 = b2*x - a2*y
+            np.multiply(section_in, b2, out=z[1])
+            np.multiply(section_out, a2, out=tmp)
+            np.subtract(z[1], tmp, out=z[1])
+
+            # the output of this section is the input of the next
+            section_in, section_out = section_out, section_in
+
+        np.copyto(out, section_in)
+        return out
+
+    def filter_value(self, x):
+        """
+        Single-channel version of filter_sample on python floats, which avoids
+        the ufunc overhead that dominates when there is only one signal.
+        """
+        zi = self.zi
+        for s, (b0, b1, b2, _, a1, a2) in enumerate(self._coefficients):
+            y = b0*x + zi[s, 0, 0]
+            zi[s, 0, 0] = b1*x - a1*y + zi[s, 1, 0]
+            zi[s, 1, 0] = b2*x - a2*y
+            x = y
+        return float(x)
+
+class FIRFilter:
+    """
+    FIR filter in transposed direct form II with a circular state index.
+
+    Instead of shifting the state every sample, the head of the state moves
+    around a ring and the taps are pre-rotated to match, so each sample is a
+    fixed number of in-place operations. The arithmetic matches
+    scipy.signal.lfilter(b, [1, 0], ...) and `get_state`/`set_state` convert
+    to and from lfilter's zi layout.
+    """
+    def __init__(self, b, num_signals):
+        self.b = np.array(b, dtype='double').ravel()
+        self.num_signals = num_signals
+
+        self._b0 = float(self.b[0])
+        self._n_state = len(self.b) - 1
+
+        # physical state slots, logical index k lives at (head + k) % n_state
+        self._state = np.zeros((self._n_state, num_signals), dtype='double')
+        self._head = 0
+
+        # taps added to each physical slot for each position of the head.
+        # the slot under the head is consumed by the output and then refilled
+        # with the last tap, so it is zeroed before the taps are added.
+        n = self._n_state
+        self._rotated_taps = np.zeros((n, n, 1), dtype='double')
+        for head in range(n):
+            for slot in range(n):
+                logical = (slot - head) % n
+                self._rotated_taps[head, slot, 0] = self.b[logical] if logical > 0 else self.b[n]
+
+        self._tmp = np.zeros((n, num_signals), dtype='double')
+
+    def reset(self):
+        self._state[:] = 0
+        self._head = 0
+
+    def get_state(self):
+        """
+        Returns a copy of the state in lfilter's zi layout, (num_taps - 1, num_signals).
+        """
+        return np.roll(self._state, -self._head, axis=0)
+
+    def set_state(self, zi):
+        self._state[:] = zi
+        self._head = 0
+
+    def filter_sample(self, x, out):
+        """
+        x: (num_signals,) or scalar input sample
+        out: (num_signals,) buffer the filtered sample is written into
+        """
+        # y = b0*x + z0
+        np.multiply(x, self._b0, out=out)
+        if self._n_state == 0:
+            return out
+
+        head = self._head
+        np.add(out, self._state[head], out=out)
+
+        # z_k = z_(k+1) + b_(k+1)*x, with the consumed slot becoming the last one
+        self._state[head] = 0
+        np.multiply(self._rotated_taps[head], x, out=self._tmp)
+        np.add(self._state, self._tmp, out=self._state)
+
+        self._head = (head + 1) % self._n_state
+        return out
@@ -492,6 +492,7 @@ class FSGuiWidget(QtWidgets.QWidget):
             ('node:spikes', lambda i, e: qtgui.forms.GuiFormSelectWidget(options=get_options_datatype('spikes'), default=i.get('default'), editable=e)),
             ('node:timestamp', lambda i, e: qtgui.forms.GuiFormSelectWidget(options=get_options_datatype('timestamp'), default=i.get('default'), editable=e)),
             ('node:point2d', lambda i, e: qtgui.forms.GuiFormSelectWidget(options=get_options_datatype('point2d'), default=i.get('default'), editable=e)),
+            ('node:band_envelope', lambda i, e: qtgui.forms.GuiFormSelectWidget(options=get_options_datatype('band_envelope'), default=i.get('default'), editable=e)),
             ('node:tree', lambda i, e: qtapp.component.FSGuiFilterSelectionWidget(filters=get_options_datatype('bool'), default=i.get('default'), editable=e)),
             ('geometry', lambda i, e: qtapp.component.FSGuiGeometrySelectionWidget(default=i.get('default'), editable=e)),
             ('linearization', lambda i, e: qtapp.component.FSGuiLinearizationSelectionWidget(default=i.get('default'), editable=e)),
@@ -0,0 +1,29 @@
+import numpy as np
+
+import fsgui.filter.lfp.ripple_new as ripple_new
+
+def test_warm_start_survives_sharded_worker_startup(tmp_path):
+    num_signals = 8
+    channel_ids = np.arange(num_signals)
+    checkpoint = ripple_new.BaselineCheckpoint(str(tmp_path), 'test', channel_ids, [1.0])
+
+    saved = ripple_new.EnvelopeThresholdDetector(num_signals)
+    saved.means[:] = 5
+    saved.M2[:] = 400
+    saved.counts[:] = 100
+    assert checkpoint.save(saved)
+
+    detector = ripple_new.ShardedEnvelopeDetector(
+        num_signals=num_signals, num_workers=2, max_block_size=4, estimator_kwargs={})
+    try:
+        assert checkpoint.load_into(detector, prior_samples=100) == num_signals
+
+        # a round trip through every worker, so all of them have finished starting up
+        config = {'sample_mean_sd': False, 'sd_threshold': 3, 'auto_flag': True, 'means_magic_input': 0, 'sigmas_magic_input': 0}
+        detector.process_block(np.zeros((4, num_signals)), config)
+
+        np.testing.assert_array_equal(detector.means, 5)
+        np.testing.assert_array_equal(detector.counts, 100)
+        np.testing.assert_allclose(detector.sigmas, 2)
+    finally:
+        detector.close()